@@ -0,0 +1,175 @@
+import asyncio
+import math
+import time
+from collections import deque
+from typing import (
+    Any,
+    Awaitable,
+    Dict,
+    Optional,
+)
+
+from fastapi import HTTPException
+from sse_starlette import EventSourceResponse
+from starlette.background import BackgroundTask, BackgroundTasks
+
+
+class Ticket:
+    """ A granted generation slot. """
+
+    def __init__(self, controller: "AdmissionController") -> None:
+        self.controller = controller
+        self.acquired_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller.release(time.monotonic() - self.acquired_at)
+
+    def defer(self) -> BackgroundTask:
+        """ Keep the slot until the (streaming) response has been sent. """
+        return BackgroundTask(self.release)
+
+
+class AdmissionController:
+    """
+    Bounds the number of concurrent generations.
+
+    Requests beyond `max_concurrency` (unbounded if `None`) wait in a FIFO
+    queue of at most `max_queue_size` entries. A request is rejected with
+    `429` and a `Retry-After` hint when the queue is full or when it has
+    waited longer than `queue_timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: Optional[int] = None,
+        max_queue_size: int = 64,
+        queue_timeout: float = 30.0,
+    ) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+
+        self.active = 0
+        self._waiters: deque = deque()
+
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self.num_timeouts = 0
+        self.avg_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.avg_service_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def hold(self, ticket: Optional[Ticket], response: Awaitable[Any]) -> Any:
+        """
+        Awaits the response of a request admitted with `ticket` (if any), and
+        releases the slot once it is sent.
+        """
+        try:
+            response = await response
+        except BaseException:
+            if ticket is not None:
+                ticket.release()
+            raise
+
+        if ticket is None:
+            return response
+        if isinstance(response, EventSourceResponse):
+            if response.background is None:
+                response.background = ticket.defer()
+            else:
+                tasks = BackgroundTasks()
+                tasks.add_task(response.background)
+                tasks.add_task(ticket.defer())
+                response.background = tasks
+        else:
+            ticket.release()
+        return response
+
+    async def acquire(self) -> Ticket:
+        start = time.monotonic()
+        if (self.max_concurrency is None or self.active < self.max_concurrency) and not self._waiters:
+            self.active += 1
+            return self._admitted(start)
+
+        if len(self._waiters) >= self.max_queue_size:
+            self.num_rejected += 1
+            raise self._overloaded("The server is overloaded, please retry later.")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._cancel_waiter(waiter)
+            self.num_timeouts += 1
+            raise self._overloaded("Timed out waiting in the request queue, please retry later.")
+        except asyncio.CancelledError:
+            self._cancel_waiter(waiter)
+            raise
+        return self._admitted(start)
+
+    def release(self, service_time: Optional[float] = None) -> None:
+        if service_time is not None:
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * service_time
+
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # hand the slot over
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queue_depth,
+            "max_queue_size": self.max_queue_size,
+            "num_admitted": self.num_admitted,
+            "num_rejected": self.num_rejected,
+            "num_timeouts": self.num_timeouts,
+            "avg_wait_time": self.avg_wait_time,
+            "max_wait_time": self.max_wait_time,
+            "avg_service_time": self.avg_service_time,
+        }
+
+    def _admitted(self, start: float) -> Ticket:
+        wait_time = time.monotonic() - start
+        self.num_admitted += 1
+        self.avg_wait_time = 0.9 * self.avg_wait_time + 0.1 * wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return Ticket(self)
+
+    def _cancel_waiter(self, waiter: asyncio.Future) -> None:
+        if waiter.done() and not waiter.cancelled():
+            # the slot was handed over while we gave up
+            self.release()
+        else:
+            waiter.cancel()
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                pass
+
+    def _overloaded(self, message: str) -> HTTPException:
+        # rough estimate of when a slot frees up for a new request
+        retry_after = self.avg_service_time * (self.queue_depth + 1) / max(self.max_concurrency or 1, 1)
+        return HTTPException(
+            status_code=429,
+            detail={
+                "error": {
+                    "message": message,
+                    "type": "server_overloaded",
+                    "param": None,
+                    "code": "engine_overloaded",
+                }
+            },
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
@@ -0,0 +1,381 @@
+import asyncio
+import json
+import os
+import secrets
+import time
+import uuid
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Set,
+    TYPE_CHECKING,
+)
+
+import anyio
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from loguru import logger
+from openai.types.batch import Batch, Errors
+from openai.types.batch_error import BatchError
+from openai.types.batch_request_counts import BatchRequestCounts
+
+from api.common import dictify, jsonify, model_validate
+from api.protocol import (
+    BatchCreateParams,
+    ChatCompletionCreateParams,
+    CompletionCreateParams,
+    Role,
+)
+from api.utils import check_completion_requests, parse_prompt_format
+
+if TYPE_CHECKING:
+    from api.admission import AdmissionController
+    from api.engine.hf import HuggingFaceEngine
+
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchRunner:
+    """
+    Runs OpenAI batch jobs, JSONL files of chat or text completion requests
+    uploaded through the files api, in the background of the server.
+
+    Batch requests only take the capacity left by interactive requests: no
+    new request is started while interactive requests wait for a generation
+    slot, and batch and interactive requests together stay below
+    `max_concurrency`. Batch requests are decoded together by the batch
+    scheduler of the engine.
+
+    Every finished request is appended to a checkpoint file next to the batch
+    state in `batch_path`, so a restarted server resumes unfinished batches
+    where they stopped. Results are written to `storage_path` as files.
+    """
+
+    def __init__(
+        self,
+        engine: "HuggingFaceEngine",
+        storage_path: str,
+        batch_path: str,
+        max_concurrency: int = 256,
+        admission_controller: Optional["AdmissionController"] = None,
+        poll_interval: float = 0.5,
+    ) -> None:
+        self.engine = engine
+        self.storage_path = storage_path
+        self.batch_path = batch_path
+        self.max_concurrency = max_concurrency
+        self.admission_controller = admission_controller
+        self.poll_interval = poll_interval
+
+        # batch requests get their own worker threads, so they never starve interactive requests
+        self.limiter = anyio.CapacityLimiter(max_concurrency)
+        self.batches: Dict[str, Batch] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self.num_running_requests = 0
+
+    async def start(self) -> None:
+        """
+        Load the saved batches and start the worker, resuming unfinished
+        batches. Called once at the startup of the app.
+        """
+        if self._worker is not None:
+            return
+        self._queue = asyncio.Queue()
+        for batch in await anyio.to_thread.run_sync(self._load):
+            self.batches[batch.id] = batch
+            if batch.status not in FINAL_STATUSES:
+                self._queue.put_nowait(batch.id)
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    def create(self, request: BatchCreateParams) -> Batch:
+        if self._find_file(request.input_file_id) is None:
+            raise HTTPException(status_code=404, detail=f"File {request.input_file_id} not found!")
+
+        created_at = int(time.time())
+        batch = Batch(
+            id=f"batch_{uuid.uuid4().hex}",
+            object="batch",
+            endpoint=request.endpoint,
+            input_file_id=request.input_file_id,
+            completion_window=request.completion_window,
+            status="validating",
+            created_at=created_at,
+            expires_at=created_at + 24 * 3600,
+            metadata=request.metadata,
+            request_counts=BatchRequestCounts(total=0, completed=0, failed=0),
+        )
+        self.batches[batch.id] = batch
+        self._save(batch)
+        self._queue.put_nowait(batch.id)
+        return batch
+
+    def retrieve(self, batch_id: str) -> Batch:
+        if batch_id not in self.batches:
+            raise HTTPException(status_code=404, detail=f"Batch {batch_id} not found!")
+        return self.batches[batch_id]
+
+    def cancel(self, batch_id: str) -> Batch:
+        batch = self.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            raise HTTPException(status_code=400, detail=f"Batch {batch_id} is already {batch.status}.")
+        if batch.status != "cancelling":
+            batch.status, batch.cancelling_at = "cancelling", int(time.time())
+            self._save(batch)
+        return batch
+
+    def list(self, after: Optional[str] = None, limit: int = 20) -> List[Batch]:
+        batches = sorted(self.batches.values(), key=lambda b: b.created_at, reverse=True)
+        if after is not None:
+            ids = [b.id for b in batches]
+            batches = batches[ids.index(after) + 1:] if after in ids else []
+        return batches[:limit]
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {"num_running_requests": self.num_running_requests}
+        for batch in self.batches.values():
+            stats[f"num_{batch.status}"] = stats.get(f"num_{batch.status}", 0) + 1
+        return stats
+
+    async def _run(self) -> None:
+        while True:
+            batch_id = await self._queue.get()
+            batch = self.batches[batch_id]
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logger.exception(f"Batch {batch_id} failed")
+                batch.status, batch.failed_at = "failed", int(time.time())
+                batch.errors = Errors(object="list", data=[BatchError(code="internal_error", message=str(e))])
+                self._save(batch)
+
+    async def _process(self, batch: Batch) -> None:
+        requests = self._read_requests(batch)
+        if requests is None:
+            return
+
+        checkpoint = os.path.join(self.batch_path, f"{batch.id}.jsonl")
+        done = set()
+        completed = failed = 0
+        if os.path.exists(checkpoint):
+            with open(checkpoint, encoding="utf-8") as f:
+                for line in f:
+                    result = json.loads(line)
+                    done.add(result["custom_id"])
+                    if result["error"] is None and result["response"]["status_code"] == 200:
+                        completed += 1
+                    else:
+                        failed += 1
+
+        batch.request_counts = BatchRequestCounts(total=len(requests), completed=completed, failed=failed)
+        if batch.status == "validating":
+            batch.status, batch.in_progress_at = "in_progress", int(time.time())
+        self._save(batch)
+
+        tasks: Set[asyncio.Task] = set()
+        with open(checkpoint, "a", encoding="utf-8") as output:
+            for request in requests:
+                if request["custom_id"] in done:
+                    continue
+                await self._wait_for_capacity(tasks)
+                if batch.status == "cancelling" or time.time() > batch.expires_at:
+                    break
+                tasks.add(asyncio.create_task(self._run_request(batch, request, output)))
+            if tasks:
+                await asyncio.wait(tasks)
+
+        now = int(time.time())
+        if batch.status == "cancelling":
+            batch.status, batch.cancelled_at = "cancelled", now
+        elif batch.request_counts.completed + batch.request_counts.failed < len(requests):
+            batch.status, batch.expired_at = "expired", now
+        else:
+            batch.status, batch.finalizing_at = "finalizing", now
+        self._save(batch)
+        self._write_results(batch, checkpoint)
+
+    def _read_requests(self, batch: Batch) -> Optional[List[Dict[str, Any]]]:
+        """ Returns the requests of the input file, or `None` if the batch failed validation. """
+        filename = self._find_file(batch.input_file_id)
+        errors, requests, custom_ids = [], [], set()
+        if filename is None:
+            errors.append(BatchError(code="invalid_file", message=f"File {batch.input_file_id} not found!"))
+        else:
+            with open(os.path.join(self.storage_path, filename), encoding="utf-8") as f:
+                for i, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        request = json.loads(line)
+                    except json.JSONDecodeError:
+                        errors.append(BatchError(code="invalid_json_line", line=i, message="Invalid JSON."))
+                        continue
+                    if request.get("url") != batch.endpoint:
+                        errors.append(
+                            BatchError(
+                                code="mismatched_endpoint",
+                                line=i,
+                                message=f"The url must match the endpoint of the batch {batch.endpoint}.",
+                            )
+                        )
+                    elif not isinstance(request.get("body"), dict):
+                        errors.append(BatchError(code="missing_body", line=i, message="Missing request body."))
+                    elif request.get("custom_id") is None or request["custom_id"] in custom_ids:
+                        errors.append(
+                            BatchError(code="duplicate_custom_id", line=i, message="The custom_id must be unique.")
+                        )
+                    else:
+                        custom_ids.add(request["custom_id"])
+                        requests.append(request)
+            if not requests and not errors:
+                errors.append(BatchError(code="empty_file", message="The input file has no requests."))
+
+        if errors:
+            batch.status, batch.failed_at = "failed", int(time.time())
+            batch.errors = Errors(object="list", data=errors)
+            self._save(batch)
+            return None
+        return requests
+
+    async def _wait_for_capacity(self, tasks: Set[asyncio.Task]) -> None:
+        while True:
+            tasks.difference_update([task for task in tasks if task.done()])
+            active, waiting = 0, 0
+            if self.admission_controller is not None:
+                active, waiting = self.admission_controller.active, self.admission_controller.queue_depth
+            if waiting == 0 and len(tasks) + active < self.max_concurrency:
+                return
+            if tasks:
+                await asyncio.wait(tasks, timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run_request(self, batch: Batch, request: Dict[str, Any], output) -> None:
+        result = {
+            "id": f"batch_req_{uuid.uuid4().hex}",
+            "custom_id": request["custom_id"],
+            "response": None,
+            "error": None,
+        }
+        self.num_running_requests += 1
+        try:
+            body = await self._generate(batch.endpoint, request["body"])
+            result["response"] = {"status_code": 200, "request_id": result["id"], "body": body}
+        except HTTPException as e:
+            result["response"] = {"status_code": e.status_code, "request_id": result["id"], "body": e.detail}
+        except Exception as e:
+            result["error"] = {"code": "internal_error", "message": str(e)}
+        finally:
+            self.num_running_requests -= 1
+
+        counts = batch.request_counts
+        if result["error"] is None and result["response"]["status_code"] == 200:
+            counts.completed += 1
+        else:
+            counts.failed += 1
+        output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        output.flush()
+
+    async def _generate(self, endpoint: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        """ Runs one request like the online endpoint, without streaming. """
+        engine = self.engine
+        body = dict(body, stream=False)
+        if endpoint == "/v1/chat/completions":
+            request = model_validate(ChatCompletionCreateParams, body)
+            if (not request.messages) or request.messages[-1]["role"] == Role.ASSISTANT.value:
+                raise HTTPException(status_code=400, detail="Invalid request")
+
+            request = await check_completion_requests(
+                request,
+                engine.template.stop,
+                engine.template.stop_token_ids,
+            )
+            if isinstance(request, JSONResponse):
+                raise HTTPException(status_code=400, detail=json.loads(request.body))
+            request.max_tokens = request.max_tokens or 1024
+
+            params = dictify(request, exclude={"messages"})
+            params.update(dict(prompt_or_messages=request.messages, echo=False))
+            create = engine.create_chat_completion
+        else:
+            request = model_validate(CompletionCreateParams, body)
+            try:
+                _, prompts = parse_prompt_format(request.prompt)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid request")
+
+            request = await check_completion_requests(
+                request,
+                engine.template.stop,
+                engine.template.stop_token_ids,
+                chat=False,
+            )
+            if isinstance(request, JSONResponse):
+                raise HTTPException(status_code=400, detail=json.loads(request.body))
+            request.max_tokens = request.max_tokens or 128
+
+            params = dictify(request, exclude={"prompt"})
+            params.update(dict(prompt_or_messages=prompts[0] if len(prompts) == 1 else prompts))
+            create = engine.create_completion
+
+        params["batched"] = True
+        response = await anyio.to_thread.run_sync(create, params, limiter=self.limiter)
+        if isinstance(response, JSONResponse):
+            raise HTTPException(status_code=response.status_code, detail=json.loads(response.body))
+        return json.loads(jsonify(response))
+
+    def _write_results(self, batch: Batch, checkpoint: str) -> None:
+        """ Split the checkpoint into the output and error files of the batch. """
+        output_file_id = "file-" + secrets.token_hex(12)
+        error_file_id = "file-" + secrets.token_hex(12)
+        output_path = os.path.join(self.storage_path, f"{output_file_id}_{batch.id}_output.jsonl")
+        error_path = os.path.join(self.storage_path, f"{error_file_id}_{batch.id}_error.jsonl")
+
+        num_outputs = num_errors = 0
+        with open(checkpoint, encoding="utf-8") as f, \
+                open(output_path, "w", encoding="utf-8") as output, \
+                open(error_path, "w", encoding="utf-8") as error:
+            for line in f:
+                result = json.loads(line)
+                if result["error"] is None and result["response"]["status_code"] == 200:
+                    output.write(line)
+                    num_outputs += 1
+                else:
+                    error.write(line)
+                    num_errors += 1
+
+        if num_outputs:
+            batch.output_file_id = output_file_id
+        else:
+            os.remove(output_path)
+        if num_errors:
+            batch.error_file_id = error_file_id
+        else:
+            os.remove(error_path)
+
+        if batch.status == "finalizing":
+            batch.status, batch.completed_at = "completed", int(time.time())
+        self._save(batch)
+        os.remove(checkpoint)
+
+    def _load(self) -> List[Batch]:
+        batches = []
+        for filename in sorted(os.listdir(self.batch_path)):
+            if filename.endswith(".json"):
+                with open(os.path.join(self.batch_path, filename), encoding="utf-8") as f:
+                    batches.append(model_validate(Batch, json.load(f)))
+        return batches
+
+    def _save(self, batch: Batch) -> None:
+        path = os.path.join(self.batch_path, f"{batch.id}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(jsonify(batch))
+        os.replace(f"{path}.tmp", path)
+
+    def _find_file(self, file_id: str) -> Optional[str]:
+        for filename in os.listdir(self.storage_path):
+            if filename.startswith(file_id):
+                return filename
+        return None
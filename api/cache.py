@@ -0,0 +1,410 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+import numpy as np
+from loguru import logger
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
+
+from api.common import EncodedChunk, jsonify, model_validate
+from api.protocol import Role
+
+if TYPE_CHECKING:
+    from api.rag import RAGEmbedding
+
+# request fields which do not change the generated response
+EXCLUDED_KEYS = {"stream", "cancel_event", "user", "batched", "inputs"}
+
+# request fields which must match exactly for a semantically cached answer to be reused
+SEMANTIC_KEYS = ("tools", "functions", "tool_choice", "response_format", "max_tokens", "stop")
+
+
+def request_key(kind: str, params: Dict[str, Any], **extra: Any) -> Optional[str]:
+    """ Returns a canonical hash of a deterministic request, or `None` if its response is sampled. """
+    temperature = params.get("temperature")
+    if temperature is None or temperature > 1e-5:
+        return None
+
+    request = {k: v for k, v in params.items() if k not in EXCLUDED_KEYS and v is not None}
+    request.update(kind=kind, stream=bool(params.get("stream")), **extra)
+    data = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def renew_ids(responses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Gives a replayed response (or all the chunks of a replayed stream) a new
+    id, with the prefix of the cached one (e.g. `chatcmpl-`), and the current
+    creation time, so that clients never see the same id twice.
+    """
+    if responses:
+        prefix = responses[0]["id"].split("-", 1)[0]
+        response_id, created = f"{prefix}-{uuid.uuid4()}", int(time.time())
+        for response in responses:
+            response.update(id=response_id, created=created)
+    return responses
+
+
+class ResponseCache:
+    """
+    Caches the responses of deterministic (greedy) requests, so that
+    identical requests are answered without generating again.
+
+    Responses are kept in an in-memory LRU of at most `max_size` bytes, and
+    optionally in a second tier of files under `disk_path` of at most
+    `max_disk_size` bytes, which survives restarts. Entries expire after
+    `ttl` seconds (never if `None`).
+
+    Streaming requests cache the chunks they sent, which are replayed as the
+    stream of later identical requests.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = 3600,
+        disk_path: Optional[str] = None,
+        max_disk_size: int = 0,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.max_disk_size = max_disk_size
+
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.size = 0
+        self.disk_entries: "OrderedDict[str, int]" = OrderedDict()
+        self.disk_size = 0
+        self._lock = Lock()
+
+        self.num_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        if self.disk_path is not None:
+            os.makedirs(self.disk_path, exist_ok=True)
+            filenames = [f for f in os.listdir(self.disk_path) if f.endswith(".json")]
+            paths = sorted((os.path.join(self.disk_path, f) for f in filenames), key=os.path.getmtime)
+            for path in paths:
+                key, size = os.path.basename(path)[:-5], os.path.getsize(path)
+                self.disk_entries[key] = size
+                self.disk_size += size
+            logger.info(f"Loaded {len(self.disk_entries)} cached responses from {self.disk_path}")
+
+    def key(self, kind: str, model: str, params: Dict[str, Any]) -> Optional[str]:
+        """ Returns the key of a request, or `None` if its response is not deterministic. """
+        return request_key(kind, params, model=model)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < now:
+                self._pop(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.num_hits += 1
+                return entry[1]
+
+        entry = self._load(key, now)
+        with self._lock:
+            if entry is None:
+                self.num_misses += 1
+                return None
+            self.num_disk_hits += 1
+            self._put(key, *entry)
+        return entry[1]
+
+    def put(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            self._put(key, expires_at, value)
+        self._dump(key, expires_at, value)
+
+    def record(self, key: str, iterator: Iterator[Any], cancel_event=None) -> Iterator[Any]:
+        """ Passes a stream through, caching its chunks once it has been fully sent. """
+        chunks: List[str] = []
+        for chunk in iterator:
+            if isinstance(chunk, dict):  # an error
+                yield chunk
+                return
+            chunks.append(chunk if isinstance(chunk, EncodedChunk) else jsonify(chunk))
+            yield chunk
+
+        if cancel_event is None or not cancel_event.is_set():
+            self.put(key, "[" + ",".join(chunks) + "]")
+
+    def stats(self) -> Dict[str, Any]:
+        num_queries = self.num_hits + self.num_disk_hits + self.num_misses
+        return {
+            "num_entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "num_disk_entries": len(self.disk_entries),
+            "disk_size": self.disk_size,
+            "max_disk_size": self.max_disk_size,
+            "num_hits": self.num_hits,
+            "num_disk_hits": self.num_disk_hits,
+            "num_misses": self.num_misses,
+            "num_evictions": self.num_evictions,
+            "hit_rate": (self.num_hits + self.num_disk_hits) / num_queries if num_queries else 0.0,
+        }
+
+    def _put(self, key: str, expires_at: float, value: str) -> None:
+        if len(value) > self.max_size:
+            return
+        if key in self.entries:
+            self._pop(key)
+        self.entries[key] = (expires_at, value)
+        self.size += len(value)
+        while self.size > self.max_size:
+            self._pop(next(iter(self.entries)))
+            self.num_evictions += 1
+
+    def _pop(self, key: str) -> None:
+        _, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def _load(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        if self.disk_path is None or key not in self.disk_entries:
+            return None
+        path = os.path.join(self.disk_path, f"{key}.json")
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        if entry is None or entry["expires_at"] < now:
+            self._remove(key)
+            return None
+        os.utime(path)
+        with self._lock:
+            if key in self.disk_entries:
+                self.disk_entries.move_to_end(key)
+        return entry["expires_at"], entry["value"]
+
+    def _dump(self, key: str, expires_at: float, value: str) -> None:
+        if self.disk_path is None:
+            return
+        data = json.dumps({"expires_at": expires_at, "value": value}, ensure_ascii=False)
+        if len(data) > self.max_disk_size:
+            return
+
+        path = os.path.join(self.disk_path, f"{key}.json")
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self.disk_size += size - self.disk_entries.pop(key, 0)
+            self.disk_entries[key] = size
+            evicted = []
+            while self.disk_size > self.max_disk_size:
+                oldest, oldest_size = self.disk_entries.popitem(last=False)
+                self.disk_size -= oldest_size
+                evicted.append(oldest)
+        for oldest in evicted:
+            self._unlink(oldest)
+
+    def _remove(self, key: str) -> None:
+        with self._lock:
+            self.disk_size -= self.disk_entries.pop(key, 0)
+        self._unlink(key)
+
+    def _unlink(self, key: str) -> None:
+        try:
+            os.remove(os.path.join(self.disk_path, f"{key}.json"))
+        except OSError:
+            pass
+
+
+class SemanticCache:
+    """
+    Reuses the answers of previous chat requests whose last user message is
+    similar to the new one, which skips generation for FAQ-like traffic.
+
+    The last user message is embedded by the co-hosted embedding model and
+    searched by cosine similarity in an in-process index of at most
+    `max_entries` answers, which evicts the oldest ones first. An answer is
+    reused above the `threshold` similarity, and only if the rest of the
+    request (the system prompt, earlier turns, tools, ...) is identical.
+
+    Only single choice answers which ended normally are cached.
+    """
+
+    def __init__(
+        self,
+        embedding: "RAGEmbedding",
+        threshold: float = 0.95,
+        max_entries: int = 10000,
+        ttl: Optional[float] = 3600,
+    ) -> None:
+        self.embedding = embedding
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.vectors: Optional[np.ndarray] = None
+        self.namespaces: List[Optional[str]] = [None] * max_entries
+        self.expires_at = np.zeros(max_entries)
+        self.values: List[Optional[str]] = [None] * max_entries
+        self.num_added = 0
+        self._lock = Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.avg_similarity = 0.0
+
+    def key(self, model: str, params: Dict[str, Any]) -> Optional[Tuple[str, np.ndarray]]:
+        """ Returns the namespace and the embedding of a chat request, or `None` if it is not cacheable. """
+        messages = params.get("prompt_or_messages")
+        if (params.get("n") or 1) > 1 or not messages or messages[-1]["role"] != Role.USER.value:
+            return None
+        query = messages[-1].get("content")
+        if not isinstance(query, str) or not query.strip():
+            return None
+
+        request = {k: params.get(k) for k in SEMANTIC_KEYS}
+        request.update(model=model, messages=messages[:-1])
+        data = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+        namespace = hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+        vector = np.asarray(self.embedding.embed([query]).data[0].embedding, dtype=np.float32)
+        return namespace, vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def get(self, key: Tuple[str, np.ndarray]) -> Optional[ChatCompletion]:
+        namespace, vector = key
+        with self._lock:
+            slot, similarity = None, -1.0
+            if self.vectors is not None:
+                similarities = self.vectors @ vector
+                now = time.time()
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    if self.namespaces[i] == namespace and self.expires_at[i] >= now:
+                        slot, similarity = int(i), float(similarities[i])
+                        break
+
+            if slot is None:
+                self.num_misses += 1
+                return None
+            self.num_hits += 1
+            self.avg_similarity += (similarity - self.avg_similarity) / self.num_hits
+            value = self.values[slot]
+        return model_validate(ChatCompletion, renew_ids([json.loads(value)])[0])
+
+    def put(self, key: Tuple[str, np.ndarray], completion: ChatCompletion) -> None:
+        if len(completion.choices) != 1 or completion.choices[0].finish_reason != "stop":
+            return
+
+        namespace, vector = key
+        expires_at = time.time() + self.ttl if self.ttl is not None else float("inf")
+        with self._lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            slot = self.num_added % self.max_entries  # overwrites the oldest answer
+            self.vectors[slot] = vector
+            self.namespaces[slot] = namespace
+            self.expires_at[slot] = expires_at
+            self.values[slot] = jsonify(completion)
+            self.num_added += 1
+
+    def record(
+        self,
+        key: Tuple[str, np.ndarray],
+        iterator: Iterator[Any],
+        cancel_event=None,
+    ) -> Iterator[Any]:
+        """ Passes a stream through, caching its answer once it has been fully sent. """
+        contents, finish_reason, last = [], None, None
+        for chunk in iterator:
+            if isinstance(chunk, dict):  # an error
+                yield chunk
+                return
+            if isinstance(chunk, EncodedChunk):  # read from the chunk, without parsing its json
+                fields, content = chunk.fields, chunk.content
+            else:
+                choice = chunk.choices[0]
+                if choice.delta.function_call or choice.delta.tool_calls:
+                    fields = None
+                else:
+                    fields = dict(
+                        id=chunk.id,
+                        created=chunk.created,
+                        model=chunk.model,
+                        index=choice.index,
+                        finish_reason=choice.finish_reason,
+                    )
+                    content = choice.delta.content
+            if fields is None or fields["index"] != 0:
+                yield chunk
+                yield from iterator
+                return
+            contents.append(content or "")
+            finish_reason, last = finish_reason or fields.get("finish_reason"), fields
+            yield chunk
+
+        if last is not None and (cancel_event is None or not cancel_event.is_set()):
+            completion = {
+                "id": last["id"],
+                "object": "chat.completion",
+                "created": last["created"],
+                "model": last["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "".join(contents).strip()},
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+            self.put(key, model_validate(ChatCompletion, completion))
+
+    @staticmethod
+    def replay(completion: ChatCompletion) -> Iterator[ChatCompletionChunk]:
+        """ Streams a cached answer as the chunks of the role, the content and the end. """
+        deltas = [
+            (ChoiceDelta(role="assistant", content=""), None),
+            (ChoiceDelta(content=completion.choices[0].message.content), None),
+            (ChoiceDelta(), "stop"),
+        ]
+        for delta, finish_reason in deltas:
+            yield ChatCompletionChunk(
+                id=completion.id,
+                choices=[ChunkChoice(index=0, delta=delta, finish_reason=finish_reason, logprobs=None)],
+                created=completion.created,
+                model=completion.model,
+                object="chat.completion.chunk",
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        num_queries = self.num_hits + self.num_misses
+        return {
+            "num_entries": min(self.num_added, self.max_entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "hit_rate": self.num_hits / num_queries if num_queries else 0.0,
+            "avg_similarity": self.avg_similarity,
+        }
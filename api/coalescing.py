@@ -0,0 +1,170 @@
+import asyncio
+import inspect
+from threading import Event
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+)
+
+from loguru import logger
+from starlette.concurrency import iterate_in_threadpool
+
+from api.admission import AdmissionController, Ticket
+from api.cache import request_key
+
+
+class _Flight:
+    """ A generation shared by identical requests. """
+
+    def __init__(self, cancel_event: Optional[Event] = None) -> None:
+        self.cancel_event = cancel_event
+        self.task: Optional[asyncio.Task] = None
+        self.changed = asyncio.Event()
+
+        self.is_stream = False
+        self.items: List[Any] = []
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self.num_subscribers = 0
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class RequestCoalescer:
+    """
+    Single-flight coalescing of identical concurrent deterministic requests.
+
+    The first request with a given key starts the generation, and identical
+    requests arriving while it is in flight attach to it: they all receive
+    its result, or all the chunks of its stream (from the first one, however
+    late they attached). The generation is cancelled once every client of a
+    stream has gone.
+    """
+
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.flights: Dict[str, _Flight] = {}
+
+        self.num_requests = 0
+        self.num_coalesced = 0
+
+    def key(self, kind: str, params: Dict[str, Any]) -> Optional[str]:
+        """ Returns the key of a request, or `None` if it must not be coalesced. """
+        return request_key(kind, params) if self.enabled else None
+
+    async def admit(self, key: Optional[str], admission_controller: AdmissionController) -> Optional[Ticket]:
+        """
+        Acquires a generation slot for a request, unless it will attach to an
+        identical request in flight: it shares the slot of that generation,
+        so it is never queued or rejected.
+        """
+        if key is not None and key in self.flights:
+            return None
+        ticket = await admission_controller.acquire()
+        if key is not None and key in self.flights:  # an identical request started while this one waited
+            ticket.release()
+            return None
+        return ticket
+
+    async def run(
+        self,
+        key: Optional[str],
+        create: Callable[[], Any],
+        cancel_event: Optional[Event] = None,
+    ) -> Any:
+        """
+        Runs `create`, or attaches to the in-flight run with the same `key`.
+
+        `create` returns (or is a coroutine returning) a response, or an
+        iterator over the chunks of a stream. Coalesced streams are returned
+        as async iterators, and `cancel_event` is set once all their clients
+        have gone.
+        """
+        self.num_requests += 1
+        if key is None:
+            result = create()
+            return await result if inspect.isawaitable(result) else result
+
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = _Flight(cancel_event)
+            flight.task = asyncio.create_task(self._fly(key, flight, create))
+        else:
+            self.num_coalesced += 1
+            logger.debug(f"Coalesced request {key[:8]} with {flight.num_subscribers} others")
+
+        flight.num_subscribers += 1
+        try:
+            while not (flight.done or flight.items):
+                await flight.changed.wait()
+        except BaseException:
+            self._unsubscribe(flight)
+            raise
+
+        if flight.error is not None and not flight.items:
+            self._unsubscribe(flight)
+            raise flight.error
+        if not flight.is_stream:
+            self._unsubscribe(flight)
+            return flight.result
+        return self._follow(flight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "num_in_flight": len(self.flights),
+            "num_requests": self.num_requests,
+            "num_coalesced": self.num_coalesced,
+        }
+
+    async def _fly(self, key: str, flight: _Flight, create: Callable[[], Any]) -> None:
+        try:
+            result = create()
+            if inspect.isawaitable(result):
+                result = await result
+
+            if isinstance(result, Iterator):
+                result = iterate_in_threadpool(result)
+            if isinstance(result, AsyncIterator):
+                flight.is_stream = True
+                async for item in result:
+                    flight.items.append(item)
+                    flight.notify()
+            else:
+                flight.result = result
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            self.flights.pop(key, None)
+            flight.notify()
+
+    async def _follow(self, flight: _Flight) -> AsyncIterator[Any]:
+        try:
+            i = 0
+            while True:
+                while i < len(flight.items):
+                    yield flight.items[i]
+                    i += 1
+                if flight.done:
+                    return
+                await flight.changed.wait()
+        finally:
+            self._unsubscribe(flight)
+
+    def _unsubscribe(self, flight: _Flight) -> None:
+        flight.num_subscribers -= 1
+        if flight.num_subscribers == 0 and not flight.done:
+            if flight.cancel_event is not None:
+                flight.cancel_event.set()
+            flight.task.cancel()
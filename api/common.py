@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import json
 import os
-from typing import Any, Dict, Type
+import uuid
+from typing import Any, Callable, Dict, Optional, Tuple, Type
 
 import pydantic
 from pydantic import BaseModel
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 PYDANTIC_V2 = pydantic.VERSION.startswith("2.")
 
 
@@ -30,6 +37,74 @@ def model_validate(data: Type["BaseModel"], obj: Any) -> "BaseModel":
         return data.parse_obj(obj)
 
 
+def _dumps_str(text: str) -> str:
+    """ Encodes a string like the json serializer of pydantic. """
+    if not PYDANTIC_V2:  # pydantic v1 uses the json module with its defaults
+        return json.dumps(text)
+    if orjson is not None:
+        return orjson.dumps(text).decode("utf-8")
+    return json.dumps(text, ensure_ascii=False)
+
+
+class EncodedChunk(str):
+    """
+    A stream chunk already rendered to json by a `ChunkEncoder`, sent as is.
+    It keeps its content and fields, so that chunks can be merged.
+    """
+
+    def __new__(
+        cls,
+        text: str,
+        encoder: "ChunkEncoder",
+        content: Optional[str],
+        fields: Dict[str, Any],
+    ) -> "EncodedChunk":
+        chunk = super().__new__(cls, text)
+        chunk.encoder, chunk.content, chunk.fields = encoder, content, fields
+        return chunk
+
+    def model(self) -> "BaseModel":
+        """ Rebuilds the pydantic object, for the consumers reading the fields of the chunk. """
+        return model_validate(self.encoder.chunk_type, json.loads(self))
+
+
+class ChunkEncoder:
+    """
+    Renders the chunks of a stream to the same json as `jsonify`, without
+    building their pydantic models. The chunk built for a set of fields
+    (id, created, model, index, ...) is rendered once with a placeholder
+    content and split around it, so every following chunk with the same
+    fields only costs the encoding of its content.
+
+    Args:
+        chunk_type: The pydantic model of the chunks.
+        build: Builds the chunk for a content (or `None`) and the other fields.
+    """
+
+    def __init__(self, chunk_type: Type["BaseModel"], build: Callable[..., "BaseModel"]) -> None:
+        self.chunk_type = chunk_type
+        self.build = build
+        self.templates: Dict[Tuple[Any, ...], Tuple[str, str]] = {}
+        self._placeholder = f"@@{uuid.uuid4().hex}@@"
+
+    def encode(self, content: Optional[str], **fields: Any) -> EncodedChunk:
+        key = (content is None, *fields.items())
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = self._render(content is None, fields)
+
+        prefix, suffix = template
+        text = prefix if content is None else prefix + _dumps_str(content) + suffix
+        return EncodedChunk(text, self, content, fields)
+
+    def _render(self, empty: bool, fields: Dict[str, Any]) -> Tuple[str, str]:
+        if empty:
+            return jsonify(self.build(None, **fields)), ""
+        text = jsonify(self.build(self._placeholder, **fields))
+        prefix, _, suffix = text.partition(_dumps_str(self._placeholder))
+        return prefix, suffix
+
+
 def disable_warnings(model: Type["BaseModel"]):
     # Disable warning for model_name settings
     if PYDANTIC_V2:
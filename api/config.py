@@ -32,6 +32,12 @@ STORAGE_LOCAL_PATH = get_env(
 )
 os.makedirs(STORAGE_LOCAL_PATH, exist_ok=True)
 
+BATCH_LOCAL_PATH = get_env(
+    "BATCH_LOCAL_PATH",
+    os.path.join(Path(__file__).parents[1], "data", "batches")
+)
+os.makedirs(BATCH_LOCAL_PATH, exist_ok=True)
+
 
 class BaseSettings(BaseModel):
     """ Settings class. """
@@ -55,6 +61,11 @@ class BaseSettings(BaseModel):
         default=list(TASKS),
         description="Choices are ['llm', 'rag'].",
     )
+    ingestion_workers: Optional[int] = Field(
+        default=int(get_env("INGESTION_WORKERS", 2)),
+        ge=1,
+        description="Number of threads parsing and splitting uploaded files.",
+    )
     # device related
     device_map: Optional[Union[str, Dict]] = Field(
         default=get_env("DEVICE_MAP", "auto"),
@@ -134,6 +145,160 @@ class LLMSettings(BaseModel):
         description="Whether to interrupt requests when a new request is received.",
     )
 
+    # streaming related
+    stream_flush_interval: Optional[float] = Field(
+        default=float(get_env("STREAM_FLUSH_INTERVAL", 0)),
+        ge=0,
+        description="Milliseconds the content deltas of a stream are merged before being sent, 0 means no window.",
+    )
+    stream_flush_tokens: Optional[int] = Field(
+        default=int(get_env("STREAM_FLUSH_TOKENS", 0)),
+        ge=0,
+        description="Max number of content deltas merged into one streamed chunk, 0 means no limit.",
+    )
+
+    # admission related
+    max_concurrent_requests: Optional[int] = Field(
+        default=int(get_env("MAX_CONCURRENT_REQUESTS", -1)),
+        ge=-1,
+        description="Max number of concurrent generations, -1 means unlimited.",
+    )
+    max_queue_size: Optional[int] = Field(
+        default=int(get_env("MAX_QUEUE_SIZE", 64)),
+        ge=0,
+        description="Max number of requests waiting for a generation slot.",
+    )
+    queue_timeout: Optional[float] = Field(
+        default=float(get_env("QUEUE_TIMEOUT", 30)),
+        gt=0,
+        description="Seconds a request may wait for a generation slot before being rejected.",
+    )
+    llm_workers: Optional[int] = Field(
+        default=int(get_env("LLM_WORKERS", -1)),
+        ge=-1,
+        description="Number of threads running generations, -1 means `max_num_seqs`.",
+    )
+
+    enable_request_coalescing: Optional[bool] = Field(
+        default=get_bool_env("ENABLE_REQUEST_COALESCING"),
+        description="Whether identical concurrent greedy requests share one generation.",
+    )
+
+    # batching related
+    continuous_batching: Optional[bool] = Field(
+        default=get_bool_env("CONTINUOUS_BATCHING"),
+        description="Whether to batch concurrent requests at every decoding step for the default engine.",
+    )
+    max_num_batched_tokens: Optional[int] = Field(
+        default=int(get_env("MAX_NUM_BATCHED_TOKENS", -1)),
+        ge=-1,
+        description="Max num batched tokens per step."
+    )
+    max_num_seqs: Optional[int] = Field(
+        default=int(get_env("MAX_NUM_SEQS", 256)),
+        ge=1,
+        description="Max num seqs per step."
+    )
+    prefill_chunk_size: Optional[int] = Field(
+        default=int(get_env("PREFILL_CHUNK_SIZE", -1)),
+        ge=-1,
+        description="Prefill long prompts in chunks of this many tokens, interleaved with decoding, for the default engine.",
+    )
+    enable_prefix_caching: Optional[bool] = Field(
+        default=get_bool_env("ENABLE_PREFIX_CACHING"),
+        description="Whether to reuse the kv cache of shared prompt prefixes.",
+    )
+    prefix_cache_memory: Optional[float] = Field(
+        default=float(get_env("PREFIX_CACHE_MEMORY", 4)),
+        ge=0,
+        description="Memory budget (GiB) of the prefix kv cache for the default engine.",
+    )
+
+    # speculative decoding related
+    draft_model_path: Optional[str] = Field(
+        default=get_env("DRAFT_MODEL_PATH", None),
+        description="The path to a small draft model for speculative decoding.",
+    )
+    num_speculative_tokens: Optional[int] = Field(
+        default=int(get_env("NUM_SPECULATIVE_TOKENS", 5)),
+        ge=1,
+        description="Number of tokens proposed at every speculative decoding step.",
+    )
+    prompt_lookup_decoding: Optional[bool] = Field(
+        default=get_bool_env("PROMPT_LOOKUP_DECODING"),
+        description="Whether to speculate by looking up n-grams in the prompt, which needs no draft model.",
+    )
+    prompt_lookup_max_ngram: Optional[int] = Field(
+        default=int(get_env("PROMPT_LOOKUP_MAX_NGRAM", 3)),
+        ge=1,
+        description="Max size of the n-gram matched against the prompt for prompt lookup decoding.",
+    )
+
+    # compilation related
+    enable_static_cache: Optional[bool] = Field(
+        default=get_bool_env("ENABLE_STATIC_CACHE"),
+        description="Whether to decode with a static kv cache of `context_length` tokens compiled by torch.compile.",
+    )
+
+    # memory related
+    memory_high_watermark: Optional[float] = Field(
+        default=float(get_env("MEMORY_HIGH_WATERMARK", 0.9)),
+        gt=0,
+        le=1,
+        description="Fraction of the gpu memory left after the weights reserved by the torch allocator above which cached blocks are released.",
+    )
+    memory_low_watermark: Optional[float] = Field(
+        default=float(get_env("MEMORY_LOW_WATERMARK", 0.7)),
+        gt=0,
+        le=1,
+        description="Fraction of the gpu memory left after the weights in use above which releasing the cache also collects garbage.",
+    )
+    reserve_memory: Optional[float] = Field(
+        default=float(get_env("RESERVE_MEMORY", 0)),
+        ge=0,
+        description="Gpu memory (GiB) reserved up front for the kv caches and activations of the default engine.",
+    )
+
+    # response cache related
+    enable_response_cache: Optional[bool] = Field(
+        default=get_bool_env("ENABLE_RESPONSE_CACHE"),
+        description="Whether to cache the responses of greedy (temperature 0) requests for the default engine.",
+    )
+    response_cache_memory: Optional[float] = Field(
+        default=float(get_env("RESPONSE_CACHE_MEMORY", 256)),
+        ge=0,
+        description="Memory budget (MiB) of the in-memory response cache.",
+    )
+    response_cache_ttl: Optional[float] = Field(
+        default=float(get_env("RESPONSE_CACHE_TTL", 3600)),
+        ge=-1,
+        description="Seconds a cached response stays valid, -1 means forever.",
+    )
+    response_cache_path: Optional[str] = Field(
+        default=get_env("RESPONSE_CACHE_PATH", None),
+        description="Directory of the on-disk tier of the response cache, disabled if not set.",
+    )
+    response_cache_disk_size: Optional[float] = Field(
+        default=float(get_env("RESPONSE_CACHE_DISK_SIZE", 4096)),
+        ge=0,
+        description="Disk budget (MiB) of the on-disk tier of the response cache.",
+    )
+    enable_semantic_cache: Optional[bool] = Field(
+        default=get_bool_env("ENABLE_SEMANTIC_CACHE"),
+        description="Whether to reuse the answers of similar chat requests, needs the embedding model of `TASKS=llm,rag`.",
+    )
+    semantic_cache_threshold: Optional[float] = Field(
+        default=float(get_env("SEMANTIC_CACHE_THRESHOLD", 0.95)),
+        gt=0,
+        le=1,
+        description="Min cosine similarity of the last user messages for a cached answer to be reused.",
+    )
+    semantic_cache_size: Optional[int] = Field(
+        default=int(get_env("SEMANTIC_CACHE_SIZE", 10000)),
+        ge=1,
+        description="Max number of answers in the semantic cache.",
+    )
+
 
 class RAGSettings(BaseModel):
     # embedding related
@@ -157,6 +322,16 @@ class RAGSettings(BaseModel):
         default=get_env("RERANK_DEVICE", "cuda:0"),
         description="Device to load the model."
     )
+    embedding_workers: Optional[int] = Field(
+        default=int(get_env("EMBEDDING_WORKERS", 4)),
+        ge=1,
+        description="Number of threads computing embeddings.",
+    )
+    rerank_workers: Optional[int] = Field(
+        default=int(get_env("RERANK_WORKERS", 4)),
+        ge=1,
+        description="Number of threads reranking documents.",
+    )
 
 
 class VLLMSetting(BaseModel):
@@ -177,16 +352,6 @@ class VLLMSetting(BaseModel):
         default=float(get_env("GPU_MEMORY_UTILIZATION", 0.9)),
         description="GPU memory utilization for vllm server."
     )
-    max_num_batched_tokens: Optional[int] = Field(
-        default=int(get_env("MAX_NUM_BATCHED_TOKENS", -1)),
-        ge=-1,
-        description="Max num batched tokens for vllm server."
-    )
-    max_num_seqs: Optional[int] = Field(
-        default=int(get_env("MAX_NUM_SEQS", 256)),
-        ge=1,
-        description="Max num seqs for vllm server."
-    )
     quantization_method: Optional[str] = Field(
         default=get_env("QUANTIZATION_METHOD", None),
         description="Quantization method for vllm server."
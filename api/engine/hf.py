@@ -1,11 +1,19 @@
+import asyncio
+import json
 import traceback
 from abc import ABC
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Event
 from typing import (
+    AsyncIterator,
+    Callable,
     Optional,
+    Type,
     Union,
     Dict,
     Iterator,
     Any,
+    List,
     TYPE_CHECKING,
 )
 
@@ -31,7 +39,12 @@ from openai.types.completion_choice import CompletionChoice, Logprobs
 from openai.types.completion_usage import CompletionUsage
 from transformers import PreTrainedModel, PreTrainedTokenizer
 
-from api.common import model_validate
+from api.cache import renew_ids
+from api.common import ChunkEncoder, jsonify, model_validate
+from api.engine.memory import MemoryManager
+from api.engine.scheduler import BatchScheduler
+from api.engine.speculative import SpeculativeDecoder
+from api.engine.static_cache import StaticCacheDecoder
 from api.protocol import ErrorCode
 from api.templates import get_template
 from api.templates.glm import generate_stream_chatglm, generate_stream_chatglm_v3
@@ -43,6 +56,8 @@ from api.utils import create_error_response
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, PreTrainedModel
 
+    from api.cache import ResponseCache, SemanticCache
+
 server_error_msg = (
     "**NETWORK ERROR DUE TO HIGH TRAFFIC. PLEASE REGENERATE OR REFRESH THIS PAGE.**"
 )
@@ -57,6 +72,20 @@ class HuggingFaceEngine(ABC):
         model_name: str,
         template_name: Optional[str] = None,
         max_model_length: Optional[int] = None,
+        continuous_batching: Optional[bool] = False,
+        max_num_seqs: Optional[int] = 256,
+        max_num_batched_tokens: Optional[int] = None,
+        prefix_cache_memory: Optional[int] = None,
+        prefill_chunk_size: Optional[int] = None,
+        draft_model: Optional["PreTrainedModel"] = None,
+        num_speculative_tokens: Optional[int] = 5,
+        prompt_lookup_max_ngram: Optional[int] = None,
+        memory_high_watermark: Optional[float] = 0.9,
+        memory_low_watermark: Optional[float] = 0.7,
+        reserve_memory: Optional[int] = 0,
+        static_cache: Optional[bool] = False,
+        response_cache: Optional["ResponseCache"] = None,
+        semantic_cache: Optional["SemanticCache"] = None,
     ) -> None:
         self.model = model
         self.tokenizer = tokenizer
@@ -79,6 +108,58 @@ class HuggingFaceEngine(ABC):
         elif self.model.config.model_type == "minicpmv":
             self.generate_stream_func = generate_stream_minicpm_v
 
+        self.scheduler = None
+        if (
+            (continuous_batching or prefix_cache_memory or prefill_chunk_size)
+            and self.generate_stream_func is generate_stream
+        ):
+            self.scheduler = BatchScheduler(
+                self.model,
+                self.tokenizer,
+                self.max_model_length,
+                max_num_seqs=max_num_seqs if continuous_batching else 1,
+                max_num_batched_tokens=max_num_batched_tokens,
+                prefix_cache_memory=prefix_cache_memory,
+                prefill_chunk_size=prefill_chunk_size,
+            )
+            logger.info(f"Using continuous batching with max_num_seqs={self.scheduler.max_num_seqs}")
+
+        # requests for several samples share their prefill through the scheduler
+        self.sampling_scheduler = self.scheduler
+        if self.sampling_scheduler is None and self.generate_stream_func is generate_stream:
+            self.sampling_scheduler = BatchScheduler(
+                self.model,
+                self.tokenizer,
+                self.max_model_length,
+                max_num_seqs=max_num_seqs,
+            )
+
+        self.speculative_decoder = None
+        if draft_model is not None or prompt_lookup_max_ngram:
+            if self.scheduler is not None or self.generate_stream_func is not generate_stream:
+                logger.warning("Speculative decoding is not supported for this model or with batching, ignored.")
+            else:
+                self.speculative_decoder = SpeculativeDecoder(
+                    draft_model,
+                    num_speculative_tokens,
+                    prompt_lookup_max_ngram=prompt_lookup_max_ngram or 3,
+                )
+                logger.info(f"Using speculative decoding with {num_speculative_tokens} draft tokens")
+
+        self.static_cache_decoder = None
+        if static_cache:
+            if self.scheduler is not None or self.generate_stream_func is not generate_stream:
+                logger.warning("Static kv cache is not supported for this model or with batching, ignored.")
+            else:
+                self.static_cache_decoder = StaticCacheDecoder(self.model, self.max_model_length)
+                self.static_cache_decoder.warmup()
+                logger.info(f"Using static kv cache of {self.max_model_length} tokens with torch.compile")
+
+        self.memory_manager = MemoryManager(memory_high_watermark, memory_low_watermark, reserve_memory)
+
+        self.response_cache = response_cache
+        self.semantic_cache = semantic_cache
+
         logger.info(f"Using {self.model_name} Model for Chat!")
         logger.info(f"Using {self.template} for Chat!")
 
@@ -93,25 +174,33 @@ class HuggingFaceEngine(ABC):
             Iterator: A dictionary containing the generated text and error code.
         """
         prompt_or_messages = params.get("prompt_or_messages")
-        if isinstance(prompt_or_messages, str):
-            inputs = self.tokenizer(prompt_or_messages).input_ids
+        if self._is_prompt_batch(prompt_or_messages):
+            inputs = [self._get_inputs(prompt, params) for prompt in prompt_or_messages]
         else:
-            if self.model.config.model_type == "minicpmv":
-                inputs = prompt_or_messages
-            else:
-                inputs = self.template.convert_messages_to_ids(
-                    prompt_or_messages,
-                    tools=params.get("tools"),
-                    max_tokens=params.get("max_tokens", 256),
-                )
+            inputs = self._get_inputs(prompt_or_messages, params)
         params.update(dict(inputs=inputs))
 
+        generate_stream_func = self.generate_stream_func
+        if self._is_prompt_batch(prompt_or_messages):
+            generate_stream_func = self._generate_batch_stream
+        elif self.scheduler is not None and isinstance(inputs, list):
+            generate_stream_func = self.scheduler.generate_stream
+        elif self.sampling_scheduler is not None and isinstance(inputs, list) and (
+            (params.get("n") or 1) > 1 or params.get("batched")  # offline batch jobs are decoded together
+        ):
+            generate_stream_func = self.sampling_scheduler.generate_stream
+        elif self.speculative_decoder is not None and isinstance(inputs, list):
+            generate_stream_func = self.speculative_decoder.generate_stream
+        elif self.static_cache_decoder is not None and isinstance(inputs, list):
+            generate_stream_func = self.static_cache_decoder.generate_stream
+
         try:
-            for output in self.generate_stream_func(self.model, self.tokenizer, params):
+            for output in generate_stream_func(self.model, self.tokenizer, params):
                 output["error_code"] = 0
                 yield output
 
         except torch.cuda.OutOfMemoryError as e:
+            self.memory_manager.trim()
             yield {
                 "text": f"{server_error_msg}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
@@ -124,6 +213,53 @@ class HuggingFaceEngine(ABC):
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
 
+        finally:
+            self.memory_manager.maybe_trim()
+
+    def _get_inputs(self, prompt_or_messages: Any, params: Dict[str, Any]) -> Any:
+        """ Returns the model inputs of a prompt, its token ids, or chat messages. """
+        if isinstance(prompt_or_messages, str):
+            return self.tokenizer(prompt_or_messages).input_ids
+        if prompt_or_messages and isinstance(prompt_or_messages[0], int):
+            return list(prompt_or_messages)
+        if self.model.config.model_type == "minicpmv":
+            return prompt_or_messages
+        return self.template.convert_messages_to_ids(
+            prompt_or_messages,
+            tools=params.get("tools"),
+            max_tokens=params.get("max_tokens", 256),
+        )
+
+    @staticmethod
+    def _is_prompt_batch(prompt_or_messages: Any) -> bool:
+        """ Whether a completion request has several prompts, as strings or token ids. """
+        return (
+            isinstance(prompt_or_messages, list)
+            and len(prompt_or_messages) > 0
+            and isinstance(prompt_or_messages[0], (str, list))
+        )
+
+    def _generate_batch_stream(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[dict]:
+        """
+        Generates the completions of several prompts, batched by the scheduler
+        when there is one. The sample `j` of the prompt `i` has the `index` `i * n + j`.
+        """
+        prompts = params.get("inputs")
+        if self.sampling_scheduler is not None:
+            yield from self.sampling_scheduler.generate_batch_stream(model, tokenizer, params, prompts)
+            return
+
+        n = max(int(params.get("n") or 1), 1)
+        for i, inputs in enumerate(prompts):
+            for output in self.generate_stream_func(model, tokenizer, {**params, "inputs": inputs}):
+                output["index"] = i * n + output.get("index", 0)
+                yield output
+
     def _create_completion_stream(self, params: Dict[str, Any]) -> Iterator[Completion]:
         """
         Generates a stream of completions based on the given parameters.
@@ -134,29 +270,55 @@ class HuggingFaceEngine(ABC):
         Yields:
             Iterator: A stream of completion objects.
         """
+        encoder = ChunkEncoder(Completion, self._build_completion_chunk)
         for output in self._generate(params):
             if output["error_code"] != 0:
                 yield output
                 return
 
-            logprobs = None
-            if params.get("logprobs") and output["logprobs"]:
-                logprobs = model_validate(Logprobs, output["logprobs"])
+            if not (params.get("logprobs") and output["logprobs"]):
+                yield encoder.encode(
+                    output["delta"],
+                    id=output["id"],
+                    created=output["created"],
+                    model=output["model"],
+                    index=output.get("index", 0),
+                )
+                continue
 
-            choice = CompletionChoice(
-                index=0,
-                text=output["delta"],
-                finish_reason="stop",
-                logprobs=logprobs,
-            )
-            yield Completion(
+            logprobs = model_validate(Logprobs, output["logprobs"])
+            yield self._build_completion_chunk(
+                output["delta"],
                 id=output["id"],
-                choices=[choice],
                 created=output["created"],
                 model=output["model"],
-                object="text_completion",
+                index=output.get("index", 0),
+                logprobs=logprobs,
             )
 
+    @staticmethod
+    def _build_completion_chunk(
+        text: str,
+        id: str,
+        created: int,
+        model: str,
+        index: int,
+        logprobs: Optional[Logprobs] = None,
+    ) -> Completion:
+        choice = CompletionChoice(
+            index=index,
+            text=text,
+            finish_reason="stop",
+            logprobs=logprobs,
+        )
+        return Completion(
+            id=id,
+            choices=[choice],
+            created=created,
+            model=model,
+            object="text_completion",
+        )
+
     def _create_completion(self, params: Dict[str, Any]) -> Union[Completion, JSONResponse]:
         """
         Creates a completion based on the given parameters.
@@ -167,33 +329,76 @@ class HuggingFaceEngine(ABC):
         Returns:
             Completion: The generated completion object.
         """
-        last_output = None
-        for output in self._generate(params):
-            last_output = output
-
-        if last_output["error_code"] != 0:
-            return create_error_response(last_output["error_code"], last_output["text"])
+        n = params.get("n") or 1
+        best_of = max(params.get("best_of") or 1, n)
+        params["n"] = best_of
+
+        outputs = self._collect_outputs(params)
+        if isinstance(outputs, JSONResponse):
+            return outputs
+
+        usage = self._sum_usage(outputs, best_of)
+        if best_of > n:
+            # keep the candidates of every prompt with the highest log probability per token
+            candidates = {}
+            for output in outputs:
+                candidates.setdefault(output.get("index", 0) // best_of, []).append(output)
+            outputs = [
+                output
+                for i in sorted(candidates)
+                for output in sorted(
+                    candidates[i],
+                    key=lambda x: x.get("cumulative_logprob", 0.0) / max(x["usage"]["completion_tokens"], 1),
+                    reverse=True,
+                )[:n]
+            ]
+
+        choices = []
+        for index, output in enumerate(outputs):
+            logprobs = None
+            if params.get("logprobs") and output["logprobs"]:
+                logprobs = model_validate(Logprobs, output["logprobs"])
 
-        logprobs = None
-        if params.get("logprobs") and last_output["logprobs"]:
-            logprobs = model_validate(Logprobs, last_output["logprobs"])
+            choices.append(
+                CompletionChoice(
+                    index=index,
+                    text=output["text"],
+                    finish_reason="stop",
+                    logprobs=logprobs,
+                )
+            )
 
-        choice = CompletionChoice(
-            index=0,
-            text=last_output["text"],
-            finish_reason="stop",
-            logprobs=logprobs,
-        )
-        usage = model_validate(CompletionUsage, last_output["usage"])
         return Completion(
-            id=last_output["id"],
-            choices=[choice],
-            created=last_output["created"],
-            model=last_output["model"],
+            id=outputs[0]["id"],
+            choices=choices,
+            created=outputs[0]["created"],
+            model=outputs[0]["model"],
             object="text_completion",
             usage=usage,
         )
 
+    def _collect_outputs(self, params: Dict[str, Any]) -> Union[List[Dict[str, Any]], JSONResponse]:
+        """ Runs a generation to the end and returns the last output of every sample by index. """
+        last_outputs = {}
+        for output in self._generate(params):
+            if output["error_code"] != 0:
+                return create_error_response(output["error_code"], output["text"])
+            last_outputs[output.get("index", 0)] = output
+        return [last_outputs[i] for i in sorted(last_outputs)]
+
+    @staticmethod
+    def _sum_usage(outputs: List[Dict[str, Any]], n: int = 1) -> CompletionUsage:
+        """ Every prompt is processed once for its `n` samples, while every sample adds its completion tokens. """
+        prompt_tokens = sum(
+            output["usage"]["prompt_tokens"] for output in outputs if output.get("index", 0) % n == 0
+        )
+        completion_tokens = sum(output["usage"]["completion_tokens"] for output in outputs)
+        return CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+
     def _create_chat_completion_stream(self, params: Dict[str, Any]) -> Iterator[ChatCompletionChunk]:
         """
         Creates a chat completion stream.
@@ -204,27 +409,21 @@ class HuggingFaceEngine(ABC):
         Yields:
             Dict[str, Any]: The output of the chat completion stream.
         """
+        # the plain chunks are rendered from templates, only those carrying a function call are built
+        encoder = ChunkEncoder(ChatCompletionChunk, self._build_chat_chunk)
         _id, _created, _model = None, None, None
-        has_function_call = False
-        for i, output in enumerate(self._generate(params)):
+        indexes, function_call_indexes = [], set()
+        for output in self._generate(params):
             if output["error_code"] != 0:
                 yield output
                 return
 
             _id, _created, _model = output["id"], output["created"], output["model"]
-            if i == 0:
-                choice = ChunkChoice(
-                    index=0,
-                    delta=ChoiceDelta(role="assistant", content=""),
-                    finish_reason=None,
-                    logprobs=None,
-                )
-                yield ChatCompletionChunk(
-                    id=f"chat{_id}",
-                    choices=[choice],
-                    created=_created,
-                    model=_model,
-                    object="chat.completion.chunk",
+            index = output.get("index", 0)
+            if index not in indexes:
+                indexes.append(index)
+                yield encoder.encode(
+                    "", id=f"chat{_id}", created=_created, model=_model, index=index, role="assistant",
                 )
 
             finish_reason = output["finish_reason"]
@@ -242,14 +441,14 @@ class HuggingFaceEngine(ABC):
                     logger.warning("Failed to parse tool call")
 
             if isinstance(function_call, dict) and "arguments" in function_call:
-                has_function_call = True
+                function_call_indexes.add(index)
                 function_call = ChoiceDeltaFunctionCall(**function_call)
                 delta = ChoiceDelta(
                     content=output["delta"],
                     function_call=function_call
                 )
             elif isinstance(function_call, dict) and "function" in function_call:
-                has_function_call = True
+                function_call_indexes.add(index)
                 finish_reason = "tool_calls"
                 function_call["index"] = 0
                 tool_calls = [model_validate(ChoiceDeltaToolCall, function_call)]
@@ -258,10 +457,18 @@ class HuggingFaceEngine(ABC):
                     tool_calls=tool_calls,
                 )
             else:
-                delta = ChoiceDelta(content=output["delta"])
+                yield encoder.encode(
+                    output["delta"],
+                    id=f"chat{_id}",
+                    created=_created,
+                    model=_model,
+                    index=index,
+                    finish_reason=finish_reason,
+                )
+                continue
 
             choice = ChunkChoice(
-                index=0,
+                index=index,
                 delta=delta,
                 finish_reason=finish_reason,
                 logprobs=None,
@@ -274,21 +481,37 @@ class HuggingFaceEngine(ABC):
                 object="chat.completion.chunk",
             )
 
-        if not has_function_call:
-            choice = ChunkChoice(
-                index=0,
-                delta=ChoiceDelta(),
-                finish_reason="stop",
-                logprobs=None,
-            )
-            yield ChatCompletionChunk(
-                id=f"chat{_id}",
-                choices=[choice],
-                created=_created,
-                model=_model,
-                object="chat.completion.chunk",
+        for index in indexes:
+            if index in function_call_indexes:
+                continue
+            yield encoder.encode(
+                None, id=f"chat{_id}", created=_created, model=_model, index=index, finish_reason="stop",
             )
 
+    @staticmethod
+    def _build_chat_chunk(
+        content: Optional[str],
+        id: str,
+        created: int,
+        model: str,
+        index: int,
+        role: Optional[str] = None,
+        finish_reason: Optional[str] = None,
+    ) -> ChatCompletionChunk:
+        choice = ChunkChoice(
+            index=index,
+            delta=ChoiceDelta(role=role, content=content),
+            finish_reason=finish_reason,
+            logprobs=None,
+        )
+        return ChatCompletionChunk(
+            id=id,
+            choices=[choice],
+            created=created,
+            model=model,
+            object="chat.completion.chunk",
+        )
+
     def _create_chat_completion(self, params: Dict[str, Any]) -> Union[ChatCompletion, JSONResponse]:
         """
         Creates a chat completion based on the given parameters.
@@ -299,60 +522,61 @@ class HuggingFaceEngine(ABC):
         Returns:
             ChatCompletion: The generated chat completion.
         """
-        last_output = None
-        for output in self._generate(params):
-            last_output = output
+        outputs = self._collect_outputs(params)
+        if isinstance(outputs, JSONResponse):
+            return outputs
+
+        choices = []
+        for index, output in enumerate(outputs):
+            function_call, finish_reason = None, "stop"
+            if params.get("functions") or params.get("tools"):
+                try:
+                    res, function_call = self.template.parse_assistant_response(
+                        output["text"], params.get("tools") or params.get("functions"),
+                    )
+                    output["text"] = res
+                except Exception as e:
+                    traceback.print_exc()
+                    logger.warning("Failed to parse tool call")
 
-        if last_output["error_code"] != 0:
-            return create_error_response(last_output["error_code"], last_output["text"])
+            if isinstance(function_call, dict) and "arguments" in function_call:
+                finish_reason = "function_call"
+                function_call = FunctionCall(**function_call)
+                message = ChatCompletionMessage(
+                    role="assistant",
+                    content=output["text"],
+                    function_call=function_call,
+                )
+            elif isinstance(function_call, dict) and "function" in function_call:
+                finish_reason = "tool_calls"
+                tool_calls = [model_validate(ChatCompletionMessageToolCall, function_call)]
+                message = ChatCompletionMessage(
+                    role="assistant",
+                    content=output["text"],
+                    tool_calls=tool_calls,
+                )
+            else:
+                message = ChatCompletionMessage(
+                    role="assistant",
+                    content=output["text"].strip(),
+                )
 
-        function_call, finish_reason = None, "stop"
-        if params.get("functions") or params.get("tools"):
-            try:
-                res, function_call = self.template.parse_assistant_response(
-                    last_output["text"], params.get("tools") or params.get("functions"),
+            choices.append(
+                Choice(
+                    index=index,
+                    message=message,
+                    finish_reason=finish_reason,
+                    logprobs=None,
                 )
-                last_output["text"] = res
-            except Exception as e:
-                traceback.print_exc()
-                logger.warning("Failed to parse tool call")
-
-        if isinstance(function_call, dict) and "arguments" in function_call:
-            finish_reason = "function_call"
-            function_call = FunctionCall(**function_call)
-            message = ChatCompletionMessage(
-                role="assistant",
-                content=last_output["text"],
-                function_call=function_call,
-            )
-        elif isinstance(function_call, dict) and "function" in function_call:
-            finish_reason = "tool_calls"
-            tool_calls = [model_validate(ChatCompletionMessageToolCall, function_call)]
-            message = ChatCompletionMessage(
-                role="assistant",
-                content=last_output["text"],
-                tool_calls=tool_calls,
-            )
-        else:
-            message = ChatCompletionMessage(
-                role="assistant",
-                content=last_output["text"].strip(),
             )
 
-        choice = Choice(
-            index=0,
-            message=message,
-            finish_reason=finish_reason,
-            logprobs=None,
-        )
-        usage = model_validate(CompletionUsage, last_output["usage"])
         return ChatCompletion(
-            id=f"chat{last_output['id']}",
-            choices=[choice],
-            created=last_output["created"],
-            model=last_output["model"],
+            id=f"chat{outputs[0]['id']}",
+            choices=choices,
+            created=outputs[0]["created"],
+            model=outputs[0]["model"],
             object="chat.completion",
-            usage=usage,
+            usage=self._sum_usage(outputs, params.get("n") or 1),
         )
 
     def create_completion(
@@ -362,10 +586,13 @@ class HuggingFaceEngine(ABC):
     ) -> Union[Iterator[Completion], Completion]:
         params = params or {}
         params.update(kwargs)
-        return (
-            self._create_completion_stream(params)
-            if params.get("stream", False)
-            else self._create_completion(params)
+        return self._create_or_replay(
+            "completion",
+            params,
+            self._create_completion_stream,
+            self._create_completion,
+            Completion,
+            Completion,
         )
 
     def create_chat_completion(
@@ -375,8 +602,177 @@ class HuggingFaceEngine(ABC):
     ) -> Union[Iterator[ChatCompletionChunk], ChatCompletion]:
         params = params or {}
         params.update(kwargs)
-        return (
-            self._create_chat_completion_stream(params)
-            if params.get("stream", False)
-            else self._create_chat_completion(params)
+        key = self.semantic_cache.key(self.model_name, params) if self.semantic_cache is not None else None
+        if key is not None:
+            cached = self.semantic_cache.get(key)
+            if cached is not None:
+                return self.semantic_cache.replay(cached) if params.get("stream", False) else cached
+
+        response = self._create_or_replay(
+            "chat.completion",
+            params,
+            self._create_chat_completion_stream,
+            self._create_chat_completion,
+            ChatCompletionChunk,
+            ChatCompletion,
         )
+        if key is None:
+            return response
+        if params.get("stream", False):
+            return self.semantic_cache.record(key, response, params.get("cancel_event"))
+        if isinstance(response, ChatCompletion):
+            self.semantic_cache.put(key, response)
+        return response
+
+    def _create_or_replay(
+        self,
+        kind: str,
+        params: Dict[str, Any],
+        create_stream: Callable[[Dict[str, Any]], Iterator[Any]],
+        create: Callable[[Dict[str, Any]], Any],
+        chunk_type: Type[Any],
+        completion_type: Type[Any],
+    ) -> Any:
+        """ Answers deterministic requests from the response cache, caching the new responses. """
+        stream = params.get("stream", False)
+        key = None
+        if self.response_cache is not None:
+            key = self.response_cache.key(kind, self.model_name, params)
+        if key is None:
+            return create_stream(params) if stream else create(params)
+
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            if stream:
+                return iter([model_validate(chunk_type, chunk) for chunk in renew_ids(json.loads(cached))])
+            return model_validate(completion_type, renew_ids([json.loads(cached)])[0])
+
+        if stream:
+            return self.response_cache.record(key, create_stream(params), params.get("cancel_event"))
+        response = create(params)
+        if isinstance(response, completion_type):
+            self.response_cache.put(key, jsonify(response))
+        return response
+
+
+class AsyncHuggingFaceEngine(HuggingFaceEngine):
+    """
+    HuggingFace engine with asyncio entry points, so that the routes are
+    pure async like the vLLM engine.
+
+    Generations run on the worker threads of the engine (`executor`, or
+    `max_workers` threads of its own, so not limited by the threadpool of
+    anyio), which push every chunk of a stream to an asyncio queue with
+    `loop.call_soon_threadsafe`, instead of a threadpool round trip per chunk.
+    """
+
+    def __init__(
+        self,
+        *args: Any,
+        max_workers: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=max_workers or kwargs.get("max_num_seqs") or 256,
+            thread_name_prefix="hf-engine",
+        )
+
+    async def acreate_completion(
+        self,
+        params: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> Union[AsyncIterator[Completion], Completion, JSONResponse]:
+        return await self._arun(self.create_completion, params, kwargs)
+
+    async def acreate_chat_completion(
+        self,
+        params: Optional[Dict[str, Any]] = None,
+        **kwargs: Any,
+    ) -> Union[AsyncIterator[ChatCompletionChunk], ChatCompletion, JSONResponse]:
+        return await self._arun(self.create_chat_completion, params, kwargs)
+
+    async def _arun(
+        self,
+        create: Callable[[Dict[str, Any]], Any],
+        params: Optional[Dict[str, Any]],
+        kwargs: Dict[str, Any],
+    ) -> Any:
+        params = params or {}
+        params.update(kwargs)
+        loop = asyncio.get_running_loop()
+        cancel_event = params.get("cancel_event")
+        if not params.get("stream", False):
+            try:
+                return await loop.run_in_executor(self.executor, create, params)
+            except asyncio.CancelledError:
+                # the request has gone (e.g. its client disconnected), stop the generation
+                if cancel_event is not None:
+                    cancel_event.set()
+                raise
+
+        queue: asyncio.Queue = asyncio.Queue()
+        stop = Event()
+        self.executor.submit(self._drain, create, params, loop, queue, stop)
+
+        # errors raised before the first chunk are raised to the route, like a non streaming request
+        try:
+            first, error = await queue.get()
+        except asyncio.CancelledError:
+            stop.set()
+            if cancel_event is not None:
+                cancel_event.set()
+            raise
+        if error is not None:
+            raise error
+        return self._aiterate(first, queue, stop, cancel_event)
+
+    @staticmethod
+    def _drain(
+        create: Callable[[Dict[str, Any]], Any],
+        params: Dict[str, Any],
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        stop: Event,
+    ) -> None:
+        """ Runs a stream on a worker thread, pushing `(chunk, error)` pairs and a final `(None, None)`. """
+        def push(item: Any, error: Optional[BaseException] = None) -> None:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+            except RuntimeError:  # the event loop is closed
+                stop.set()
+
+        iterator = None
+        try:
+            iterator = create(params)
+            for chunk in iterator:
+                push(chunk)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            push(None, e)
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            push(None)
+
+    @staticmethod
+    async def _aiterate(
+        first: Any,
+        queue: asyncio.Queue,
+        stop: Event,
+        cancel_event: Optional[Event] = None,
+    ) -> AsyncIterator[Any]:
+        try:
+            chunk = first
+            while chunk is not None:
+                yield chunk
+                chunk, error = await queue.get()
+                if error is not None:
+                    raise error
+        finally:
+            # stops the worker, and the generation if the client has gone
+            stop.set()
+            if cancel_event is not None:
+                cancel_event.set()
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from typing import (
+    Any,
+    List,
+    Sequence,
+    Tuple,
+)
+
+import torch
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, ...], ...]
+
+
+def to_legacy_cache(past_key_values: Any) -> PastKeyValues:
+    """ Convert a `transformers` cache object into the legacy tuple format. """
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def infer_seq_dim(past_key_values: PastKeyValues, seq_len: int) -> int:
+    """
+    Infer which dimension of the key/value tensors holds the sequence.
+
+    Most models use `[batch, heads, seq, dim]`, but some remote code models
+    (e.g. Qwen-7B-Chat) use `[batch, seq, heads, dim]`.
+    """
+    key = past_key_values[0][0]
+    for dim in (2, 1):
+        if key.shape[dim] == seq_len:
+            return dim
+    raise ValueError(f"Unsupported kv cache shape {tuple(key.shape)}")
+
+
+def get_cache_length(past_key_values: PastKeyValues, seq_dim: int = 2) -> int:
+    return past_key_values[0][0].shape[seq_dim]
+
+
+def _map_cache(past_key_values: PastKeyValues, fn) -> PastKeyValues:
+    return tuple(tuple(fn(t) for t in layer) for layer in past_key_values)
+
+
+def left_pad_cache(
+    past_key_values: PastKeyValues,
+    length: int,
+    seq_dim: int = 2,
+) -> PastKeyValues:
+    """ Left pad the sequence dimension of the cache with zeros up to `length`. """
+    pad = length - get_cache_length(past_key_values, seq_dim)
+    if pad <= 0:
+        return past_key_values
+
+    def _pad(t: torch.Tensor) -> torch.Tensor:
+        shape = list(t.shape)
+        shape[seq_dim] = pad
+        return torch.cat([t.new_zeros(shape), t], dim=seq_dim)
+
+    return _map_cache(past_key_values, _pad)
+
+
+def concat_caches(caches: Sequence[PastKeyValues]) -> PastKeyValues:
+    """ Concatenate caches of equal sequence length along the batch dimension. """
+    return tuple(
+        tuple(torch.cat([c[i][j] for c in caches], dim=0) for j in range(len(caches[0][i])))
+        for i in range(len(caches[0]))
+    )
+
+
+def select_cache(past_key_values: PastKeyValues, indices: List[int]) -> PastKeyValues:
+    """ Keep only the given rows of the batch dimension. """
+    index = torch.as_tensor(indices, device=past_key_values[0][0].device)
+    return _map_cache(past_key_values, lambda t: t.index_select(0, index))
+
+
+def slice_cache(
+    past_key_values: PastKeyValues,
+    start: int = 0,
+    end: int = None,
+    seq_dim: int = 2,
+) -> PastKeyValues:
+    """ Slice the sequence dimension of the cache. """
+    return _map_cache(past_key_values, lambda t: t.narrow(
+        seq_dim, start, (end if end is not None else t.shape[seq_dim]) - start
+    ))
+
+
+def left_pad_mask(mask: torch.Tensor, length: int) -> torch.Tensor:
+    pad = length - mask.shape[1]
+    if pad <= 0:
+        return mask
+    return torch.cat([mask.new_zeros(mask.shape[0], pad), mask], dim=1)
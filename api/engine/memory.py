@@ -0,0 +1,108 @@
+import gc
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+
+import torch
+from loguru import logger
+
+
+class MemoryManager:
+    """
+    Keeps the memory freed by finished requests pooled in the torch caching
+    allocator, so that the kv caches and activations of the next requests
+    reuse it instead of growing the pool again.
+
+    The pool is only trimmed under pressure, measured against the headroom
+    of a device: the memory left after the weights (the memory allocated
+    when the manager is created, after the model is loaded), which is the
+    free memory of the device (`torch.cuda.mem_get_info`, so that other
+    processes count too) plus the memory reserved by the pool above the
+    weights. Once the pool takes more than `high_watermark` of the headroom,
+    the cached blocks are released, and a full garbage collection is run if
+    the allocated memory still takes more than `low_watermark` of it
+    (reference cycles may keep tensors alive).
+
+    Args:
+        high_watermark: Fraction of the headroom reserved by the pool above which it is trimmed.
+        low_watermark: Fraction of the headroom allocated above which a trim also collects garbage.
+        reserve_memory: Bytes allocated up front, so that the first requests find a grown pool.
+    """
+
+    def __init__(
+        self,
+        high_watermark: float = 0.9,
+        low_watermark: float = 0.7,
+        reserve_memory: int = 0,
+    ) -> None:
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.devices: List[int] = list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+        # the memory of the weights, which is never given back
+        self.baselines: Dict[int, int] = {d: torch.cuda.memory_allocated(d) for d in self.devices}
+
+        self.num_requests = 0
+        self.num_trims = 0
+        self.num_collections = 0
+
+        if reserve_memory > 0 and self.devices:
+            self.reserve(reserve_memory)
+
+    def reserve(self, num_bytes: int) -> None:
+        """ Grow the pool of every device by `num_bytes`, which stay cached once freed. """
+        for device in self.devices:
+            block = torch.empty(num_bytes, dtype=torch.uint8, device=device)
+            del block
+        logger.info(f"Reserved {num_bytes / (1 << 30):.2f} GiB on {len(self.devices)} device(s)")
+
+    def maybe_trim(self) -> None:
+        """ Called after every request, trims the pool if a device is under pressure. """
+        self.num_requests += 1
+        if self.devices and max(self._usage(d, reserved=True) for d in self.devices) > self.high_watermark:
+            self.trim()
+
+    def trim(self) -> None:
+        """ Release the cached blocks, collecting garbage too if the devices stay full. """
+        self.num_trims += 1
+        torch.cuda.empty_cache()
+        if not self.devices or max(self._usage(d, reserved=False) for d in self.devices) > self.low_watermark:
+            self.num_collections += 1
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "high_watermark": self.high_watermark,
+            "low_watermark": self.low_watermark,
+            "num_requests": self.num_requests,
+            "num_trims": self.num_trims,
+            "num_collections": self.num_collections,
+            "gc_counts": list(gc.get_count()),
+            "gc_frozen": gc.get_freeze_count(),
+        }
+        devices = {}
+        for device in self.devices:
+            memory_stats = torch.cuda.memory_stats(device)
+            devices[f"cuda:{device}"] = {
+                "total": torch.cuda.get_device_properties(device).total_memory,
+                "baseline": self.baselines[device],
+                "allocated": torch.cuda.memory_allocated(device),
+                "reserved": torch.cuda.memory_reserved(device),
+                "max_allocated": torch.cuda.max_memory_allocated(device),
+                "max_reserved": torch.cuda.max_memory_reserved(device),
+                "num_alloc_retries": memory_stats.get("num_alloc_retries", 0),
+                "num_ooms": memory_stats.get("num_ooms", 0),
+            }
+        if devices:
+            stats["devices"] = devices
+        return stats
+
+    def _usage(self, device: int, reserved: bool) -> float:
+        """ The fraction of the headroom of a device reserved (or allocated) by the requests. """
+        baseline = self.baselines[device]
+        free, _ = torch.cuda.mem_get_info(device)
+        headroom = free + max(torch.cuda.memory_reserved(device) - baseline, 0)
+        used = torch.cuda.memory_reserved(device) if reserved else torch.cuda.memory_allocated(device)
+        return max(used - baseline, 0) / headroom if headroom > 0 else 1.0
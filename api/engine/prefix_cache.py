@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import (
+    Dict,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from api.engine.kv_cache import PastKeyValues, get_cache_length, slice_cache
+
+
+class _Node:
+    __slots__ = ("tokens", "children", "parent", "entry")
+
+    def __init__(self, tokens: Tuple[int, ...] = (), parent: Optional["_Node"] = None) -> None:
+        self.tokens = tokens
+        self.children: Dict[int, "_Node"] = {}
+        self.parent = parent
+        self.entry: Optional["_Entry"] = None
+
+
+class _Entry:
+    __slots__ = ("node", "past_key_values", "length", "nbytes")
+
+    def __init__(self, node: _Node, past_key_values: PastKeyValues, length: int) -> None:
+        self.node = node
+        self.past_key_values = past_key_values
+        self.length = length
+        self.nbytes = sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
+
+
+class PrefixCache:
+    """
+    Token prefix kv cache for reusing the prefill of previous requests.
+
+    Cached prefixes are stored in a radix tree keyed on token ids. Looking up
+    a prompt returns the kv of its longest cached prefix, so only the suffix
+    needs to be prefilled. Entries are evicted in LRU order once the memory
+    budget is exceeded.
+    """
+
+    def __init__(self, max_memory: int, seq_dim: int = 2) -> None:
+        self.max_memory = max_memory
+        self.seq_dim = seq_dim
+        self.root = _Node()
+        self.entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self.memory = 0
+
+        self.num_queries = 0
+        self.num_hits = 0
+        self.num_cached_tokens = 0
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """
+        Find the longest cached prefix of `token_ids`.
+
+        At least one token is always left uncached so that the caller can
+        compute the logits of the last prompt token.
+
+        Returns:
+            The number of matched tokens and the kv cache for them.
+        """
+        self.num_queries += 1
+        node, matched, pos = self.root, 0, 0
+        limit = len(token_ids) - 1
+        while pos < limit:
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                break
+            n = 0
+            for a, b in zip(child.tokens, token_ids[pos:limit]):
+                if a != b:
+                    break
+                n += 1
+            pos += n
+            matched, node = pos, child
+            if n < len(child.tokens):
+                break
+
+        if matched == 0:
+            return 0, None
+
+        # every entry below `node` shares the matched prefix
+        entry = self._find_entry(node)
+        self.entries.move_to_end(id(entry))
+
+        self.num_hits += 1
+        self.num_cached_tokens += matched
+        return matched, slice_cache(entry.past_key_values, 0, matched, self.seq_dim)
+
+    def insert(self, token_ids: Sequence[int], past_key_values: PastKeyValues) -> None:
+        """ Cache the kv of `token_ids`, which must cover exactly these tokens. """
+        token_ids = tuple(token_ids)
+        if not token_ids or get_cache_length(past_key_values, self.seq_dim) != len(token_ids):
+            return
+
+        node, pos, redundant = self.root, 0, []
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                child = _Node(token_ids[pos:], node)
+                node.children[token_ids[pos]] = child
+                node = child
+                break
+
+            n = 0
+            for a, b in zip(child.tokens, token_ids[pos:]):
+                if a != b:
+                    break
+                n += 1
+
+            if n < len(child.tokens):
+                if pos + n == len(token_ids):
+                    # the tokens are a prefix of a cached entry
+                    self.entries.move_to_end(id(self._find_entry(child)))
+                    return
+                child = self._split(child, n)
+            pos += n
+            node = child
+
+            # an existing entry on the path is a prefix of the new one
+            if node.entry is not None and pos < len(token_ids):
+                redundant.append(node.entry)
+
+        if node.entry is not None or node.children:
+            # the tokens are already covered by a cached entry
+            self.entries.move_to_end(id(self._find_entry(node)))
+            return
+
+        past_key_values = tuple(tuple(t.clone() for t in layer) for layer in past_key_values)
+        entry = _Entry(node, past_key_values, len(token_ids))
+        node.entry = entry
+        self.entries[id(entry)] = entry
+        self.memory += entry.nbytes
+
+        for e in redundant:
+            self._remove(e)
+
+        while self.memory > self.max_memory and self.entries:
+            _, lru = next(iter(self.entries.items()))
+            self._remove(lru)
+
+    def clear(self) -> None:
+        self.root = _Node()
+        self.entries.clear()
+        self.memory = 0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "num_entries": len(self.entries),
+            "memory": self.memory,
+            "num_queries": self.num_queries,
+            "num_hits": self.num_hits,
+            "hit_rate": self.num_hits / self.num_queries if self.num_queries else 0.0,
+            "num_cached_tokens": self.num_cached_tokens,
+        }
+
+    @staticmethod
+    def _find_entry(node: _Node) -> _Entry:
+        while node.entry is None:
+            node = next(iter(node.children.values()))
+        return node.entry
+
+    @staticmethod
+    def _split(node: _Node, n: int) -> _Node:
+        """ Split the edge of `node` after `n` tokens and return the new parent. """
+        parent = node.parent
+        mid = _Node(node.tokens[:n], parent)
+        parent.children[mid.tokens[0]] = mid
+        node.tokens = node.tokens[n:]
+        node.parent = mid
+        mid.children[node.tokens[0]] = node
+        return mid
+
+    def _remove(self, entry: _Entry) -> None:
+        self.entries.pop(id(entry), None)
+        self.memory -= entry.nbytes
+        node = entry.node
+        node.entry = None
+
+        # prune the branches which no longer lead to an entry
+        while node is not self.root and node.entry is None and not node.children:
+            parent = node.parent
+            del parent.children[node.tokens[0]]
+            node = parent
+
+        # merge a single child into its parent to keep the tree compressed
+        if node is not self.root and node.entry is None and len(node.children) == 1:
+            (child,) = node.children.values()
+            child.tokens = node.tokens + child.tokens
+            child.parent = node.parent
+            node.parent.children[child.tokens[0]] = child
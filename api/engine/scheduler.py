@@ -0,0 +1,478 @@
+from __future__ import annotations
+
+import uuid
+from collections import deque
+from queue import Queue
+from threading import Condition, Event, Thread
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+import torch
+from loguru import logger
+
+from api.engine.kv_cache import (
+    PastKeyValues,
+    concat_caches,
+    infer_seq_dim,
+    left_pad_cache,
+    left_pad_mask,
+    select_cache,
+    slice_cache,
+    to_legacy_cache,
+)
+from api.engine.prefix_cache import PrefixCache
+from api.templates.stream import StreamDecoder
+from api.templates.utils import prepare_logits_processor
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel, PreTrainedTokenizer
+
+
+class Sequence:
+    """ A single generation sequence tracked by the scheduler. """
+
+    def __init__(
+        self,
+        prompt_ids: List[int],
+        params: Dict[str, Any],
+        stop_token_ids: List[int],
+        max_new_tokens: int,
+        outputs: Queue,
+        index: int = 0,
+    ) -> None:
+        self.seq_id = str(uuid.uuid4())
+        self.index = index
+        self.prompt_ids = prompt_ids
+        self.output_ids: List[int] = []
+        self.cumulative_logprob = 0.0
+
+        self.temperature = float(params.get("temperature", 1.0))
+        self.top_p = float(params.get("top_p", 1.0))
+        self.repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        top_k = int(params.get("top_k", 50))
+        self.logits_processor = prepare_logits_processor(
+            self.temperature, self.repetition_penalty, self.top_p, top_k
+        )
+        self.stop_token_ids = set(stop_token_ids)
+        self.max_new_tokens = max_new_tokens
+
+        self.finish_reason: Optional[str] = None
+        self.cancel_event: Optional[Event] = params.get("cancel_event")
+        self._aborted = False
+        self.outputs = outputs
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.prompt_ids) + len(self.output_ids)
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    @property
+    def aborted(self) -> bool:
+        """ Aborted by the consumer, or the client of the request went away. """
+        return self._aborted or (self.cancel_event is not None and self.cancel_event.is_set())
+
+    def abort(self) -> None:
+        """ Ask the scheduler to drop this sequence at the next step. """
+        self._aborted = True
+
+    def put(self, item: Any) -> None:
+        """ Send new token ids, `None` when finished, or an exception to the consumer. """
+        self.outputs.put((self.index, item))
+
+
+class BatchScheduler:
+    """
+    Iteration-level (continuous) batching for the HuggingFace engine.
+
+    A single background thread owns the model. At every step it admits
+    waiting sequences (prefilling them one by one), runs one batched decode
+    forward across all running sequences, and evicts the finished ones.
+    Sequences of different lengths share a left padded kv cache.
+
+    The `n` samples of a request are prefilled once, and the prompt kv cache
+    is forked across them.
+
+    With `prefill_chunk_size`, prompts longer than a chunk are prefilled one
+    chunk per step, in between the decode steps of the running sequences.
+    This bounds the activation memory of long prompts and keeps the other
+    streams going while they are prefilled.
+    """
+
+    def __init__(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        max_model_length: int,
+        max_num_seqs: int = 256,
+        max_num_batched_tokens: Optional[int] = None,
+        prefix_cache_memory: Optional[int] = None,
+        prefill_chunk_size: Optional[int] = None,
+    ) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = model.device
+        self.max_model_length = max_model_length
+        self.max_num_seqs = max_num_seqs
+        self.max_num_batched_tokens = max_num_batched_tokens
+        self.prefill_chunk_size = prefill_chunk_size
+
+        eos_token_id = model.generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_ids = [i for i in (eos_token_id or []) + [tokenizer.eos_token_id] if i is not None]
+
+        self.waiting: deque = deque()
+        self.running: List[Sequence] = []
+        self.seq_dim: Optional[int] = None
+        self._past_key_values: Optional[PastKeyValues] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        # the group being prefilled chunk by chunk, the number of prompt tokens done and their kv
+        self.prefilling: Optional[Tuple[List[Sequence], int, Optional[PastKeyValues]]] = None
+
+        self.prefix_cache_memory = prefix_cache_memory
+        self.prefix_cache: Optional[PrefixCache] = None
+
+        self._cond = Condition()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_request(
+        self,
+        prompt_ids: List[int],
+        params: Dict[str, Any],
+        n: int = 1,
+        outputs: Optional[Queue] = None,
+        start_index: int = 0,
+    ) -> List[Sequence]:
+        """
+        Queue `n` samples of a prompt, which all send their outputs to one
+        queue, tagged with their index counted from `start_index`.
+        """
+        prompt_ids = list(prompt_ids)
+        stop_token_ids = list(params.get("stop_token_ids") or []) + self.eos_token_ids
+        max_new_tokens = min(
+            int(params.get("max_tokens", 256)),
+            max(self.max_model_length - len(prompt_ids), 1),
+        )
+        outputs = outputs if outputs is not None else Queue()
+        group = [
+            Sequence(prompt_ids, params, stop_token_ids, max_new_tokens, outputs, index=start_index + i)
+            for i in range(n)
+        ]
+        with self._cond:
+            self.waiting.append(group)
+            self._cond.notify()
+        return group
+
+    def generate_stream(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Same contract as `api.templates.stream.generate_stream`, except that the
+        outputs of the `n` samples are interleaved and tagged with their `index`.
+        """
+        yield from self.generate_batch_stream(model, tokenizer, params, [params.get("inputs")])
+
+    def generate_batch_stream(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+        prompts: List[List[int]],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Runs `n` samples of every prompt in the same batch. The outputs are
+        interleaved, the sample `j` of the prompt `i` has the `index` `i * n + j`.
+        """
+        n = max(int(params.get("n") or 1), 1)
+        outputs = Queue()
+        group = []
+        for i, prompt_ids in enumerate(prompts):
+            group.extend(self.add_request(prompt_ids, params, n=n, outputs=outputs, start_index=i * n))
+        decoders = [StreamDecoder(tokenizer, params, len(seq.prompt_ids), index=seq.index) for seq in group]
+        for decoder in decoders[1:]:
+            decoder.completion_id, decoder.created = decoders[0].completion_id, decoders[0].created
+
+        done = set()
+        try:
+            while len(done) < len(group):
+                index, item = outputs.get()
+                if isinstance(item, Exception):
+                    raise item
+                if index in done:
+                    continue
+
+                decoder = decoders[index]
+                if item is not None:
+                    output = decoder.update(item)
+                    if output is not None:
+                        yield output
+                    if not decoder.stopped:
+                        continue
+                    group[index].abort()
+
+                done.add(index)
+                output = decoder.final_output()
+                output["cumulative_logprob"] = group[index].cumulative_logprob
+                yield output
+        finally:
+            for seq in group:
+                seq.abort()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "num_running": len(self.running),
+            "num_waiting": len(self.waiting),
+            "num_prefilling": len(self.prefilling[0]) if self.prefilling is not None else 0,
+            "max_num_seqs": self.max_num_seqs,
+            "max_num_batched_tokens": self.max_num_batched_tokens,
+            "prefill_chunk_size": self.prefill_chunk_size,
+        }
+        if self.prefix_cache is not None:
+            stats["prefix_cache"] = self.prefix_cache.stats()
+        return stats
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self.waiting and not self.running and self.prefilling is None:
+                    self._cond.wait()
+            try:
+                self.step()
+            except Exception as e:  # the batched decode step, prefill errors only fail their group
+                logger.exception("Scheduler step failed")
+                self._fail_running(e)
+
+    @torch.inference_mode()
+    def step(self) -> None:
+        self._evict()
+
+        budget = None
+        if self.max_num_batched_tokens:
+            budget = self.max_num_batched_tokens - len(self.running)
+
+        if self.prefilling is not None:
+            group = self.prefilling[0]
+            if all(seq.aborted for seq in group):
+                for seq in group:
+                    seq.put(None)
+                self.prefilling = None
+            else:
+                if budget is not None:
+                    budget -= self._next_chunk_length()
+                self._prefill_chunk()
+
+        while self.waiting and self.prefilling is None:
+            group = self.waiting[0]
+            if self.running and len(self.running) + len(group) > self.max_num_seqs:
+                break
+            if budget is not None and self.running and len(group[0].prompt_ids) > budget:
+                if not self.prefill_chunk_size or self.prefill_chunk_size > budget:
+                    break
+            with self._cond:
+                self.waiting.popleft()
+            group = [seq for seq in group if not seq.aborted]
+            if not group:
+                continue
+            self._prefill(group)
+            if budget is not None and self.prefilling is None:
+                budget -= len(group[0].prompt_ids)
+
+        if self.running:
+            self._decode()
+
+    def _prefill(self, group: List[Sequence]) -> None:
+        seq = group[0]
+        num_cached, cached_key_values = 0, None
+        if self.prefix_cache is not None:
+            num_cached, cached_key_values = self.prefix_cache.match(seq.prompt_ids)
+
+        self.prefilling = (group, num_cached, cached_key_values)
+        self._prefill_chunk()
+
+    def _next_chunk_length(self) -> int:
+        group, start, _ = self.prefilling
+        length = len(group[0].prompt_ids) - start
+        return min(length, self.prefill_chunk_size) if self.prefill_chunk_size else length
+
+    def _prefill_chunk(self) -> None:
+        """
+        Forward the next chunk of the prompt being prefilled, and start decoding
+        it once done. If it fails (e.g. out of memory on a long prompt), only
+        its group fails: the running sequences and their kv cache are kept.
+        """
+        group = self.prefilling[0]
+        try:
+            self._forward_chunk()
+        except Exception as e:
+            logger.exception("Prefill failed")
+            self.prefilling = None
+            for seq in group:
+                seq.put(e)
+
+    def _forward_chunk(self) -> None:
+        group, start, past_key_values = self.prefilling
+        seq = group[0]
+        end = start + self._next_chunk_length()
+        input_ids = torch.as_tensor([seq.prompt_ids[start:end]], device=self.device)
+        if past_key_values is None:
+            out = self.model(input_ids=input_ids, use_cache=True)
+        else:
+            out = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones(1, end, dtype=torch.long, device=self.device),
+                position_ids=torch.arange(start, end, device=self.device)[None, :],
+                past_key_values=past_key_values,
+                use_cache=True,
+            )
+
+        past_key_values = to_legacy_cache(out.past_key_values)
+        if self.seq_dim is None:
+            self.seq_dim = infer_seq_dim(past_key_values, end)
+            if self.prefix_cache_memory:
+                self.prefix_cache = PrefixCache(self.prefix_cache_memory, self.seq_dim)
+        if end < len(seq.prompt_ids):
+            self.prefilling = (group, end, past_key_values)
+            return
+
+        self.prefilling = None
+        group = [s for s in group if not s.aborted]
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(seq.prompt_ids, past_key_values)
+
+        logits = out.logits[0, -1, :]
+        alive = []
+        for s in group:
+            self._append_token(s, logits)
+            if s.finished:
+                s.put(None)
+            else:
+                alive.append(s)
+        if not alive:
+            return
+
+        if len(alive) > 1:
+            past_key_values = concat_caches([past_key_values] * len(alive))
+        mask = torch.ones(len(alive), len(seq.prompt_ids), dtype=torch.long, device=self.device)
+        if not self.running:
+            self._past_key_values, self._attention_mask = past_key_values, mask
+        else:
+            length = max(self._attention_mask.shape[1], mask.shape[1])
+            self._past_key_values = concat_caches(
+                [
+                    left_pad_cache(self._past_key_values, length, self.seq_dim),
+                    left_pad_cache(past_key_values, length, self.seq_dim),
+                ]
+            )
+            self._attention_mask = torch.cat(
+                [left_pad_mask(self._attention_mask, length), left_pad_mask(mask, length)], dim=0
+            )
+        self.running.extend(alive)
+
+    def _decode(self) -> None:
+        input_ids = torch.as_tensor([[s.output_ids[-1]] for s in self.running], device=self.device)
+        position_ids = torch.as_tensor([[s.num_tokens - 1] for s in self.running], device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones(len(self.running), 1)], dim=1
+        )
+
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+        )
+        self._past_key_values = to_legacy_cache(out.past_key_values)
+        self._attention_mask = attention_mask
+
+        logits = out.logits[:, -1, :]
+        for i, seq in enumerate(self.running):
+            self._append_token(seq, logits[i])
+
+        self._evict()
+
+    def _sample(self, seq: Sequence, logits: torch.Tensor) -> Tuple[int, float]:
+        """ Returns the sampled token and its log probability. """
+        if seq.logits_processor:
+            input_ids = None
+            if seq.repetition_penalty > 1.0:
+                input_ids = torch.as_tensor([seq.prompt_ids + seq.output_ids], device=logits.device)
+            logits = seq.logits_processor(input_ids, logits[None, :])[0]
+
+        logprobs = torch.log_softmax(logits.float(), dim=-1)
+        if seq.temperature < 1e-5 or seq.top_p < 1e-8:  # greedy
+            token = int(torch.argmax(logprobs))
+        else:
+            token = int(torch.multinomial(logprobs.exp(), num_samples=1))
+        return token, float(logprobs[token])
+
+    def _append_token(self, seq: Sequence, logits: torch.Tensor) -> None:
+        token, logprob = self._sample(seq, logits)
+        seq.output_ids.append(token)
+        seq.cumulative_logprob += logprob
+        if token in seq.stop_token_ids:
+            seq.finish_reason = "stop"
+        else:
+            seq.put([token])
+            if len(seq.output_ids) >= seq.max_new_tokens:
+                seq.finish_reason = "length"
+
+    def _evict(self) -> None:
+        """ Remove finished or aborted sequences from the running batch. """
+        keep = []
+        for i, seq in enumerate(self.running):
+            if seq.finished or seq.aborted:
+                seq.put(None)
+                self._cache_prefix(i, seq)
+            else:
+                keep.append(i)
+
+        if len(keep) == len(self.running):
+            return
+
+        if not keep:
+            self._reset()
+            return
+
+        self.running = [self.running[i] for i in keep]
+        self._past_key_values = select_cache(self._past_key_values, keep)
+        self._attention_mask = self._attention_mask[keep]
+
+        # drop the leading columns which are padding for every remaining sequence
+        start = int(self._attention_mask.sum(0).nonzero()[0])
+        if start > 0:
+            self._past_key_values = slice_cache(self._past_key_values, start, seq_dim=self.seq_dim)
+            self._attention_mask = self._attention_mask[:, start:]
+
+    def _cache_prefix(self, index: int, seq: Sequence) -> None:
+        """ Keep the kv of a finished sequence so that the next turn can reuse it. """
+        if self.prefix_cache is None:
+            return
+        length = seq.num_tokens - 1  # the last sampled token has not been forwarded
+        past_key_values = select_cache(self._past_key_values, [index])
+        start = self._attention_mask.shape[1] - length
+        past_key_values = slice_cache(past_key_values, start, seq_dim=self.seq_dim)
+        self.prefix_cache.insert(seq.prompt_ids + seq.output_ids[:-1], past_key_values)
+
+    def _fail_running(self, e: Exception) -> None:
+        for seq in self.running:
+            seq.put(e)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.running = []
+        self._past_key_values, self._attention_mask = None, None
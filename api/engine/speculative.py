@@ -0,0 +1,314 @@
+from __future__ import annotations
+
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    TYPE_CHECKING,
+)
+
+import torch
+
+from api.engine.kv_cache import (
+    PastKeyValues,
+    get_cache_length,
+    infer_seq_dim,
+    slice_cache,
+    to_legacy_cache,
+)
+from api.templates.stream import decode_stream
+from api.templates.utils import prepare_logits_processor
+
+if TYPE_CHECKING:
+    from transformers import LogitsProcessorList, PreTrainedModel, PreTrainedTokenizer
+
+
+class _CachedForward:
+    """ Runs a causal lm over a growing token sequence, keeping its kv cache. """
+
+    def __init__(self, model: "PreTrainedModel") -> None:
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.seq_dim: Optional[int] = None
+        self.past_key_values: Optional[PastKeyValues] = None
+        self.cached_ids: List[int] = []
+
+    def __call__(self, token_ids: List[int]) -> torch.Tensor:
+        """ Returns the logits of every token in `token_ids` not seen before. """
+        n = 0
+        for a, b in zip(self.cached_ids, token_ids[:-1]):
+            if a != b:
+                break
+            n += 1
+        if n == 0:
+            self.past_key_values = None
+        elif n < len(self.cached_ids):
+            self.past_key_values = slice_cache(self.past_key_values, 0, n, self.seq_dim)
+
+        new_ids = token_ids[n:]
+        out = self.model(
+            input_ids=torch.as_tensor([new_ids], device=self.device),
+            past_key_values=self.past_key_values,
+            use_cache=True,
+        )
+        self.past_key_values = to_legacy_cache(out.past_key_values)
+        if self.seq_dim is None:
+            self.seq_dim = infer_seq_dim(self.past_key_values, len(token_ids))
+        self.cached_ids = list(token_ids)
+        return out.logits[0, -len(new_ids):, :]
+
+    def crop(self, length: int) -> None:
+        """ Forget everything after the first `length` tokens. """
+        if self.past_key_values is not None and get_cache_length(self.past_key_values, self.seq_dim) > length:
+            self.past_key_values = slice_cache(self.past_key_values, 0, length, self.seq_dim)
+        self.cached_ids = self.cached_ids[:length]
+
+
+class DraftModelProposer:
+    """ Proposes tokens by running a small draft model autoregressively. """
+
+    def __init__(
+        self,
+        draft_model: "PreTrainedModel",
+        logits_processor: "LogitsProcessorList",
+        greedy: bool,
+    ) -> None:
+        self.forward = _CachedForward(draft_model)
+        self.logits_processor = logits_processor
+        self.greedy = greedy
+
+    def propose(self, token_ids: List[int], num_tokens: int) -> Tuple[List[int], Optional[torch.Tensor]]:
+        """
+        Returns the proposed tokens and the draft probabilities they were
+        sampled from (`None` for greedy decoding).
+        """
+        token_ids = list(token_ids)
+        tokens, probs = [], []
+        logits = self.forward(token_ids)[-1]
+        for i in range(num_tokens):
+            if self.logits_processor:
+                input_ids = torch.as_tensor([token_ids], device=logits.device)
+                logits = self.logits_processor(input_ids, logits[None, :])[0]
+            if self.greedy:
+                token = int(torch.argmax(logits))
+            else:
+                prob = torch.softmax(logits.float(), dim=-1)
+                token = int(torch.multinomial(prob, num_samples=1))
+                probs.append(prob)
+
+            tokens.append(token)
+            token_ids.append(token)
+            if i < num_tokens - 1:
+                logits = self.forward(token_ids)[-1]
+
+        return tokens, torch.stack(probs) if probs else None
+
+
+class PromptLookupProposer:
+    """
+    Proposes the tokens which followed the last occurrence of the current
+    n-gram suffix in the prompt or the generated text. No draft model is
+    needed, and extractive answers (e.g. chat over retrieved documents) are
+    largely copied from the prompt.
+    """
+
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1) -> None:
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+        # n-gram -> end position of its last occurrence, for every n
+        self.indexes: Dict[int, Dict[Tuple[int, ...], int]] = {
+            n: {} for n in range(min_ngram, max_ngram + 1)
+        }
+        self.num_indexed = 0
+
+    def propose(self, token_ids: List[int], num_tokens: int) -> Tuple[List[int], Optional[torch.Tensor]]:
+        length = len(token_ids)
+        # index the n-grams which are followed by at least one token
+        for end in range(max(self.num_indexed, 1), length):
+            for n, index in self.indexes.items():
+                if end >= n:
+                    index[tuple(token_ids[end - n:end])] = end
+        self.num_indexed = length
+
+        for n in range(self.max_ngram, self.min_ngram - 1, -1):
+            if length < n:
+                continue
+            end = self.indexes[n].get(tuple(token_ids[length - n:]))
+            if end is not None:
+                return list(token_ids[end:end + num_tokens]), None
+        return [], None
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding for the HuggingFace engine.
+
+    At every step a proposer guesses the next `num_speculative_tokens` tokens,
+    and the target model scores all of them in a single forward pass. The
+    longest prefix agreeing with the target distribution is accepted, followed
+    by one token sampled from the target model, so every step yields at least
+    one token and the output distribution is unchanged.
+
+    Tokens are proposed by a small draft model if given, otherwise by looking
+    up the n-gram suffix in the prompt.
+    """
+
+    def __init__(
+        self,
+        draft_model: Optional["PreTrainedModel"] = None,
+        num_speculative_tokens: int = 5,
+        prompt_lookup_max_ngram: int = 3,
+    ) -> None:
+        self.draft_model = draft_model
+        self.num_speculative_tokens = num_speculative_tokens
+        self.prompt_lookup_max_ngram = prompt_lookup_max_ngram
+
+        self.num_steps = 0
+        self.num_draft_tokens = 0
+        self.num_accepted_tokens = 0
+        self.num_emitted_tokens = 0
+
+    def generate_stream(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """ Same contract as `api.templates.stream.generate_stream`. """
+        inputs = params.get("inputs")
+        yield from decode_stream(tokenizer, self.generate(model, tokenizer, params), params, len(inputs))
+
+    @torch.inference_mode()
+    def generate(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[List[int]]:
+        """ Yields the new token ids accepted at every step. """
+        token_ids = list(params.get("inputs"))
+        temperature = float(params.get("temperature", 1.0))
+        repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        top_p = float(params.get("top_p", 1.0))
+        top_k = int(params.get("top_k", 50))
+        max_new_tokens = int(params.get("max_tokens", 256))
+
+        stop_token_ids = set(params.get("stop_token_ids") or [])
+        stop_token_ids.add(tokenizer.eos_token_id)
+
+        greedy = temperature <= 1e-5
+        logits_processor = prepare_logits_processor(temperature, repetition_penalty, top_p, top_k)
+        proposer = self.get_proposer(logits_processor, greedy)
+        target = _CachedForward(model)
+        cancel_event = params.get("cancel_event")
+
+        num_generated = 0
+        while num_generated < max_new_tokens:
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            num_draft = min(self.num_speculative_tokens, max_new_tokens - num_generated - 1)
+            drafts, draft_probs = proposer.propose(token_ids, num_draft) if num_draft > 0 else ([], None)
+
+            logits = target(token_ids + drafts)[-(len(drafts) + 1):]
+            new_ids = self._verify(token_ids, drafts, draft_probs, logits, logits_processor, greedy)
+            target.crop(len(token_ids) + len(new_ids) - 1)
+
+            self.num_steps += 1
+            self.num_draft_tokens += len(drafts)
+            self.num_accepted_tokens += len(new_ids) - 1
+
+            # the tokens accepted before a stop token are still emitted
+            finished = False
+            for i, token in enumerate(new_ids):
+                if token in stop_token_ids:
+                    new_ids, finished = new_ids[:i], True
+                    break
+            new_ids = new_ids[:max_new_tokens - num_generated]
+            num_generated += len(new_ids)
+            token_ids.extend(new_ids)
+            self.num_emitted_tokens += len(new_ids)
+
+            if new_ids:
+                yield new_ids
+            if finished:
+                break
+
+    def get_proposer(
+        self,
+        logits_processor: "LogitsProcessorList",
+        greedy: bool,
+    ) -> Union[DraftModelProposer, PromptLookupProposer]:
+        if self.draft_model is not None:
+            return DraftModelProposer(self.draft_model, logits_processor, greedy)
+        return PromptLookupProposer(self.prompt_lookup_max_ngram)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "proposer": "draft_model" if self.draft_model is not None else "prompt_lookup",
+            "num_speculative_tokens": self.num_speculative_tokens,
+            "num_steps": self.num_steps,
+            "num_draft_tokens": self.num_draft_tokens,
+            "num_accepted_tokens": self.num_accepted_tokens,
+            "acceptance_rate": (
+                self.num_accepted_tokens / self.num_draft_tokens if self.num_draft_tokens else 0.0
+            ),
+            "mean_tokens_per_step": (
+                self.num_emitted_tokens / self.num_steps if self.num_steps else 0.0
+            ),
+        }
+
+    @staticmethod
+    def _verify(
+        token_ids: List[int],
+        drafts: List[int],
+        draft_probs: Optional[torch.Tensor],
+        logits: torch.Tensor,
+        logits_processor: "LogitsProcessorList",
+        greedy: bool,
+    ) -> List[int]:
+        """
+        Accept the drafts agreeing with the target model, and append one token
+        sampled from the target distribution at the first rejected position.
+        """
+        accepted = []
+        for i in range(len(drafts) + 1):
+            step_logits = logits[i]
+            if logits_processor:
+                input_ids = torch.as_tensor([token_ids + accepted], device=step_logits.device)
+                step_logits = logits_processor(input_ids, step_logits[None, :])[0]
+
+            if greedy:
+                token = int(torch.argmax(step_logits))
+                if i < len(drafts) and token == drafts[i]:
+                    accepted.append(token)
+                    continue
+                return accepted + [token]
+
+            probs = torch.softmax(step_logits.float(), dim=-1)
+            if i == len(drafts):
+                return accepted + [int(torch.multinomial(probs, num_samples=1))]
+
+            # accept with probability min(1, p / q), otherwise resample from max(0, p - q)
+            draft = drafts[i]
+            if draft_probs is None:
+                q = torch.zeros_like(probs)
+                q[draft] = 1.0
+            else:
+                q = torch.zeros_like(probs)
+                n = min(q.shape[-1], draft_probs.shape[-1])
+                q[:n] = draft_probs[i, :n].to(probs.device)
+
+            if draft < probs.shape[-1] and torch.rand(()) * q[draft] < probs[draft]:
+                accepted.append(draft)
+                continue
+
+            residual = (probs - q).clamp_(min=0)
+            if residual.sum() <= 0:
+                residual = probs
+            return accepted + [int(torch.multinomial(residual / residual.sum(), num_samples=1))]
+
+        return accepted
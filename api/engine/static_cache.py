@@ -0,0 +1,245 @@
+from __future__ import annotations
+
+import time
+from concurrent.futures import Future
+from queue import Queue
+from threading import Event, Thread
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    TYPE_CHECKING,
+)
+
+import torch
+from loguru import logger
+
+from api.templates.stream import TokenIdStreamer, decode_stream
+from api.templates.utils import prepare_logits_processor
+
+if TYPE_CHECKING:
+    from transformers import PreTrainedModel, PreTrainedTokenizer
+
+
+class StaticCacheDecoder:
+    """
+    Fast path of the HuggingFace engine with a static kv cache.
+
+    The kv cache is allocated once for `max_model_length` tokens, so every
+    decoding step has the same shapes and is compiled with `torch.compile`
+    (with cuda graphs on gpu), removing most of the per-token python
+    overhead. Prompts are right padded to the next bucket length, so that
+    prefill only needs one compiled graph per bucket; all graphs are warmed
+    up at startup.
+
+    The cache holds a single sequence, so requests are served one at a time,
+    by one long-lived worker thread: the cuda graphs of `reduce-overhead`
+    are thread local, so the graphs recorded by the warmup are only replayed
+    by the thread which recorded them.
+
+    Args:
+        model: The pre-trained model, which must support `StaticCache`.
+        max_model_length: The number of tokens the kv cache holds.
+        min_bucket_length: The smallest prefill bucket, buckets double up to `max_model_length`.
+    """
+
+    def __init__(
+        self,
+        model: "PreTrainedModel",
+        max_model_length: int,
+        min_bucket_length: int = 64,
+    ) -> None:
+        try:
+            from transformers import StaticCache
+        except ImportError:
+            raise ValueError("Static kv cache requires transformers>=4.38.0")
+
+        if not getattr(model, "_supports_static_cache", False):
+            raise ValueError(f"{model.config.model_type} models do not support a static kv cache")
+
+        self.model = model
+        self.max_model_length = max_model_length
+        self.device = next(model.parameters()).device
+        self.cache = StaticCache(model.config, 1, max_model_length, self.device, model.dtype)
+
+        self.buckets: List[int] = []
+        length = min(min_bucket_length, max_model_length)
+        while length < max_model_length:
+            self.buckets.append(length)
+            length *= 2
+        self.buckets.append(max_model_length)
+
+        # one graph per prefill bucket, plus the decoding step
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(self.buckets) + 2
+        )
+        self._prefill = torch.compile(self._forward, dynamic=False)
+        self._decode = torch.compile(self._forward, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+        self._jobs: Queue = Queue()
+        self._worker = Thread(target=self._work, name="static-cache", daemon=True)
+        self._worker.start()
+
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.decode_time = 0.0
+
+    def _forward(self, input_ids: torch.Tensor, cache_position: torch.Tensor) -> torch.Tensor:
+        return self.model(
+            input_ids=input_ids,
+            position_ids=cache_position[None, :],
+            cache_position=cache_position,
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=False,
+        )[0]
+
+    def _work(self) -> None:
+        while True:
+            fn, args, future = self._jobs.get()
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _submit(self, fn: Callable[..., Any], *args: Any) -> Future:
+        """ Run `fn` on the worker thread. """
+        future = Future()
+        self._jobs.put((fn, args, future))
+        return future
+
+    def warmup(self) -> None:
+        """ Compile the prefill graph of every bucket and the decoding step, on the worker thread. """
+        start = time.perf_counter()
+        self._submit(self._warmup).result()
+        logger.info(f"Compiled {len(self.buckets)} prefill buckets in {time.perf_counter() - start:.1f}s")
+
+    @torch.inference_mode()
+    def _warmup(self) -> None:
+        for length in self.buckets:
+            self.cache.reset()
+            input_ids = torch.zeros(1, length, dtype=torch.long, device=self.device)
+            self._prefill(input_ids, torch.arange(length, device=self.device))
+
+        for _ in range(3):  # cuda graphs are recorded after a few runs
+            input_ids = torch.zeros(1, 1, dtype=torch.long, device=self.device)
+            self._decode(input_ids, torch.tensor([1], device=self.device))
+        self.cache.reset()
+
+    def generate_stream(
+        self,
+        model: "PreTrainedModel",
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[Dict[str, Any]]:
+        """ Same contract as `api.templates.stream.generate_stream`. """
+        inputs = params.get("inputs")
+        yield from decode_stream(tokenizer, self.generate(tokenizer, params), params, len(inputs))
+
+    def generate(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+    ) -> Iterator[List[int]]:
+        """
+        Yields the new token id of every step, decoded on the worker thread.
+        Errors of the generation are raised here, and the decoding stops once
+        this iterator is closed (e.g. when a stop string is found).
+        """
+        streamer, stop = TokenIdStreamer(), Event()
+        self._submit(self._generate, tokenizer, params, streamer, stop)
+        try:
+            yield from streamer
+        finally:
+            stop.set()
+
+    def _generate(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+        streamer: TokenIdStreamer,
+        stop: Event,
+    ) -> None:
+        try:
+            self._decode_tokens(tokenizer, params, streamer, stop)
+        except Exception as e:
+            logger.exception("Static kv cache generation failed")
+            streamer.error(e)  # raised by the consumer, e.g. into the OOM handling of the engine
+        finally:
+            streamer.end()
+
+    @torch.inference_mode()
+    def _decode_tokens(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+        streamer: TokenIdStreamer,
+        stop: Event,
+    ) -> None:
+        token_ids = list(params.get("inputs"))
+        temperature = float(params.get("temperature", 1.0))
+        repetition_penalty = float(params.get("repetition_penalty", 1.0))
+        top_p = float(params.get("top_p", 1.0))
+        top_k = int(params.get("top_k", 50))
+        max_new_tokens = min(
+            int(params.get("max_tokens", 256)),
+            self.max_model_length - len(token_ids),
+        )
+
+        stop_token_ids = set(params.get("stop_token_ids") or [])
+        stop_token_ids.add(tokenizer.eos_token_id)
+        cancel_event = params.get("cancel_event")
+
+        greedy = temperature <= 1e-5
+        logits_processor = prepare_logits_processor(temperature, repetition_penalty, top_p, top_k)
+
+        def stopped() -> bool:
+            return stop.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+        streamer.put(torch.as_tensor(token_ids))
+        if max_new_tokens <= 0 or stopped():
+            return
+        self.cache.reset()
+        self.num_requests += 1
+
+        # right padding is never attended, the decoding steps overwrite it
+        length = len(token_ids)
+        bucket = next(b for b in self.buckets if b >= length)
+        input_ids = torch.zeros(1, bucket, dtype=torch.long, device=self.device)
+        input_ids[0, :length] = torch.as_tensor(token_ids, device=self.device)
+        logits = self._prefill(input_ids, torch.arange(bucket, device=self.device))[:, length - 1]
+
+        start = time.perf_counter()
+        for i in range(max_new_tokens):
+            if logits_processor:
+                logits = logits_processor(torch.as_tensor([token_ids], device=logits.device), logits)
+            if greedy:
+                token = int(torch.argmax(logits[0]))
+            else:
+                probs = torch.softmax(logits[0].float(), dim=-1)
+                token = int(torch.multinomial(probs, num_samples=1))
+
+            if token in stop_token_ids:
+                break
+            token_ids.append(token)
+            self.num_tokens += 1
+            streamer.put(torch.as_tensor([token]))
+
+            if i == max_new_tokens - 1 or stopped():
+                break
+            logits = self._decode(
+                torch.tensor([[token]], device=self.device),
+                torch.tensor([len(token_ids) - 1], device=self.device),
+            )[:, -1].clone()  # cuda graph outputs are overwritten by the next replay
+        self.decode_time += time.perf_counter() - start
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_model_length": self.max_model_length,
+            "buckets": self.buckets,
+            "num_requests": self.num_requests,
+            "num_tokens": self.num_tokens,
+            "tokens_per_second": self.num_tokens / self.decode_time if self.decode_time else 0.0,
+        }
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+)
+
+
+class WorkloadExecutor(ThreadPoolExecutor):
+    """
+    A bounded pool of worker threads for one class of blocking work (llm,
+    embedding, rerank, ingestion), so that a burst of one class, e.g. the
+    parsing of large PDFs, can't starve the others of the threadpool of anyio.
+    At most `max_workers` calls of the class run at once, the others wait in
+    its queue.
+    """
+
+    def __init__(self, name: str, max_workers: int) -> None:
+        super().__init__(max_workers=max_workers, thread_name_prefix=f"{name}-worker")
+        self.name = name
+        self.max_workers = max_workers
+        self._stats_lock = Lock()
+
+        self.num_queued = 0
+        self.num_running = 0
+        self.num_completed = 0
+        self.avg_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        with self._stats_lock:
+            self.num_queued += 1
+        return super().submit(self._run, time.monotonic(), fn, args, kwargs)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """ Runs `fn` on a worker thread of the pool and returns its result. """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self, partial(fn, *args, **kwargs))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "num_queued": self.num_queued,
+            "num_running": self.num_running,
+            "num_completed": self.num_completed,
+            "avg_wait_time": self.avg_wait_time,
+            "max_wait_time": self.max_wait_time,
+        }
+
+    def _run(self, submitted_at: float, fn: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> Any:
+        wait_time = time.monotonic() - submitted_at
+        with self._stats_lock:
+            self.num_queued -= 1
+            self.num_running += 1
+            self.avg_wait_time = 0.9 * self.avg_wait_time + 0.1 * wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._stats_lock:
+                self.num_running -= 1
+                self.num_completed += 1
@@ -0,0 +1,17 @@
+from collections import OrderedDict
+from typing import (
+    Any,
+    Callable,
+    Dict,
+)
+
+METRICS: Dict[str, Callable[[], Dict[str, Any]]] = OrderedDict()
+
+
+def register_metrics(name: str, fn: Callable[[], Dict[str, Any]]) -> None:
+    """ Register a callable returning the current stats of a component. """
+    METRICS[name] = fn
+
+
+def collect_metrics() -> Dict[str, Dict[str, Any]]:
+    return {name: fn() for name, fn in METRICS.items()}
@@ -4,8 +4,10 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 
+from api.admission import AdmissionController
 from api.common import dictify
 from api.config import SETTINGS
+from api.metrics import register_metrics
 
 
 def create_app() -> FastAPI:
@@ -22,7 +24,15 @@ def create_app() -> FastAPI:
             torch.cuda.ipc_collect()
 
     @asynccontextmanager
-    async def lifespan(app: "FastAPI"):  # collects GPU memory
+    async def lifespan(app: "FastAPI"):  # resumes the saved batches, collects GPU memory
+        # all models are loaded now: keep them out of the reach of the garbage collector,
+        # so that the collections during requests are short
+        gc.collect()
+        gc.freeze()
+        # set by the server once the batch api is registered
+        batch_runner = getattr(app.state, "batch_runner", None)
+        if batch_runner is not None:
+            await batch_runner.start()
         yield
         torch_gc()
 
@@ -59,9 +69,18 @@ def create_rag_models():
     return rag_models if len(rag_models) == 2 else [None, None]
 
 
+def create_executor(name: str, max_workers: int):
+    """ get bounded worker threads for one class of blocking work. """
+    from api.executors import WorkloadExecutor
+
+    executor = WorkloadExecutor(name, max_workers)
+    register_metrics(f"{name}_executor", executor.stats)
+    return executor
+
+
 def create_hf_llm():
     """ get generate model for chat or completion. """
-    from api.engine.hf import HuggingFaceEngine
+    from api.engine.hf import AsyncHuggingFaceEngine
     from api.adapter.loader import load_model_and_tokenizer
 
     include = {
@@ -78,15 +97,111 @@ def create_hf_llm():
         model_name_or_path=SETTINGS.model_path, **kwargs,
     )
 
+    draft_model = None
+    if SETTINGS.draft_model_path:
+        draft_model, _ = load_model_and_tokenizer(
+            model_name_or_path=SETTINGS.draft_model_path, **kwargs,
+        )
+
+    response_cache = None
+    if SETTINGS.enable_response_cache:
+        from api.cache import ResponseCache
+
+        response_cache = ResponseCache(
+            int(SETTINGS.response_cache_memory * (1 << 20)),
+            ttl=SETTINGS.response_cache_ttl if SETTINGS.response_cache_ttl >= 0 else None,
+            disk_path=SETTINGS.response_cache_path,
+            max_disk_size=int(SETTINGS.response_cache_disk_size * (1 << 20)),
+        )
+        register_metrics("response_cache", response_cache.stats)
+
+    semantic_cache = None
+    if SETTINGS.enable_semantic_cache:
+        if EMBEDDING_MODEL is None:
+            logger.warning("Semantic cache needs an embedding model (TASKS=llm,rag and EMBEDDING_NAME), ignored.")
+        else:
+            from api.cache import SemanticCache
+
+            semantic_cache = SemanticCache(
+                EMBEDDING_MODEL,
+                threshold=SETTINGS.semantic_cache_threshold,
+                max_entries=SETTINGS.semantic_cache_size,
+                ttl=SETTINGS.response_cache_ttl if SETTINGS.response_cache_ttl >= 0 else None,
+            )
+            register_metrics("semantic_cache", semantic_cache.stats)
+
     logger.info("Using HuggingFace Engine")
 
-    return HuggingFaceEngine(
+    executor = create_executor(
+        "llm", SETTINGS.llm_workers if SETTINGS.llm_workers > 0 else SETTINGS.max_num_seqs
+    )
+
+    engine = AsyncHuggingFaceEngine(
         model,
         tokenizer,
         model_name=SETTINGS.model_name,
         max_model_length=SETTINGS.context_length if SETTINGS.context_length > 0 else None,
         template_name=SETTINGS.chat_template,
+        continuous_batching=SETTINGS.continuous_batching,
+        max_num_seqs=SETTINGS.max_num_seqs,
+        max_num_batched_tokens=SETTINGS.max_num_batched_tokens if SETTINGS.max_num_batched_tokens > 0 else None,
+        prefix_cache_memory=int(SETTINGS.prefix_cache_memory * (1 << 30)) if SETTINGS.enable_prefix_caching else None,
+        prefill_chunk_size=SETTINGS.prefill_chunk_size if SETTINGS.prefill_chunk_size > 0 else None,
+        draft_model=draft_model,
+        num_speculative_tokens=SETTINGS.num_speculative_tokens,
+        prompt_lookup_max_ngram=SETTINGS.prompt_lookup_max_ngram if SETTINGS.prompt_lookup_decoding else None,
+        memory_high_watermark=SETTINGS.memory_high_watermark,
+        memory_low_watermark=SETTINGS.memory_low_watermark,
+        reserve_memory=int(SETTINGS.reserve_memory * (1 << 30)),
+        static_cache=SETTINGS.enable_static_cache,
+        response_cache=response_cache,
+        semantic_cache=semantic_cache,
+        executor=executor,
+    )
+    if engine.scheduler is not None:
+        register_metrics("scheduler", engine.scheduler.stats)
+    if engine.speculative_decoder is not None:
+        register_metrics("speculative_decoding", engine.speculative_decoder.stats)
+    if engine.static_cache_decoder is not None:
+        register_metrics("static_cache", engine.static_cache_decoder.stats)
+    register_metrics("memory", engine.memory_manager.stats)
+    return engine
+
+
+def create_admission_controller():
+    """ get admission controller which bounds concurrent generations. """
+    controller = AdmissionController(
+        max_concurrency=SETTINGS.max_concurrent_requests if SETTINGS.max_concurrent_requests > 0 else None,
+        max_queue_size=SETTINGS.max_queue_size,
+        queue_timeout=SETTINGS.queue_timeout,
+    )
+    register_metrics("admission", controller.stats)
+    return controller
+
+
+def create_request_coalescer():
+    """ get request coalescer which shares generations between identical concurrent requests. """
+    from api.coalescing import RequestCoalescer
+
+    coalescer = RequestCoalescer(enabled=SETTINGS.enable_request_coalescing)
+    register_metrics("coalescing", coalescer.stats)
+    return coalescer
+
+
+def create_batch_runner():
+    """ get batch runner which serves the batch api in the background. """
+    from api.batch import BatchRunner
+    from api.config import BATCH_LOCAL_PATH, STORAGE_LOCAL_PATH
+
+    runner = BatchRunner(
+        LLM_ENGINE,
+        STORAGE_LOCAL_PATH,
+        BATCH_LOCAL_PATH,
+        max_concurrency=SETTINGS.max_num_seqs,
+        admission_controller=ADMISSION_CONTROLLER,
     )
+    register_metrics("batch", runner.stats)
+    return runner
 
 
 def create_vllm_engine():
@@ -111,6 +226,7 @@ def create_vllm_engine():
         "enforce_eager",
         "lora_extra_vocab_size",
         "disable_custom_all_reduce",
+        "enable_prefix_caching",
     }
 
     if vllm_version >= "0.4.3":
@@ -145,11 +261,23 @@ app = create_app()
 # model for rag
 EMBEDDING_MODEL, RERANK_MODEL = create_rag_models()
 
+# separate worker threads for the blocking work of the rag models and of the file parsing
+EMBEDDING_EXECUTOR = create_executor("embedding", SETTINGS.embedding_workers) if EMBEDDING_MODEL else None
+RERANK_EXECUTOR = create_executor("rerank", SETTINGS.rerank_workers) if RERANK_MODEL else None
+INGESTION_EXECUTOR = create_executor("ingestion", SETTINGS.ingestion_workers)
+
 # llm
 if "llm" in SETTINGS.tasks and SETTINGS.activate_inference:
     if SETTINGS.engine == "default":
         LLM_ENGINE = create_hf_llm()
     elif SETTINGS.engine == "vllm":
         LLM_ENGINE = create_vllm_engine()
+    register_metrics("token_cache", LLM_ENGINE.template.token_cache.stats)
+    ADMISSION_CONTROLLER = create_admission_controller()
+    REQUEST_COALESCER = create_request_coalescer()
+    BATCH_RUNNER = create_batch_runner() if SETTINGS.engine == "default" else None
 else:
     LLM_ENGINE = None
+    ADMISSION_CONTROLLER = None
+    REQUEST_COALESCER = None
+    BATCH_RUNNER = None
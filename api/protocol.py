@@ -63,6 +63,14 @@ class ErrorResponse(BaseModel):
     code: int
 
 
+class StreamOptions(BaseModel):
+    flush_interval: Optional[float] = None
+    """Milliseconds the content deltas are merged before being sent, overrides `STREAM_FLUSH_INTERVAL`."""
+
+    flush_tokens: Optional[int] = None
+    """Max number of content deltas merged into one chunk, overrides `STREAM_FLUSH_TOKENS`."""
+
+
 class ChatCompletionCreateParams(BaseModel):
     messages: List[Dict[str, Any]]
     """A list of messages comprising the conversation so far.
@@ -226,6 +234,9 @@ class ChatCompletionCreateParams(BaseModel):
     [Example Python code](https://cookbook.openai.com/examples/how_to_stream_completions).
     """
 
+    stream_options: Optional[StreamOptions] = None
+    """Options for streaming response. Only set this when you set `stream: true`."""
+
     # Addictional parameters
     repetition_penalty: Optional[float] = 1.03
     """The parameter for repetition penalty. 1.0 means no penalty.
@@ -442,6 +453,9 @@ class CompletionCreateParams(BaseModel):
     [Example Python code](https://cookbook.openai.com/examples/how_to_stream_completions).
     """
 
+    stream_options: Optional[StreamOptions] = None
+    """Options for streaming response. Only set this when you set `stream: true`."""
+
     # Addictional parameters
     repetition_penalty: Optional[float] = 1.03
     """The parameter for repetition penalty. 1.0 means no penalty.
@@ -490,6 +504,19 @@ class CompletionCreateParams(BaseModel):
     guided_decoding_backend: Optional[str] = None
 
 
+class BatchCreateParams(BaseModel):
+    input_file_id: str
+    """The ID of an uploaded JSONL file of requests, one per line."""
+
+    endpoint: Literal["/v1/chat/completions", "/v1/completions"]
+    """The endpoint to be used for all requests in the batch."""
+
+    completion_window: Literal["24h"] = "24h"
+    """The time frame within which the batch should be processed."""
+
+    metadata: Optional[Dict[str, str]] = None
+
+
 class EmbeddingCreateParams(BaseModel):
     input: Union[str, List[str], List[int], List[List[int]]]
     """Input text to embed, encoded as a string or array of tokens.
@@ -0,0 +1,50 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends, status
+from openai.pagination import SyncPage
+from openai.types.batch import Batch
+
+from api.models import BATCH_RUNNER
+from api.protocol import BatchCreateParams
+from api.utils import check_api_key
+
+batch_router = APIRouter(prefix="/batches")
+
+
+@batch_router.post(
+    "",
+    dependencies=[Depends(check_api_key)],
+    status_code=status.HTTP_200_OK,
+    response_model=Batch,
+)
+async def create_batch(request: BatchCreateParams):
+    return BATCH_RUNNER.create(request)
+
+
+@batch_router.get(
+    "/{batch_id}",
+    dependencies=[Depends(check_api_key)],
+    status_code=status.HTTP_200_OK,
+    response_model=Batch,
+)
+async def retrieve_batch(batch_id: str):
+    return BATCH_RUNNER.retrieve(batch_id)
+
+
+@batch_router.post(
+    "/{batch_id}/cancel",
+    dependencies=[Depends(check_api_key)],
+    status_code=status.HTTP_200_OK,
+    response_model=Batch,
+)
+async def cancel_batch(batch_id: str):
+    return BATCH_RUNNER.cancel(batch_id)
+
+
+@batch_router.get(
+    "",
+    dependencies=[Depends(check_api_key)],
+    status_code=status.HTTP_200_OK,
+)
+async def list_batches(after: Optional[str] = None, limit: int = 20):
+    return SyncPage(data=BATCH_RUNNER.list(after, limit), object="list")
@@ -1,5 +1,11 @@
 from functools import partial
-from typing import Iterator
+from threading import Event
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Optional,
+)
 
 import anyio
 from fastapi import (
@@ -7,20 +13,22 @@ from fastapi import (
     Depends,
     Request,
     HTTPException,
+    Response,
     status,
 )
 from loguru import logger
 from sse_starlette import EventSourceResponse
-from starlette.concurrency import run_in_threadpool
 
 from api.common import dictify
-from api.engine.hf import HuggingFaceEngine
-from api.models import LLM_ENGINE
+from api.engine.hf import AsyncHuggingFaceEngine
+from api.models import LLM_ENGINE, ADMISSION_CONTROLLER, REQUEST_COALESCER
 from api.protocol import CompletionCreateParams
 from api.utils import (
     check_completion_requests,
     check_api_key,
     get_event_publisher,
+    DisconnectWatcher,
+    parse_prompt_format,
 )
 
 completion_router = APIRouter()
@@ -38,12 +46,11 @@ def get_engine():
 async def create_completion(
     request: CompletionCreateParams,
     raw_request: Request,
-    engine: HuggingFaceEngine = Depends(get_engine),
+    engine: AsyncHuggingFaceEngine = Depends(get_engine),
 ):
-    if isinstance(request.prompt, str):
-        request.prompt = [request.prompt]
-
-    if len(request.prompt) < 1:
+    try:
+        _, prompts = parse_prompt_format(request.prompt)
+    except ValueError:
         raise HTTPException(status_code=400, detail="Invalid request")
 
     request = await check_completion_requests(
@@ -55,21 +62,40 @@ async def create_completion(
     request.max_tokens = request.max_tokens or 128
 
     params = dictify(request, exclude={"prompt"})
-    params.update(dict(prompt_or_messages=request.prompt[0]))
+    # several prompts are generated in one batch, with one choice per prompt
+    params.update(dict(prompt_or_messages=prompts[0] if len(prompts) == 1 else prompts))
     logger.debug(f"==== request ====\n{params}")
 
-    iterator_or_completion = await run_in_threadpool(engine.create_completion, params)
+    cancel_event = Event()
+    params["cancel_event"] = cancel_event
+
+    # identical deterministic requests in flight share one generation, and its generation slot
+    key = REQUEST_COALESCER.key("completion", params)
+    ticket = await REQUEST_COALESCER.admit(key, ADMISSION_CONTROLLER)
+    return await ADMISSION_CONTROLLER.hold(
+        ticket, _create_completion(engine, request, raw_request, params, key, cancel_event)
+    )
 
-    if isinstance(iterator_or_completion, Iterator):
-        # It's easier to ask for forgiveness than permission
-        first_response = await run_in_threadpool(next, iterator_or_completion)
 
-        # If no exception was raised from first_response, we can assume that
-        # the iterator is valid, and we can use it to stream the response.
-        def iterator() -> Iterator:
-            yield first_response
-            yield from iterator_or_completion
+async def _create_completion(
+    engine: AsyncHuggingFaceEngine,
+    request: CompletionCreateParams,
+    raw_request: Request,
+    params: Dict[str, Any],
+    key: Optional[str],
+    cancel_event: Event,
+):
+    # a client leaving before the response is ready stops its generation, or leaves the shared one
+    async with DisconnectWatcher(raw_request) as watcher:
+        iterator_or_completion = await REQUEST_COALESCER.run(
+            key,
+            partial(engine.acreate_completion, params),
+            cancel_event,
+        )
+    if watcher.disconnected:
+        return Response(status_code=499)
 
+    if isinstance(iterator_or_completion, AsyncIterator):
         send_chan, recv_chan = anyio.create_memory_object_stream(10)
         return EventSourceResponse(
             recv_chan,
@@ -77,7 +103,10 @@ async def create_completion(
                 get_event_publisher,
                 request=raw_request,
                 inner_send_chan=send_chan,
-                iterator=iterator(),
+                iterator=iterator_or_completion,
+                # a shared generation is cancelled by the coalescer once all its clients have gone
+                cancel_event=cancel_event if key is None else None,
+                stream_options=request.stream_options,
             ),
         )
     else:
@@ -2,7 +2,7 @@ import tiktoken
 from fastapi import APIRouter, Depends, status
 
 from api.config import SETTINGS
-from api.models import EMBEDDING_MODEL
+from api.models import EMBEDDING_MODEL, EMBEDDING_EXECUTOR
 from api.protocol import EmbeddingCreateParams
 from api.rag import RAGEmbedding
 from api.utils import check_api_key
@@ -44,7 +44,8 @@ async def create_embeddings(
 
     request.dimensions = request.dimensions or getattr(SETTINGS, "embedding_size", -1)
 
-    return client.embed(
+    return await EMBEDDING_EXECUTOR.run(
+        client.embed,
         texts=request.input,
         model=request.model,
         encoding_format=request.encoding_format,
@@ -8,6 +8,7 @@ from typing import (
 
 import requests
 from fastapi import APIRouter, HTTPException, UploadFile
+from fastapi.responses import FileResponse
 from langchain.docstore.document import Document
 from langchain_community.document_loaders import TextLoader
 from openai.pagination import SyncPage
@@ -16,6 +17,7 @@ from openai.types.file_object import FileObject
 from pydantic import BaseModel
 
 from api.config import STORAGE_LOCAL_PATH
+from api.models import INGESTION_EXECUTOR
 from api.rag.processors import (
     get_loader,
     make_text_splitter,
@@ -47,8 +49,7 @@ async def upload_file(file: UploadFile):
     file_id = "file-" + str(secrets.token_hex(12)).replace("-", "_")
     filename = file.filename
     filepath = os.path.join(STORAGE_LOCAL_PATH, f"{file_id}_{filename}")
-    with open(filepath, "wb") as f:
-        f.write(file.file.read())
+    await INGESTION_EXECUTOR.run(_save_file, file, filepath)
     return FileObject(
         id=file_id,
         bytes=os.path.getsize(filepath),
@@ -80,6 +81,15 @@ async def get_details(file_id: str):
         raise HTTPException(status_code=404, detail=f"File {file_id} not found!")
 
 
+@file_router.get("/{file_id}/content")
+async def get_content(file_id: str):
+    file = _find_file(file_id)
+    if file:
+        return FileResponse(os.path.join(STORAGE_LOCAL_PATH, file))
+    else:
+        raise HTTPException(status_code=404, detail=f"File {file_id} not found!")
+
+
 @file_router.get("")
 async def list_files():
     data = []
@@ -117,6 +127,16 @@ async def delete_file(file_id: str):
 
 @file_router.post("/split", response_model=File2DocsResponse)
 async def split_into_docs(request: File2DocsRequest):
+    # parsing large files is slow, it runs on the ingestion threads to not hold up the other requests
+    return await INGESTION_EXECUTOR.run(_split_into_docs, request)
+
+
+def _save_file(file: UploadFile, filepath: str) -> None:
+    with open(filepath, "wb") as f:
+        f.write(file.file.read())
+
+
+def _split_into_docs(request: File2DocsRequest):
     if request.url is not None:
         # https://github.com/jina-ai/reader
         try:
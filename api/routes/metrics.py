@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Depends, status
+
+from api.metrics import collect_metrics
+from api.utils import check_api_key
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get(
+    "/metrics",
+    dependencies=[Depends(check_api_key)],
+    status_code=status.HTTP_200_OK,
+)
+async def show_metrics():
+    return collect_metrics()
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends, status
 
-from api.models import RERANK_MODEL
+from api.models import RERANK_MODEL, RERANK_EXECUTOR
 from api.protocol import RerankRequest
 from api.rag import RAGReranker
 from api.utils import check_api_key
@@ -18,7 +18,8 @@ def get_embedding_engine():
     status_code=status.HTTP_200_OK,
 )
 async def create_rerank(request: RerankRequest, client: RAGReranker = Depends(get_embedding_engine)):
-    return client.rerank(
+    return await RERANK_EXECUTOR.run(
+        client.rerank,
         query=request.query,
         documents=request.documents,
         top_n=request.top_n,
@@ -1,6 +1,9 @@
+from loguru import logger
+
 from api.config import SETTINGS
 from api.models import (
     app,
+    BATCH_RUNNER,
     EMBEDDING_MODEL,
     LLM_ENGINE,
     RERANK_MODEL,
@@ -14,6 +17,8 @@ if EMBEDDING_MODEL is not None:
 
     app.include_router(embedding_router, prefix=prefix, tags=["Embedding"])
 
+file_router = None
+if EMBEDDING_MODEL is not None or BATCH_RUNNER is not None:
     try:
         from api.routes.file import file_router
 
@@ -43,6 +48,20 @@ if LLM_ENGINE is not None:
     app.include_router(chat_router, prefix=prefix, tags=["Chat Completion"])
     app.include_router(completion_router, prefix=prefix, tags=["Completion"])
 
+if BATCH_RUNNER is not None:
+    # batches are uploaded and downloaded through the files api
+    if file_router is None:
+        logger.error("The batch api needs the files api, which is unavailable (install langchain), disabled.")
+    else:
+        from api.routes.batch import batch_router
+
+        app.include_router(batch_router, prefix=prefix, tags=["Batch"])
+        app.state.batch_runner = BATCH_RUNNER
+
+from api.routes.metrics import metrics_router
+
+app.include_router(metrics_router, prefix=prefix, tags=["Metrics"])
+
 
 if __name__ == "__main__":
     import uvicorn
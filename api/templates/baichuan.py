@@ -14,7 +14,7 @@ from openai.types.chat import ChatCompletionMessageParam
 from api.protocol import Role
 from api.templates.base import ChatTemplate
 from api.templates.registry import register_template
-from api.templates.utils import parse_messages
+from api.templates.utils import TokenCache, parse_messages
 
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, BatchEncoding
@@ -24,7 +24,8 @@ def build_baichuan_chat_input(
     tokenizer: "PreTrainedTokenizer",
     messages: List[ChatCompletionMessageParam],
     context_len: int = 4096,
-    max_new_tokens: int = 256
+    max_new_tokens: int = 256,
+    token_cache: Optional[TokenCache] = None,
 ) -> List[int]:
     """
     Builds the input tokens for the Baichuan chat model based on the given messages.
@@ -37,13 +38,19 @@ def build_baichuan_chat_input(
         messages: A list of ChatCompletionMessageParam objects representing the chat messages.
         context_len: The maximum length of the context (default=4096).
         max_new_tokens: The maximum number of new tokens to be added (default=256).
+        token_cache: Optional cache of the tokens of every message.
 
     Returns:
         List[int]: The input tokens for the Baichuan chat model.
     """
+    def _encode(role, content):
+        if token_cache is None:
+            return tokenizer.encode(content)
+        return token_cache.encode(role, content, lambda: tokenizer.encode(content))
+
     max_input_tokens = context_len - max_new_tokens
     system, rounds = parse_messages(messages)
-    system_tokens = tokenizer.encode(system)
+    system_tokens = _encode(Role.SYSTEM.value, system)
     max_history_tokens = max_input_tokens - len(system_tokens)
 
     history_tokens = []
@@ -54,7 +61,7 @@ def build_baichuan_chat_input(
                 round_tokens.append(195)
             else:
                 round_tokens.append(196)
-            round_tokens.extend(tokenizer.encode(message["content"]))
+            round_tokens.extend(_encode(message["role"], message["content"]))
 
         if len(history_tokens) == 0 or len(history_tokens) + len(round_tokens) <= max_history_tokens:
             history_tokens = round_tokens + history_tokens  # concat left
@@ -88,6 +95,7 @@ class BaiChuanChatTemplate(ChatTemplate):
             messages,
             self.model_max_length,
             max_tokens,
+            token_cache=self.token_cache,
         )
 
     @property
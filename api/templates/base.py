@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 from abc import ABC
 from typing import (
     Any,
@@ -14,9 +15,15 @@ from typing import (
 
 from openai.types.chat import ChatCompletionMessageParam
 
+from api.protocol import Role
+from api.templates.utils import TokenCache
+
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, BatchEncoding
 
+# tokens added around every message by the templates (markers, separators), roughly
+MESSAGE_OVERHEAD = 8
+
 
 class ChatTemplate(ABC):
     """Base class for chat template"""
@@ -33,6 +40,8 @@ class ChatTemplate(ABC):
     ) -> None:
         self.tokenizer = tokenizer
         self.model_max_length = model_max_length
+        # token ids of the messages seen in previous requests, used by the templates that tokenize per message
+        self.token_cache = TokenCache()
 
     def convert_messages_to_ids(
         self,
@@ -43,6 +52,8 @@ class ChatTemplate(ABC):
         max_window_size: Optional[int] = 6144,
         **kwargs,
     ) -> Union[List[int], "BatchEncoding"]:
+        min_max_tokens = 256
+        messages = self.truncate_messages(messages, tools, self.model_max_length - min_max_tokens)
         try:
             token_ids = self._convert_messages_to_ids(
                 messages,
@@ -61,7 +72,6 @@ class ChatTemplate(ABC):
             )
 
         input_len = len(token_ids)
-        min_max_tokens = 256
         if input_len > self.model_max_length - min_max_tokens:
             max_input_tokens = self.model_max_length - min_max_tokens
         else:
@@ -69,6 +79,60 @@ class ChatTemplate(ABC):
 
         return token_ids[-max_input_tokens:]
 
+    def truncate_messages(
+        self,
+        messages: List[ChatCompletionMessageParam],
+        tools: Optional[List[Dict[str, Any]]] = None,
+        max_input_tokens: Optional[int] = None,
+    ) -> List[ChatCompletionMessageParam]:
+        """
+        Drops the oldest turns (a user message and the messages answering it)
+        which do not fit in `max_input_tokens`, before the conversation is
+        rendered. The system messages, the tools and the last turn are always
+        kept. The tokens of every message are counted from the newest one and
+        cached, so the dropped messages are never tokenized.
+        """
+        if self.tokenizer is None or max_input_tokens is None:
+            return messages
+
+        budget = max_input_tokens
+        if tools:
+            budget -= self._count_tokens(json.dumps(tools, ensure_ascii=False))
+
+        turns: List[List[int]] = []
+        for i, message in enumerate(messages):
+            if message["role"] == Role.SYSTEM.value:
+                budget -= self._count_message_tokens(message)
+            elif message["role"] == Role.USER.value or not turns:
+                turns.append([i])
+            else:
+                turns[-1].append(i)
+
+        num_dropped = len(turns)
+        for j in range(len(turns) - 1, -1, -1):
+            cost = sum(self._count_message_tokens(messages[i]) for i in turns[j])
+            if cost > budget and j < len(turns) - 1:
+                break
+            budget -= cost
+            num_dropped = j
+
+        if num_dropped == 0:
+            return messages
+        dropped = {i for turn in turns[:num_dropped] for i in turn}
+        return [message for i, message in enumerate(messages) if i not in dropped]
+
+    def _count_message_tokens(self, message: ChatCompletionMessageParam) -> int:
+        content = message.get("content") or ""
+        if not isinstance(content, str):  # text parts of a multimodal message
+            content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+        for key in ("function_call", "tool_calls"):
+            if message.get(key):
+                content += json.dumps(message[key], ensure_ascii=False)
+        return self._count_tokens(content) + self._count_tokens(message["role"]) + MESSAGE_OVERHEAD
+
+    def _count_tokens(self, text: str) -> int:
+        return self.token_cache.count(text, lambda: self.tokenizer.encode(text, add_special_tokens=False))
+
     def _convert_messages_to_ids(
         self,
         messages: List[ChatCompletionMessageParam],
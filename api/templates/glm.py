@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import gc
 import json
 import re
 import time
@@ -23,7 +22,7 @@ from transformers.generation.logits_process import LogitsProcessor
 from api.protocol import ChatCompletionMessageParam, Role
 from api.templates.base import ChatTemplate
 from api.templates.registry import register_template
-from api.templates.utils import apply_stopping_strings
+from api.templates.utils import IncrementalDetokenizer, StopStringMatcher, TokenCache
 
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, PreTrainedModel, BatchEncoding
@@ -108,15 +107,15 @@ def generate_stream_chatglm(
         gen_kwargs["temperature"] = temperature
 
     total_len, previous_text = 0, ""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    start = 0 if echo else input_echo_len
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
     created: int = int(time.time())
     for total_ids in model.stream_generate(input_ids, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
+        total_len = total_ids.shape[-1]
 
-        output_ids = total_ids if echo else total_ids[input_echo_len:]
-        response = tokenizer.decode(output_ids)
-        response = process_response(response)
+        detokenizer.add_tokens(total_ids[0, start + len(detokenizer.token_ids):].tolist())
+        response = process_response(detokenizer.text)
 
         delta_text = response[len(previous_text):]
         previous_text = response
@@ -154,9 +153,6 @@ def generate_stream_chatglm(
         },
     }
 
-    gc.collect()
-    torch.cuda.empty_cache()
-
 
 @torch.inference_mode()
 def generate_stream_chatglm_v3(
@@ -201,17 +197,19 @@ def generate_stream_chatglm_v3(
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
 
-    total_len, previous_text = 0, ""
+    total_len, previous_text, response = 0, "", ""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    matcher = StopStringMatcher(["<|observation|>"])
+    start = 0 if echo else input_echo_len
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
     created: int = int(time.time())
     for total_ids in model.stream_generate(input_ids, eos_token_id=eos_token_id, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
+        total_len = total_ids.shape[-1]
 
-        output_ids = total_ids[:-1] if echo else total_ids[input_echo_len:-1]
-        response = tokenizer.decode(output_ids)
-        if response and response[-1] != "�":
-            response, stop_found = apply_stopping_strings(response, ["<|observation|>"])
+        # the last token is left out, it may be the eos or the <|user|> token
+        delta_text = detokenizer.add_tokens(total_ids[0, start + len(detokenizer.token_ids):-1].tolist())
+        if detokenizer.text:
+            response, stop_found = matcher.truncate(detokenizer.text, delta_text)
 
             delta_text = response[len(previous_text):]
             previous_text = response
@@ -252,9 +250,6 @@ def generate_stream_chatglm_v3(
         },
     }
 
-    gc.collect()
-    torch.cuda.empty_cache()
-
 
 def process_chatglm_messages(
     messages: List[ChatCompletionMessageParam],
@@ -308,6 +303,51 @@ def process_chatglm_messages(
     return messages
 
 
+def build_chatglm3_chat_input(
+    tokenizer: "PreTrainedTokenizer",
+    messages: List[dict],
+    token_cache: Optional[TokenCache] = None,
+) -> List[int]:
+    """
+    Builds the input tokens for ChatGLM3 like `tokenizer.build_chat_input`,
+    taking the tokens of every message from `token_cache` when given.
+
+    Refs:
+        https://huggingface.co/THUDM/chatglm3-6b/blob/main/tokenization_chatglm.py
+
+    Args:
+        tokenizer: The ChatGLM3 tokenizer.
+        messages: The messages processed by `process_chatglm_messages`, the last one is the query.
+        token_cache: Optional cache of the tokens of every message.
+
+    Returns:
+        The list of input tokens.
+    """
+    input_ids = []
+    for i, item in enumerate(messages):
+        role, metadata, content = item["role"], item.get("metadata", ""), item["content"]
+        if i == len(messages) - 1:
+            metadata = ""
+        elif role == Role.SYSTEM.value and "tools" in item:
+            content = content + "\n" + json.dumps(item["tools"], indent=4, ensure_ascii=False)
+
+        if token_cache is None:
+            input_ids.extend(tokenizer.build_single_message(role, metadata, content))
+        else:
+            input_ids.extend(
+                token_cache.encode(
+                    role,
+                    content,
+                    lambda: tokenizer.build_single_message(role, metadata, content),
+                    metadata=metadata,
+                )
+            )
+    input_ids.append(tokenizer.get_command("<|assistant|>"))
+    return tokenizer.batch_encode_plus(
+        [input_ids], return_tensors="pt", is_split_into_words=True
+    )["input_ids"][0].tolist()
+
+
 def process_chatglm_messages_v4(
     messages: List[ChatCompletionMessageParam],
     tools: Optional[List[Dict[str, Any]]] = None,
@@ -412,6 +452,9 @@ class ChatGLM3ChatTemplate(ChatTemplate):
         **kwargs,
     ) -> Union[List[int], BatchEncoding]:
         messages = process_chatglm_messages(messages, tools)
+        if hasattr(self.tokenizer, "build_single_message"):
+            return build_chatglm3_chat_input(self.tokenizer, messages, self.token_cache)
+
         query, role = messages[-1]["content"], messages[-1]["role"]
         return self.tokenizer.build_chat_input(
             query, history=messages[:-1], role=role
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import gc
 import time
 import uuid
 from typing import (
@@ -103,9 +102,6 @@ def generate_stream_minicpm_v(
         },
     }
 
-    gc.collect()
-    torch.cuda.empty_cache()
-
 
 def process_minicpmv_messages(messages: List[ChatCompletionMessageParam]) -> List[Dict]:
     _messages = []
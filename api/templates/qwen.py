@@ -22,6 +22,7 @@ from openai.types.chat import (
 from api.protocol import Role
 from api.templates.base import ChatTemplate
 from api.templates.registry import register_template
+from api.templates.utils import TokenCache
 
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, BatchEncoding
@@ -55,6 +56,7 @@ def build_qwen_chat_input(
     max_window_size: int = 6144,
     functions: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]] = None,
     tools: Optional[List[Dict[str, Any]]] = None,
+    token_cache: Optional[TokenCache] = None,
 ) -> List[int]:
     """
     Builds the input tokens for Qwen chat generation.
@@ -68,6 +70,7 @@ def build_qwen_chat_input(
         max_window_size: The maximum length of the context.
         functions: Optional dictionary or list of dictionaries representing the functions.
         tools: Optional list of dictionaries representing the tools.
+        token_cache: Optional cache of the tokens of every message.
 
     Returns:
         The list of input tokens.
@@ -90,6 +93,12 @@ def build_qwen_chat_input(
                 role, allowed_special=set()
             ) + nl_tokens + tokenizer.encode(content, allowed_special=set())
 
+    if token_cache is not None:
+        _tokenize_uncached = _tokenize_str
+
+        def _tokenize_str(role, content):
+            return token_cache.encode(role, content, lambda: _tokenize_uncached(role, content))
+
     system_tokens_part = _tokenize_str("system", system)
     system_tokens = im_start_tokens + system_tokens_part + im_end_tokens
 
@@ -283,6 +292,7 @@ class QwenChatTemplate(ChatTemplate):
             messages,
             max_window_size,
             tools=tools,
+            token_cache=self.token_cache,
         )
 
     def parse_assistant_response(
@@ -1,20 +1,31 @@
 from __future__ import annotations
 
-import gc
 import time
 import uuid
-from threading import Thread
+from queue import Queue
+from threading import Event, Thread
 from types import MethodType
 from typing import (
     Dict,
     Any,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Union,
     TYPE_CHECKING,
 )
 
 import torch
-from transformers import TextIteratorStreamer
+from transformers.generation.stopping_criteria import StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
 
-from api.templates.utils import apply_stopping_strings
+from api.templates.utils import (
+    CancelledCriteria,
+    IncrementalDetokenizer,
+    StopSequencesCriteria,
+    StopStringMatcher,
+)
 
 if TYPE_CHECKING:
     from transformers import PreTrainedTokenizer, PreTrainedModel
@@ -27,8 +38,6 @@ def generate_stream(
     params: Dict[str, Any],
 ):
     inputs = params.get("inputs")
-    functions = params.get("functions")
-    model_name = params.get("model", "llm")
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
     top_p = float(params.get("top_p", 1.0))
@@ -38,7 +47,6 @@ def generate_stream(
     stop_token_ids = params.get("stop_token_ids") or []
     if tokenizer.eos_token_id not in stop_token_ids:
         stop_token_ids.append(tokenizer.eos_token_id)
-    stop_strings = params.get("stop", [])
 
     device = next(model.parameters()).device
     generation_kwargs = dict(
@@ -62,9 +70,24 @@ def generate_stream(
         generation_kwargs["input_ids"] = torch.tensor([inputs], device=device)
         input_echo_len = len(inputs)
 
-    streamer = TextIteratorStreamer(
-        tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True
-    )
+    # stop on the device instead of decoding every step to look for the stop tokens
+    eos_token_id = model.generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = []
+    elif isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    generation_kwargs["eos_token_id"] = list(dict.fromkeys(stop_token_ids + list(eos_token_id)))
+    stopping_criteria = StoppingCriteriaList()
+    stop_sequences = get_stop_sequences(tokenizer, params.get("stop"))
+    if stop_sequences:
+        stopping_criteria.append(StopSequencesCriteria(stop_sequences, input_echo_len, device))
+    if params.get("cancel_event") is not None:
+        stopping_criteria.append(CancelledCriteria(params["cancel_event"]))
+
+    streamer = TokenIdStreamer(timeout=60.0, skip_token_ids=stop_token_ids)
+    # closing the streamer (e.g. once a stop string is found in the text) stops the generation
+    stopping_criteria.append(CancelledCriteria(streamer.closed))
+    generation_kwargs["stopping_criteria"] = stopping_criteria
     generation_kwargs["streamer"] = streamer
 
     if "GenerationMixin" not in str(model.generate.__func__):
@@ -73,54 +96,179 @@ def generate_stream(
     thread = Thread(target=model.generate, kwargs=generation_kwargs)
     thread.start()
 
-    generated_text, func_call_found = "", False
-    completion_id: str = f"cmpl-{str(uuid.uuid4())}"
-    created: int = int(time.time())
-    previous_text = ""
-    for i, new_text in enumerate(streamer):
-        generated_text += new_text
-        if functions:
-            _, func_call_found = apply_stopping_strings(generated_text, ["Observation:"])
-        generated_text, stop_found = apply_stopping_strings(generated_text, stop_strings)
-
-        if generated_text and generated_text[-1] != "�":
-            delta_text = generated_text[len(previous_text):]
-            previous_text = generated_text
-
-            yield {
-                "id": completion_id,
-                "object": "text_completion",
-                "created": created,
-                "model": model_name,
-                "delta": delta_text,
-                "text": generated_text,
-                "logprobs": None,
-                "finish_reason": "function_call" if func_call_found else None,
-                "usage": {
-                    "prompt_tokens": input_echo_len,
-                    "completion_tokens": i,
-                    "total_tokens": input_echo_len + i,
-                },
-            }
-
-        if stop_found:
-            break
-
-    yield {
-        "id": completion_id,
-        "object": "text_completion",
-        "created": created,
-        "model": model_name,
-        "delta": "",
-        "text": generated_text,
-        "logprobs": None,
-        "finish_reason": "stop",
-        "usage": {
-            "prompt_tokens": input_echo_len,
-            "completion_tokens": i,
-            "total_tokens": input_echo_len + i,
-        },
-    }
-
-    gc.collect()
-    torch.cuda.empty_cache()
+    yield from decode_stream(tokenizer, streamer, params, input_echo_len)
+
+
+def get_stop_sequences(tokenizer: "PreTrainedTokenizer", stop: Optional[Union[str, List[str]]]) -> List[List[int]]:
+    """
+    Returns the token ids of the stop strings, checked on the device. The
+    text matching still decides where the output is cut, since a stop string
+    may be tokenized differently inside the generated text.
+    """
+    if not stop:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+
+    stop_sequences = []
+    for s in stop:
+        token_ids = tokenizer.encode(s, add_special_tokens=False)
+        if token_ids:
+            stop_sequences.append(token_ids)
+    return stop_sequences
+
+
+class TokenIdStreamer(BaseStreamer):
+    """
+    Streamer for `model.generate` yielding the new token ids of every step,
+    which are decoded incrementally by the consumer. The `skip_token_ids`
+    (e.g. the stop tokens ending the generation) are left out. The consumer
+    calls `close` once it needs no more tokens, which sets `closed`.
+    """
+
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        skip_token_ids: Optional[Iterable[int]] = None,
+    ) -> None:
+        self.queue: Queue = Queue()
+        self.timeout = timeout
+        self.skip_token_ids = set(skip_token_ids or [])
+        self.next_tokens_are_prompt = True
+        self.closed = Event()
+
+    def put(self, value: torch.Tensor) -> None:
+        if self.next_tokens_are_prompt:  # the first call receives the prompt
+            self.next_tokens_are_prompt = False
+            return
+        token_ids = [t for t in value.reshape(-1).tolist() if t not in self.skip_token_ids]
+        if token_ids:
+            self.queue.put(token_ids)
+
+    def end(self) -> None:
+        self.queue.put(None)
+
+    def close(self) -> None:
+        """ Stop the generation, e.g. when a stop string was found. """
+        self.closed.set()
+
+    def error(self, e: Exception) -> None:
+        """ Raise `e` in the consumer, e.g. when the generation failed. """
+        self.queue.put(e)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        while True:
+            token_ids = self.queue.get(timeout=self.timeout)
+            if token_ids is None:
+                return
+            if isinstance(token_ids, Exception):
+                raise token_ids
+            yield token_ids
+
+
+class StreamDecoder:
+    """
+    Turns the newly generated token ids of one sequence into text completion
+    outputs, applying the stop strings.
+
+    Args:
+        tokenizer: The tokenizer used for decoding the output tokens.
+        params: A dictionary containing the request parameters.
+        input_echo_len: The number of prompt tokens.
+        index: The index of the sequence among the samples of a request.
+    """
+
+    def __init__(
+        self,
+        tokenizer: "PreTrainedTokenizer",
+        params: Dict[str, Any],
+        input_echo_len: int,
+        index: int = 0,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.model_name = params.get("model", "llm")
+        self.stop_matcher = StopStringMatcher(params.get("stop", []))
+        self.function_matcher = StopStringMatcher(["Observation:"]) if params.get("functions") else None
+        self.input_echo_len = input_echo_len
+        self.index = index
+
+        self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
+        self.generated_text = ""
+        self.previous_text = ""
+        self.func_call_found = False
+        self.stopped = False
+        self.completion_id: str = f"cmpl-{str(uuid.uuid4())}"
+        self.created: int = int(time.time())
+
+    def update(self, new_ids: List[int]) -> Optional[Dict[str, Any]]:
+        """ Returns the output for the new token ids, or `None` if there is no new text yet. """
+        delta_text = self.detokenizer.add_tokens(new_ids)
+        if self.function_matcher is not None and not self.func_call_found:
+            self.func_call_found = self.function_matcher.feed(delta_text) is not None
+        generated_text, self.stopped = self.stop_matcher.truncate(self.detokenizer.text, delta_text)
+        self.generated_text = generated_text
+
+        if not generated_text or generated_text[-1] == "�":
+            return None
+
+        delta_text = generated_text[len(self.previous_text):]
+        self.previous_text = generated_text
+        return self._output(delta_text, "function_call" if self.func_call_found else None)
+
+    def final_output(self) -> Dict[str, Any]:
+        if not self.stopped:
+            delta_text = self.detokenizer.flush()
+            if delta_text:
+                self.generated_text, _ = self.stop_matcher.truncate(self.detokenizer.text, delta_text)
+        return self._output("", "stop")
+
+    def _output(self, delta_text: str, finish_reason: Optional[str]) -> Dict[str, Any]:
+        return {
+            "id": self.completion_id,
+            "object": "text_completion",
+            "created": self.created,
+            "model": self.model_name,
+            "index": self.index,
+            "delta": delta_text,
+            "text": self.generated_text,
+            "logprobs": None,
+            "finish_reason": finish_reason,
+            "usage": {
+                "prompt_tokens": self.input_echo_len,
+                "completion_tokens": len(self.detokenizer.token_ids),
+                "total_tokens": self.input_echo_len + len(self.detokenizer.token_ids),
+            },
+        }
+
+
+def decode_stream(
+    tokenizer: "PreTrainedTokenizer",
+    token_ids: Iterable[List[int]],
+    params: Dict[str, Any],
+    input_echo_len: int,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Turns a stream of newly generated token ids into text completion outputs.
+
+    Args:
+        tokenizer: The tokenizer used for decoding the output tokens.
+        token_ids: An iterable yielding the new token ids of every decoding step.
+        params: A dictionary containing the request parameters.
+        input_echo_len: The number of prompt tokens.
+
+    Yields:
+        A dictionary representing each generated text completion.
+    """
+    decoder = StreamDecoder(tokenizer, params, input_echo_len)
+    try:
+        for new_ids in token_ids:
+            output = decoder.update(new_ids)
+            if output is not None:
+                yield output
+            if decoder.stopped:
+                break
+    finally:
+        # stops the generation once a stop string is found, or the outputs are no longer consumed
+        if hasattr(token_ids, "close"):
+            token_ids.close()
+    yield decoder.final_output()
@@ -1,7 +1,19 @@
 from __future__ import annotations
 
-from typing import List, Tuple
+import hashlib
+from collections import OrderedDict, deque
+from threading import Event, Lock
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TYPE_CHECKING,
+)
 
+import torch
 from openai.types.chat import ChatCompletionMessageParam
 from transformers.generation.logits_process import (
     LogitsProcessorList,
@@ -10,9 +22,13 @@ from transformers.generation.logits_process import (
     TopKLogitsWarper,
     TopPLogitsWarper,
 )
+from transformers.generation.stopping_criteria import StoppingCriteria
 
 from api.protocol import Role
 
+if TYPE_CHECKING:
+    from transformers import PreTrainedTokenizer
+
 
 def parse_messages(
     messages: List[ChatCompletionMessageParam], split_role=Role.USER.value
@@ -70,14 +86,6 @@ def prepare_logits_processor(
     return processor_list
 
 
-def is_partial_stop(output: str, stop_str: str):
-    """ Check whether the output contains a partial stop str. """
-    return any(
-        stop_str.startswith(output[-i:])
-        for i in range(0, min(len(output), len(stop_str)))
-    )
-
-
 # Models don't use the same configuration key for determining the maximum
 # sequence length.  Store them here so we can sanely check them.
 # NOTE: The ordering here is important.  Some models have two of these, and we
@@ -91,6 +99,57 @@ SEQUENCE_LENGTH_KEYS = [
 ]
 
 
+class StopSequencesCriteria(StoppingCriteria):
+    """
+    Stops generation once the generated tokens end with one of the given token
+    id sequences. The check runs on the device, without decoding any text.
+
+    Args:
+        stop_sequences: The token ids of the stop sequences.
+        prompt_length: The number of prompt tokens, which are not checked.
+        device: The device of the input ids.
+    """
+
+    def __init__(
+        self,
+        stop_sequences: List[List[int]],
+        prompt_length: int,
+        device: Optional[torch.device] = None,
+    ) -> None:
+        self.prompt_length = prompt_length
+        by_length: Dict[int, List[List[int]]] = {}
+        for seq in stop_sequences:
+            if seq:
+                by_length.setdefault(len(seq), []).append(seq)
+        self.stop_sequences = {
+            length: torch.as_tensor(seqs, device=device) for length, seqs in by_length.items()
+        }
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        is_done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        num_generated = input_ids.shape[1] - self.prompt_length
+        for length, seqs in self.stop_sequences.items():
+            if num_generated >= length:
+                tail = input_ids[:, -length:]
+                is_done |= (tail[:, None, :] == seqs[None, :, :]).all(-1).any(-1)
+        return is_done
+
+
+class CancelledCriteria(StoppingCriteria):
+    """
+    Stops generation within one step once `cancel_event` is set, e.g. when the
+    client of a streaming request has disconnected.
+    """
+
+    def __init__(self, cancel_event: Event) -> None:
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.shape[0],), self.cancel_event.is_set(), dtype=torch.bool, device=input_ids.device
+        )
+
+
 def get_context_length(config) -> int:
     """ Get the context length of a model from a huggingface model config. """
     rope_scaling = getattr(config, "rope_scaling", None)
@@ -102,35 +161,210 @@ def get_context_length(config) -> int:
     return 2048
 
 
-def apply_stopping_strings(reply: str, stop_strings: List[str]) -> Tuple[str, bool]:
+class StopStringMatcher:
     """
-    Apply stopping strings to the reply and check if a stop string is found.
+    Streaming multi-pattern matcher for stop strings (Aho-Corasick).
+
+    The text is fed piece by piece and every character is consumed once, so
+    the cost per step only depends on the length of the new text. The matcher
+    reports completed stop strings, and the length of the longest suffix of
+    the text which could still become a stop string, so that exactly this
+    much text is held back.
 
     Args:
-        reply (str): The reply to apply stopping strings to.
-        stop_strings (List[str]): The list of stopping strings to check for.
+        stop_strings: The stop strings to look for.
+    """
 
-    Returns:
-        Tuple[str, bool]: A tuple containing the modified reply and a boolean indicating if a stop string was found.
+    def __init__(self, stop_strings: Optional[List[str]] = None) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        # the longest stop string ending at each node
+        self._output: List[Optional[str]] = [None]
+
+        for string in stop_strings or []:
+            if string:
+                self._insert(string)
+        self._build()
+
+        self.state = 0
+        self.match: Optional[str] = None
+
+    @property
+    def num_pending(self) -> int:
+        """ The length of the longest suffix of the text which is a prefix of a stop string. """
+        return self._depth[self.state]
+
+    def feed(self, text: str) -> Optional[int]:
+        """
+        Consume the next piece of text.
+
+        Returns:
+            If a stop string is completed, the number of characters at the end of
+            the text consumed so far which belong to or follow the stop string,
+            otherwise `None`.
+        """
+        if len(self._goto) == 1:
+            return None
+
+        goto, fail, output = self._goto, self._fail, self._output
+        state = self.state
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state] is not None:
+                self.state, self.match = state, output[state]
+                return len(text) - i - 1 + len(self.match)
+
+        self.state = state
+        return None
+
+    def truncate(self, text: str, delta: str) -> Tuple[str, bool]:
+        """
+        Consume `delta`, the newly generated end of `text`, and strip any stop
+        string or partial stop string from the end of `text`.
+
+        Returns:
+            Tuple[str, bool]: The stripped text and whether a stop string was found.
+        """
+        cut = self.feed(delta)
+        if cut is not None:
+            return text[:len(text) - cut], True
+        if self.num_pending:
+            return text[:len(text) - self.num_pending], False
+        return text, False
+
+    def _insert(self, string: str) -> None:
+        node = 0
+        for char in string:
+            if char not in self._goto[node]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[node] + 1)
+                self._output.append(None)
+                self._goto[node][char] = len(self._goto) - 1
+            node = self._goto[node][char]
+        self._output[node] = string
+
+    def _build(self) -> None:
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0) if node else 0
+                if self._output[child] is None:
+                    self._output[child] = self._output[self._fail[child]]
+                queue.append(child)
+
+
+class IncrementalDetokenizer:
+    """
+    Decodes a growing sequence of token ids with a constant amount of work per token.
+
+    Only a small window of tokens is decoded at every step: the tokens from
+    `prefix_offset` to `read_offset` were decoded before and only provide the
+    context (e.g. the leading space of sentencepiece tokens), the text of the
+    tokens after `read_offset` is new. Text ending in an incomplete utf-8
+    character ("�") is held back until the next tokens complete it.
+
+    Args:
+        tokenizer: The tokenizer used for decoding.
+        **decode_kwargs: Extra arguments of `tokenizer.decode`.
+    """
+
+    def __init__(self, tokenizer: "PreTrainedTokenizer", **decode_kwargs: Any) -> None:
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text = ""
+
+    def add_tokens(self, token_ids: List[int]) -> str:
+        """ Append new token ids and return the newly decoded text. """
+        self.token_ids.extend(token_ids)
+        return self._decode(allow_partial=False)
+
+    def flush(self) -> str:
+        """ Return the held back text, even if it ends in an incomplete character. """
+        return self._decode(allow_partial=True)
+
+    def _decode(self, allow_partial: bool) -> str:
+        if self.read_offset == len(self.token_ids):
+            return ""
+
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset], **self.decode_kwargs
+        )
+        new_text = self.tokenizer.decode(self.token_ids[self.prefix_offset:], **self.decode_kwargs)
+        if len(new_text) <= len(prefix_text) or (new_text.endswith("�") and not allow_partial):
+            return ""
+
+        delta_text = new_text[len(prefix_text):]
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        self.text += delta_text
+        return delta_text
+
+
+class TokenCache:
+    """
+    LRU cache of the token ids of chat message segments, keyed by the role,
+    the metadata (e.g. the tool name of a ChatGLM3 message) and a hash of the
+    content, so that converting a long conversation only tokenizes its new
+    messages. Every template has its own cache.
+
+    The cached lists are shared and must not be modified by the caller.
     """
-    stop_found = False
-    for string in stop_strings:
-        idx = reply.find(string)
-        if idx != -1:
-            reply = reply[:idx]
-            stop_found = True
-            break
-
-    if not stop_found:
-        # If something like "\nYo" is generated just before "\nYou: is completed, trim it
-        for string in stop_strings:
-            for j in range(len(string) - 1, 0, -1):
-                if reply[-j:] == string[:j]:
-                    reply = reply[:-j]
-                    break
-            else:
-                continue
-
-            break
-
-    return reply, stop_found
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str, bytes], Any]" = OrderedDict()
+        self._lock = Lock()
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def encode(
+        self,
+        role: str,
+        content: str,
+        encode: Callable[[], List[int]],
+        metadata: str = "",
+    ) -> List[int]:
+        """ Returns the cached token ids of a segment, calling `encode` on a miss. """
+        return self._get(role, metadata, content, encode)
+
+    def count(self, content: str, encode: Callable[[], List[int]]) -> int:
+        """ Returns the cached number of tokens of a text, calling `encode` on a miss. """
+        return self._get("#count", "", content, lambda: len(encode()))
+
+    def _get(self, role: str, metadata: str, content: str, compute: Callable[[], Any]) -> Any:
+        key = (role, metadata, hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+        with self._lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.num_hits += 1
+                return value
+
+        value = compute()
+        with self._lock:
+            self.num_misses += 1
+            self.entries[key] = value
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+    def stats(self) -> Dict[str, Any]:
+        num_queries = self.num_hits + self.num_misses
+        return {
+            "num_entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "num_hits": self.num_hits,
+            "num_misses": self.num_misses,
+            "hit_rate": self.num_hits / num_queries if num_queries else 0.0,
+        }
@@ -1,11 +1,14 @@
+import asyncio
 import json
-from threading import Lock
+from threading import Event, Lock
 from typing import (
+    Any,
     Optional,
     Union,
     Iterator,
     List,
     AsyncIterator,
+    Tuple,
 )
 
 import anyio
@@ -17,13 +20,14 @@ from loguru import logger
 from pydantic import BaseModel
 from starlette.concurrency import iterate_in_threadpool
 
-from api.common import jsonify, dictify
+from api.common import EncodedChunk, jsonify, dictify, model_validate
 from api.config import SETTINGS
 from api.protocol import (
     ChatCompletionCreateParams,
     CompletionCreateParams,
     ErrorResponse,
-    ErrorCode
+    ErrorCode,
+    StreamOptions,
 )
 
 llama_outer_lock = Lock()
@@ -73,6 +77,10 @@ async def check_completion_requests(
     if error_check_ret is not None:
         return error_check_ret
 
+    # the best candidates are only known once all of them are generated, so they can't be streamed
+    if request.stream and (getattr(request, "best_of", None) or 1) > (request.n or 1):
+        raise HTTPException(status_code=400, detail="'best_of' greater than 'n' can't be used with 'stream'")
+
     _stop = stop or []
     _stop_token_ids = stop_token_ids or []
 
@@ -138,15 +146,201 @@ def _check_completion_requests(request: Union[CompletionCreateParams, ChatComple
         )
 
 
+def parse_prompt_format(prompt) -> Tuple[bool, list]:
+    # get the prompt, openai supports the following
+    # "a string, array of strings, array of tokens, or array of token arrays."
+    prompt_is_tokens = False
+    prompts = [prompt]  # case 1: a string
+    if isinstance(prompt, list):
+        if len(prompt) == 0:
+            raise ValueError("please provide at least one prompt")
+        elif isinstance(prompt[0], str):
+            prompt_is_tokens = False
+            prompts = prompt  # case 2: array of strings
+        elif isinstance(prompt[0], int):
+            prompt_is_tokens = True
+            prompts = [prompt]  # case 3: array of tokens
+        elif isinstance(prompt[0], list) and all(isinstance(p, list) and p and isinstance(p[0], int) for p in prompt):
+            prompt_is_tokens = True
+            prompts = prompt  # case 4: array of (non-empty) token arrays
+        else:
+            raise ValueError(
+                "prompt must be a string, array of strings, array of tokens, or array of token arrays"
+            )
+    return prompt_is_tokens, prompts
+
+
+class DisconnectWatcher:
+    """
+    Listens for the `http.disconnect` of a request in a background task, so
+    that waiting for a response does not poll the receive channel. When the
+    client disconnects, `disconnected` is set and the body of the `async with`
+    block is cancelled, which stops (or leaves) its generation right away.
+
+    Streaming responses are watched by `EventSourceResponse` itself.
+    """
+
+    def __init__(self, request: Request) -> None:
+        self.request = request
+        self.disconnected = False
+        self._scope: Optional[anyio.CancelScope] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "DisconnectWatcher":
+        self._scope = anyio.CancelScope().__enter__()
+        self._task = asyncio.create_task(self._watch())
+        return self
+
+    async def __aexit__(self, *exc_info) -> bool:
+        self._task.cancel()
+        return self._scope.__exit__(*exc_info)
+
+    async def _watch(self) -> None:
+        while (await self.request.receive())["type"] != "http.disconnect":
+            pass
+        logger.info(f"Disconnected from client {self.request.client}")
+        self.disconnected = True
+        self._scope.cancel()
+
+
+def _split_delta(chunk: Any) -> Optional[Tuple[Any, str]]:
+    """
+    Returns the merge key and the content of a chunk which only carries
+    content (no role, function call or logprobs) for a single choice, else `None`.
+    """
+    if isinstance(chunk, EncodedChunk):
+        if chunk.content is None:
+            return None
+        return (id(chunk.encoder), *chunk.fields.items()), chunk.content
+
+    choices = getattr(chunk, "choices", None)
+    if not isinstance(chunk, BaseModel) or not choices or len(choices) != 1:
+        return None
+    choice = choices[0]
+    if getattr(choice, "logprobs", None) is not None:
+        return None
+    delta = getattr(choice, "delta", None)
+    if delta is None:  # a text completion
+        content = choice.text
+    elif delta.content is None or delta.role or delta.function_call or delta.tool_calls:
+        return None
+    else:
+        content = delta.content
+    return (type(chunk), chunk.id, chunk.model, choice.index, choice.finish_reason), content
+
+
+def _merge_deltas(last: Any, contents: List[str]) -> Any:
+    """ Returns `last` with the merged content of a run of chunks. """
+    if len(contents) == 1:
+        return last
+    content = "".join(contents)
+    if isinstance(last, EncodedChunk):
+        return last.encoder.encode(content, **last.fields)
+
+    data = dictify(last)
+    choice = data["choices"][0]
+    if "delta" in choice:
+        choice["delta"]["content"] = content
+    else:
+        choice["text"] = content
+    return model_validate(type(last), data)
+
+
+async def coalesce_deltas(
+    chunks: AsyncIterator,
+    flush_interval: float = 0,
+    flush_tokens: int = 0,
+) -> AsyncIterator:
+    """
+    Merges the consecutive content deltas of a stream into fewer chunks.
+    A run of deltas of the same choice is sent `flush_interval` seconds
+    after its first delta arrived, once it has `flush_tokens` deltas, or as
+    soon as any other chunk arrives. With a window, a slow generation is
+    never held back longer than `flush_interval`.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = chunks.__aiter__()
+    pending_key, pending_contents, pending_last, deadline = None, [], None, None
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+            if pending_contents and deadline is not None:
+                # waiting does not cancel the read of the next chunk on timeout
+                done, _ = await asyncio.wait({next_chunk}, timeout=max(deadline - loop.time(), 0))
+                if not done:
+                    yield _merge_deltas(pending_last, pending_contents)
+                    pending_contents = []
+                    continue
+
+            try:
+                chunk = await next_chunk
+            except StopAsyncIteration:
+                break
+            finally:
+                next_chunk = None
+
+            split = _split_delta(chunk)
+            if pending_contents and (split is None or split[0] != pending_key):
+                yield _merge_deltas(pending_last, pending_contents)
+                pending_contents = []
+            if split is None:
+                yield chunk
+                continue
+
+            if not pending_contents:
+                pending_key = split[0]
+                deadline = loop.time() + flush_interval if flush_interval > 0 else None
+            pending_contents.append(split[1])
+            pending_last = chunk
+            if flush_tokens and len(pending_contents) >= flush_tokens:
+                yield _merge_deltas(pending_last, pending_contents)
+                pending_contents = []
+
+        if pending_contents:
+            yield _merge_deltas(pending_last, pending_contents)
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+
+
+def get_flush_options(stream_options: Optional[StreamOptions] = None) -> Tuple[float, int]:
+    """ Returns the flush interval (seconds) and the max number of merged deltas of a stream. """
+    flush_interval, flush_tokens = SETTINGS.stream_flush_interval, SETTINGS.stream_flush_tokens
+    if stream_options is not None:
+        if stream_options.flush_interval is not None:
+            flush_interval = stream_options.flush_interval
+        if stream_options.flush_tokens is not None:
+            flush_tokens = stream_options.flush_tokens
+    return max(flush_interval, 0) / 1000, max(flush_tokens, 0)
+
+
 async def get_event_publisher(
     request: Request,
     inner_send_chan: MemoryObjectSendStream,
     iterator: Union[Iterator, AsyncIterator],
+    cancel_event: Optional[Event] = None,
+    stream_options: Optional[StreamOptions] = None,
 ):
+    """
+    Sends the chunks of `iterator` to the client. `cancel_event` is set once
+    the stream is over, so that a generation abandoned by the client stops
+    instead of decoding up to `max_tokens`. The content deltas are merged
+    into fewer chunks when a flush interval or size is configured.
+
+    A disconnect is noticed by the listener of `EventSourceResponse`, which
+    cancels this task, so the chunks are sent without polling the request.
+    """
+    flush_interval, flush_tokens = get_flush_options(stream_options)
     async with inner_send_chan:
         try:
             if SETTINGS.engine not in ["vllm", "tgi"]:
-                async for chunk in iterate_in_threadpool(iterator):
+                # streams shared by coalesced requests are already asynchronous
+                chunks = iterator if isinstance(iterator, AsyncIterator) else iterate_in_threadpool(iterator)
+                if flush_interval > 0 or flush_tokens > 1:
+                    chunks = coalesce_deltas(chunks, flush_interval, flush_tokens)
+                async for chunk in chunks:
                     if isinstance(chunk, BaseModel):
                         chunk = jsonify(chunk)
                     elif isinstance(chunk, dict):
@@ -154,18 +348,15 @@ async def get_event_publisher(
 
                     await inner_send_chan.send(dict(data=chunk))
 
-                    if await request.is_disconnected():
-                        raise anyio.get_cancelled_exc_class()()
-
                     if SETTINGS.interrupt_requests and llama_outer_lock.locked():
                         await inner_send_chan.send(dict(data="[DONE]"))
                         raise anyio.get_cancelled_exc_class()()
             else:
+                if flush_interval > 0 or flush_tokens > 1:
+                    iterator = coalesce_deltas(iterator, flush_interval, flush_tokens)
                 async for chunk in iterator:
                     chunk = jsonify(chunk)
                     await inner_send_chan.send(dict(data=chunk))
-                    if await request.is_disconnected():
-                        raise anyio.get_cancelled_exc_class()()
             await inner_send_chan.send(dict(data="[DONE]"))
 
         except anyio.get_cancelled_exc_class() as e:
@@ -173,3 +364,7 @@ async def get_event_publisher(
             with anyio.move_on_after(1, shield=True):
                 logger.info(f"Disconnected from client (via refresh/close) {request.client}")
                 raise e
+
+        finally:
+            if cancel_event is not None:
+                cancel_event.set()
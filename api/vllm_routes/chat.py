@@ -2,12 +2,17 @@ import time
 import traceback
 import uuid
 from functools import partial
-from typing import AsyncIterator
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Optional,
+)
 
 import anyio
 import vllm
 from fastapi import APIRouter, Depends, status
-from fastapi import HTTPException, Request
+from fastapi import HTTPException, Request, Response
 from loguru import logger
 from openai.types.chat import (
     ChatCompletionMessage,
@@ -30,12 +35,13 @@ from vllm.sampling_params import SamplingParams
 
 from api.common import dictify, model_validate
 from api.engine.vllm_engine import VllmEngine
-from api.models import LLM_ENGINE
+from api.models import LLM_ENGINE, ADMISSION_CONTROLLER, REQUEST_COALESCER
 from api.protocol import Role, ChatCompletionCreateParams
 from api.utils import (
     check_api_key,
     check_completion_requests,
     get_event_publisher,
+    DisconnectWatcher,
 )
 
 chat_router = APIRouter(prefix="/chat")
@@ -73,6 +79,19 @@ async def create_chat_completion(
     params.update(dict(prompt_or_messages=request.messages, echo=False))
     logger.debug(f"==== request ====\n{params}")
 
+    # identical deterministic requests in flight share the outputs of one generation, and its generation slot
+    key = REQUEST_COALESCER.key("chat.completion", params)
+    ticket = await REQUEST_COALESCER.admit(key, ADMISSION_CONTROLLER)
+    return await ADMISSION_CONTROLLER.hold(ticket, _create_chat_completion(request, raw_request, engine, params, key))
+
+
+async def _create_chat_completion(
+    request: ChatCompletionCreateParams,
+    raw_request: Request,
+    engine: VllmEngine,
+    params: Dict[str, Any],
+    key: Optional[str],
+):
     request_id: str = f"chatcmpl-{str(uuid.uuid4())}"
     token_ids = engine.template.convert_messages_to_ids(
         messages=request.messages,
@@ -153,6 +172,10 @@ async def create_chat_completion(
     except ValueError as e:
         traceback.print_exc()
 
+    # identical deterministic requests in flight share the outputs of one generation
+    generator = result_generator
+    result_generator = await REQUEST_COALESCER.run(key, lambda: generator)
+
     if request.stream:
         iterator = create_chat_completion_stream(result_generator, request, request_id, engine)
         send_chan, recv_chan = anyio.create_memory_object_stream(10)
@@ -163,16 +186,21 @@ async def create_chat_completion(
                 request=raw_request,
                 inner_send_chan=send_chan,
                 iterator=iterator,
+                stream_options=request.stream_options,
             ),
         )
     else:
         # Non-streaming response
         final_res: RequestOutput = None
-        async for res in result_generator:
-            if raw_request is not None and await raw_request.is_disconnected():
+        async with DisconnectWatcher(raw_request) as watcher:
+            async for res in result_generator:
+                final_res = res
+        if watcher.disconnected:
+            if key is None:
                 await engine.model.abort(request_id)
-                return
-            final_res = res
+            else:
+                await result_generator.aclose()  # aborted once all its clients have gone
+            return Response(status_code=499)
 
         assert final_res is not None
         choices = []
@@ -2,12 +2,18 @@ import time
 import traceback
 import uuid
 from functools import partial
-from typing import AsyncIterator, Tuple
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    Optional,
+    Tuple,
+)
 
 import anyio
 import vllm
 from fastapi import APIRouter, Depends
-from fastapi import Request
+from fastapi import Request, Response
 from loguru import logger
 from openai.types.completion import Completion
 from openai.types.completion_choice import CompletionChoice, Logprobs
@@ -19,12 +25,14 @@ from vllm.utils import merge_async_iterators
 
 from api.common import dictify
 from api.engine.vllm_engine import VllmEngine
-from api.models import LLM_ENGINE
+from api.models import LLM_ENGINE, ADMISSION_CONTROLLER, REQUEST_COALESCER
 from api.protocol import CompletionCreateParams
 from api.utils import (
     check_completion_requests,
     get_event_publisher,
+    DisconnectWatcher,
     check_api_key,
+    parse_prompt_format,
 )
 
 completion_router = APIRouter()
@@ -35,30 +43,6 @@ def get_engine():
     yield LLM_ENGINE
 
 
-def parse_prompt_format(prompt) -> Tuple[bool, list]:
-    # get the prompt, openai supports the following
-    # "a string, array of strings, array of tokens, or array of token arrays."
-    prompt_is_tokens = False
-    prompts = [prompt]  # case 1: a string
-    if isinstance(prompt, list):
-        if len(prompt) == 0:
-            raise ValueError("please provide at least one prompt")
-        elif isinstance(prompt[0], str):
-            prompt_is_tokens = False
-            prompts = prompt  # case 2: array of strings
-        elif isinstance(prompt[0], int):
-            prompt_is_tokens = True
-            prompts = [prompt]  # case 3: array of tokens
-        elif isinstance(prompt[0], list) and isinstance(prompt[0][0], int):
-            prompt_is_tokens = True
-            prompts = prompt  # case 4: array of token arrays
-        else:
-            raise ValueError(
-                "prompt must be a string, array of strings, array of tokens, or array of token arrays"
-            )
-    return prompt_is_tokens, prompts
-
-
 @completion_router.post("/completions", dependencies=[Depends(check_api_key)])
 async def create_completion(
     request: CompletionCreateParams,
@@ -85,6 +69,19 @@ async def create_completion(
     params.update(dict(prompt_or_messages=request.prompt))
     logger.debug(f"==== request ====\n{params}")
 
+    # identical deterministic requests in flight share the outputs of one generation, and its generation slot
+    key = REQUEST_COALESCER.key("completion", params)
+    ticket = await REQUEST_COALESCER.admit(key, ADMISSION_CONTROLLER)
+    return await ADMISSION_CONTROLLER.hold(ticket, _create_completion(request, raw_request, engine, params, key))
+
+
+async def _create_completion(
+    request: CompletionCreateParams,
+    raw_request: Request,
+    engine: VllmEngine,
+    params: Dict[str, Any],
+    key: Optional[str],
+):
     request_id: str = f"cmpl-{str(uuid.uuid4())}"
     # Schedule the request and get the result generator.
     generators = []
@@ -172,6 +169,10 @@ async def create_completion(
 
     result_generator: AsyncIterator[Tuple[int, RequestOutput]] = merge_async_iterators(*generators)
 
+    # identical deterministic requests in flight share the outputs of one generation
+    generator = result_generator
+    result_generator = await REQUEST_COALESCER.run(key, lambda: generator)
+
     if request.stream:
         iterator = create_completion_stream(
             engine, result_generator, request, request_id, num_prompts
@@ -184,16 +185,23 @@ async def create_completion(
                 request=raw_request,
                 inner_send_chan=send_chan,
                 iterator=iterator,
+                stream_options=request.stream_options,
             ),
         )
     else:
         # Non-streaming response
         final_res_batch = [None] * num_prompts
-        async for i, res in result_generator:
-            if await raw_request.is_disconnected():
-                # Abort the request if the client disconnects.
-                await engine.model.abort(f"{request_id}-{i}")
-            final_res_batch[i] = res
+        async with DisconnectWatcher(raw_request) as watcher:
+            async for i, res in result_generator:
+                final_res_batch[i] = res
+        if watcher.disconnected:
+            # Abort the request if the client disconnects.
+            if key is None:
+                for i in range(num_prompts):
+                    await engine.model.abort(f"{request_id}-{i}")
+            else:
+                await result_generator.aclose()  # aborted once all its clients have gone
+            return Response(status_code=499)
 
         choices = []
         num_prompt_tokens = 0
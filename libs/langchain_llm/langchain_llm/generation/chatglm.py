@@ -10,7 +10,7 @@ from openai.types.chat import ChatCompletionMessageParam
 from transformers import PreTrainedTokenizer, PreTrainedModel
 from transformers.generation.logits_process import LogitsProcessor
 
-from .utils import apply_stopping_strings
+from .utils import IncrementalDetokenizer, StopStringMatcher
 from .._types import Role
 
 
@@ -106,15 +106,15 @@ def generate_stream_chatglm(
         gen_kwargs["temperature"] = temperature
 
     total_len, previous_text = 0, ""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    start = 0 if echo else input_echo_len
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
     created: int = int(time.time())
     for total_ids in model.stream_generate(**inputs, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
+        total_len = total_ids.shape[-1]
 
-        output_ids = total_ids if echo else total_ids[input_echo_len:]
-        response = tokenizer.decode(output_ids)
-        response = process_response(response)
+        detokenizer.add_tokens(total_ids[0, start + len(detokenizer.token_ids):].tolist())
+        response = process_response(detokenizer.text)
 
         delta_text = response[len(previous_text):]
         previous_text = response
@@ -203,17 +203,19 @@ def generate_stream_chatglm_v3(
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
 
-    total_len, previous_text = 0, ""
+    total_len, previous_text, response = 0, "", ""
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    matcher = StopStringMatcher(["<|observation|>"])
+    start = 0 if echo else input_echo_len
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
     created: int = int(time.time())
     for total_ids in model.stream_generate(**inputs, eos_token_id=eos_token_id, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        
-        output_ids = total_ids[:-1] if echo else total_ids[input_echo_len:-1]
-        response = tokenizer.decode(output_ids)
-        if response and response[-1] != "�":
-            response, stop_found = apply_stopping_strings(response, ["<|observation|>"])
+        total_len = total_ids.shape[-1]
+
+        # the last token is left out, it may be the eos or the <|user|> token
+        delta_text = detokenizer.add_tokens(total_ids[0, start + len(detokenizer.token_ids):-1].tolist())
+        if detokenizer.text:
+            response, stop_found = matcher.truncate(detokenizer.text, delta_text)
 
             delta_text = response[len(previous_text):]
             previous_text = response
@@ -7,16 +7,19 @@ from typing import Iterable, Dict, Any
 
 import torch
 from transformers import (
-    TextIteratorStreamer,
     PreTrainedModel,
     PreTrainedTokenizer,
+    StoppingCriteriaList,
 )
 
 from .qwen import check_is_qwen
 from .utils import (
+    IncrementalDetokenizer,
+    StopSequencesCriteria,
+    StopStringMatcher,
+    TokenIdStreamer,
+    get_stop_sequences,
     prepare_logits_processor,
-    is_partial_stop,
-    apply_stopping_strings,
 )
 
 
@@ -28,7 +31,6 @@ def generate_stream(
 ):
     # Read parameters
     input_ids = params.get("inputs")
-    prompt = params.get("prompt")
     model_name = params.get("model", "llm")
     temperature = float(params.get("temperature", 1.0))
     repetition_penalty = float(params.get("repetition_penalty", 1.0))
@@ -63,6 +65,23 @@ def generate_stream(
     else:
         start_ids = torch.as_tensor([input_ids], device=device)
 
+    detokenizer = IncrementalDetokenizer(
+        tokenizer,
+        skip_special_tokens=False if check_is_qwen(model) else True,  # fix for qwen react
+        spaces_between_special_tokens=False,
+        clean_up_tokenization_spaces=True,
+    )
+    if echo:
+        detokenizer.add_tokens(input_ids)
+    if stop_str is not None and not isinstance(stop_str, (str, Iterable)):
+        raise ValueError("Invalid stop field type.")
+    matcher = StopStringMatcher([stop_str] if isinstance(stop_str, str) else stop_str)
+    if logprobs is not None:
+        token_texts = [tokenizer.decode(token) for token in input_ids]
+        text_offsets = [0]
+        for text in token_texts[:-1]:
+            text_offsets.append(text_offsets[-1] + len(text))
+
     past_key_values, sent_interrupt = None, False
     token_logprobs = [None]  # The first token has no logprobs.
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
@@ -140,77 +159,42 @@ def generate_stream(
 
         token = tokens[0]
         output_ids.append(token)
+        stop_cut = matcher.feed(detokenizer.add_tokens([token]))
 
         if logprobs is not None:
             # Cannot use last_token_logits because logprobs is based on raw logits.
             token_logprobs.append(
                 torch.log_softmax(logits[0, -1, :], dim=-1)[token].tolist()
             )
+            text_offsets.append(text_offsets[-1] + len(token_texts[-1]))
+            token_texts.append(tokenizer.decode(token))
 
-        if token in stop_token_ids:
+        if token in stop_token_ids or stop_cut is not None:
             stopped = True
         else:
             stopped = False
 
         # Yield the output tokens
         if i % 2 == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len(prompt)
-            else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
-
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=False if check_is_qwen(model) else True,  # fix for qwen react
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
-            )
+            output = detokenizer.text
 
             ret_logprobs = None
             if logprobs is not None:
+                start = 0 if echo else input_echo_len
                 ret_logprobs = {
-                    "text_offset": [],
-                    "tokens": [
-                        tokenizer.decode(token)
-                        for token in (
-                            output_ids if echo else output_ids[input_echo_len:]
-                        )
-                    ],
-                    "token_logprobs": token_logprobs if echo else token_logprobs[input_echo_len:],
-                    "top_logprobs": [{}] * len(token_logprobs if echo else token_logprobs[input_echo_len:]),
+                    "text_offset": [offset - text_offsets[start] for offset in text_offsets[start:]],
+                    "tokens": token_texts[start:],
+                    "token_logprobs": token_logprobs[start:],
+                    "top_logprobs": [{}] * len(token_logprobs[start:]),
                 }
-                # Compute text_offset
-                curr_pos = 0
-                for text in ret_logprobs["tokens"]:
-                    ret_logprobs["text_offset"].append(curr_pos)
-                    curr_pos += len(text)
 
             partially_stopped, finish_reason = False, None
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            if each_stop == "Observation:":
-                                finish_reason = "function_call"
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+            if stop_cut is not None:
+                output = output[:len(output) - stop_cut]
+                if matcher.match == "Observation:":
+                    finish_reason = "function_call"
+            else:
+                partially_stopped = matcher.num_pending > 0
 
             # Prevent yielding partial stop sequence
             if (not partially_stopped) and output and output[-1] != "�":
@@ -294,9 +278,20 @@ def generate_stream_v2(
         generation_kwargs["do_sample"] = False
         generation_kwargs.pop("top_k")
 
-    streamer = TextIteratorStreamer(
-        tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True
-    )
+    # stop on the device instead of decoding every step to look for the stop tokens
+    eos_token_id = model.generation_config.eos_token_id
+    if eos_token_id is None:
+        eos_token_id = []
+    elif isinstance(eos_token_id, int):
+        eos_token_id = [eos_token_id]
+    generation_kwargs["eos_token_id"] = list(dict.fromkeys(stop_token_ids + list(eos_token_id)))
+    stop_sequences = get_stop_sequences(tokenizer, stop_strings)
+    if stop_sequences:
+        generation_kwargs["stopping_criteria"] = StoppingCriteriaList(
+            [StopSequencesCriteria(stop_sequences, input_echo_len, device)]
+        )
+
+    streamer = TokenIdStreamer(timeout=60.0, skip_token_ids=stop_token_ids)
     generation_kwargs["streamer"] = streamer
 
     if "GenerationMixin" not in str(model.generate.__func__):
@@ -306,14 +301,17 @@ def generate_stream_v2(
     thread.start()
 
     generated_text, func_call_found = "", False
+    detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
+    stop_matcher = StopStringMatcher(stop_strings)
+    function_matcher = StopStringMatcher(["Observation:"] if functions else [])
     completion_id: str = f"cmpl-{str(uuid.uuid4())}"
     created: int = int(time.time())
     previous_text = ""
-    for i, new_text in enumerate(streamer):
-        generated_text += new_text
-        if functions:
-            _, func_call_found = apply_stopping_strings(generated_text, ["Observation:"])
-        generated_text, stop_found = apply_stopping_strings(generated_text, stop_strings)
+    for i, new_ids in enumerate(streamer):
+        delta_text = detokenizer.add_tokens(new_ids)
+        if not func_call_found:
+            func_call_found = function_matcher.feed(delta_text) is not None
+        generated_text, stop_found = stop_matcher.truncate(detokenizer.text, delta_text)
 
         if generated_text and generated_text[-1] != "�":
             delta_text = generated_text[len(previous_text):]
@@ -0,0 +1,50 @@
+import json
+import time
+
+from openai import OpenAI
+
+client = OpenAI(
+    api_key="EMPTY",
+    base_url="http://192.168.0.59:7891/v1/",
+)
+
+requests = [
+    {
+        "custom_id": f"request-{i}",
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": "qwen",
+            "messages": [{"role": "user", "content": f"1 + {i} = ?"}],
+            "max_tokens": 32,
+        },
+    }
+    for i in range(8)
+]
+with open("batch_input.jsonl", "w") as f:
+    f.write("\n".join(json.dumps(r) for r in requests))
+
+
+uf = client.files.create(
+    file=open("batch_input.jsonl", "rb"),
+    purpose="batch",
+)
+print(uf)
+
+
+batch = client.batches.create(
+    input_file_id=uf.id,
+    endpoint="/v1/chat/completions",
+    completion_window="24h",
+)
+print(batch)
+
+while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+    time.sleep(1)
+    batch = client.batches.retrieve(batch.id)
+    print(batch.status, batch.request_counts)
+
+if batch.output_file_id:
+    print(client.files.content(batch.output_file_id).text)
+
+print(client.batches.list())
@@ -0,0 +1,55 @@
+import random
+
+from openai.types.chat import ChatCompletionChunk
+from openai.types.completion import Completion
+
+import api.common
+from api.common import ChunkEncoder, jsonify
+from api.engine.hf import HuggingFaceEngine
+
+build_chat_chunk = HuggingFaceEngine._build_chat_chunk
+build_completion_chunk = HuggingFaceEngine._build_completion_chunk
+
+# quotes, escapes, control characters, the code point below the surrogates and non-BMP text
+alphabet = ["a", " ", '"', "\\", "/", "<", "\n", "\r", "\t", "\x00", "\x1f", "\x7f", "é", "中", "퟿", "😀", "𝄞"]
+
+
+def check(use_orjson: bool, num_samples: int = 2000) -> int:
+    orjson = api.common.orjson
+    if not use_orjson:
+        api.common.orjson = None
+
+    mismatches = 0
+    try:
+        chat_encoder = ChunkEncoder(ChatCompletionChunk, build_chat_chunk)
+        completion_encoder = ChunkEncoder(Completion, build_completion_chunk)
+        for _ in range(num_samples):
+            content = "".join(random.choice(alphabet) for _ in range(random.randint(0, 12)))
+            index = random.randint(0, 2)
+
+            fields = dict(
+                id="chatcmpl-0",
+                created=1700000000,
+                model=random.choice(["qwen", 'model "x"', "模型"]),
+                index=index,
+                role=random.choice([None, "assistant"]),
+                finish_reason=random.choice([None, "stop", "length", "function_call"]),
+            )
+            mismatches += chat_encoder.encode(content, **fields) != jsonify(build_chat_chunk(content, **fields))
+            mismatches += chat_encoder.encode(None, **fields) != jsonify(build_chat_chunk(None, **fields))
+
+            fields = dict(id="cmpl-0", created=1700000000, model="qwen", index=index)
+            mismatches += completion_encoder.encode(content, **fields) != jsonify(build_completion_chunk(content, **fields))
+    finally:
+        api.common.orjson = orjson
+    return mismatches
+
+
+random.seed(0)
+for use_orjson in (True, False):
+    if use_orjson and api.common.orjson is None:
+        print("orjson is not installed, skipped")
+        continue
+    mismatches = check(use_orjson)
+    print(f"{'orjson' if use_orjson else 'json'}: {mismatches} mismatches")
+    assert mismatches == 0
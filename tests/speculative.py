@@ -0,0 +1,60 @@
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from api.engine.speculative import SpeculativeDecoder
+
+
+class Tokenizer:
+    eos_token_id = 1
+    pad_token_id = 0
+
+
+class OracleProposer:
+    """ Proposes the greedy continuation, so every draft is accepted. """
+
+    def __init__(self, prompt_length, reference):
+        self.prompt_length = prompt_length
+        self.reference = reference
+
+    def propose(self, token_ids, num_tokens):
+        start = len(token_ids) - self.prompt_length
+        return self.reference[start:start + num_tokens], None
+
+
+torch.manual_seed(0)
+config = LlamaConfig(
+    vocab_size=64,
+    hidden_size=32,
+    intermediate_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=4,
+    num_key_value_heads=2,
+    eos_token_id=1,
+    pad_token_id=0,
+)
+model = LlamaForCausalLM(config).eval()
+
+prompt = [2, 5, 7, 9, 11]
+with torch.inference_mode():
+    output = model.generate(
+        torch.tensor([prompt]), max_new_tokens=16, do_sample=False, eos_token_id=[], pad_token_id=0
+    )
+reference = output[0, len(prompt):].tolist()
+
+decoder = SpeculativeDecoder(num_speculative_tokens=5)
+for stop_index in range(1, 12):
+    # the stop token is met among the accepted drafts (or the bonus token) of a step
+    stop_token = reference[stop_index]
+    expected = reference[:reference.index(stop_token)]
+    decoder.get_proposer = lambda *args: OracleProposer(len(prompt), reference)
+    params = dict(inputs=prompt, temperature=0, max_tokens=16, stop_token_ids=[stop_token])
+    got = [t for new_ids in decoder.generate(model, Tokenizer(), params) for t in new_ids]
+    print(f"stop at {stop_index}: {got == expected}")
+    assert got == expected, (got, expected)
+
+# the last step is cut at max_tokens
+expected = (reference[:reference.index(1)] if 1 in reference else reference)[:7]
+params = dict(inputs=prompt, temperature=0, max_tokens=7, stop_token_ids=[])
+got = [t for new_ids in decoder.generate(model, Tokenizer(), params) for t in new_ids]
+print(f"max_tokens: {got == expected}")
+assert got == expected, (got, expected)
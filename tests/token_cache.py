@@ -0,0 +1,103 @@
+import json
+
+from transformers import AutoTokenizer
+
+from api.templates.baichuan import build_baichuan_chat_input
+from api.templates.glm import build_chatglm3_chat_input, process_chatglm_messages
+from api.templates.qwen import build_qwen_chat_input
+from api.templates.utils import TokenCache
+
+tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_weather",
+            "description": "Get the current weather in a given location.",
+            "parameters": {
+                "type": "object",
+                "properties": {"location": {"type": "string", "description": "The city, e.g. 北京"}},
+                "required": ["location"],
+            },
+        },
+    }
+]
+
+# a conversation growing by one turn per request, with a function call answered by its result
+turns = [
+    [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好👋！有什么可以帮你？"}],
+    [
+        {"role": "user", "content": "What's the weather like in Beijing?"},
+        {
+            "role": "assistant",
+            "content": 'get_current_weather\n```python\ntool_call(location="北京")\n```',
+            "function_call": {"name": "get_current_weather", "arguments": json.dumps({"location": "北京"})},
+        },
+        {"role": "function", "name": "get_current_weather", "content": '{"temperature": "22", "unit": "celsius"}'},
+        {"role": "assistant", "content": "It's 22 °C in Beijing.\n\nAnything else?"},
+    ],
+    [{"role": "user", "content": "  Write a haiku.\n"}, {"role": "assistant", "content": "Quiet winter lake\n..."}],
+    [{"role": "user", "content": "Thanks!"}],
+]
+
+
+def build_chatglm3(tokenizer, messages, tools, token_cache):
+    return build_chatglm3_chat_input(tokenizer, process_chatglm_messages(messages, tools), token_cache)
+
+
+def build_qwen(tokenizer, messages, tools, token_cache):
+    return build_qwen_chat_input(tokenizer, messages, tools=tools, token_cache=token_cache)
+
+
+def build_baichuan(tokenizer, messages, tools, token_cache):
+    return build_baichuan_chat_input(tokenizer, messages, token_cache=token_cache)
+
+
+# the templates tokenizing every message on its own, which take the tokens of the messages from their cache:
+# (tokenizer, builder, whether the template supports tools)
+BUILDERS = {
+    "chatglm3": ("THUDM/chatglm3-6b", build_chatglm3, True),
+    "qwen": ("Qwen/Qwen-7B-Chat", build_qwen, True),
+    "baichuan": ("baichuan-inc/Baichuan-13B-Chat", build_baichuan, False),
+    "baichuan2": ("baichuan-inc/Baichuan2-7B-Chat", build_baichuan, False),
+}
+
+
+def conversations(with_tools: bool):
+    """ Yields the conversation after every turn, with or without the function call and its result. """
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in turns:
+        if not with_tools:
+            turn = [m for m in turn if m["role"] != "function" and "function_call" not in m]
+        messages = messages + turn
+        yield messages
+
+
+def check(name: str, tokenizer, build, with_tools: bool) -> int:
+    """ Builds the growing conversation with one long-lived cache, and without cache every time. """
+    token_cache = TokenCache()
+    request_tools = tools if with_tools else None
+    mismatches = 0
+    for messages in conversations(with_tools):
+        got = build(tokenizer, messages, request_tools, token_cache)
+        mismatches += got != build(tokenizer, messages, request_tools, None)
+
+        if name == "chatglm3":  # the builder follows `tokenizer.build_chat_input`
+            history = process_chatglm_messages(messages, request_tools)
+            expected = tokenizer.build_chat_input(
+                history[-1]["content"], history=history[:-1], role=history[-1]["role"]
+            )["input_ids"][0].tolist()
+            mismatches += got != expected
+    return mismatches
+
+
+for name, (path, build, supports_tools) in BUILDERS.items():
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
+    except Exception as e:
+        print(f"{name}: skipped, can't load {path} ({type(e).__name__})")
+        continue
+
+    for with_tools in (False, True) if supports_tools else (False,):
+        mismatches = check(name, tokenizer, build, with_tools)
+        print(f"{name} {'with' if with_tools else 'without'} tools: {mismatches} mismatches")
+        assert mismatches == 0